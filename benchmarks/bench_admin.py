@@ -0,0 +1,61 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks of admin."""
+from django.contrib.auth.models import User
+from django.test import override_settings
+from django.urls import reverse
+
+from benchmarks.utils import BenchmarkTestCase, create_payments, generate_payments, get_sizes
+from django_pain.admin.paginators import AFTER_VAR, KeysetChangeList
+from django_pain.constants import PaymentState
+from django_pain.models import BankAccount, BankPayment
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls')
+class BenchmarkBankPaymentAdmin(BenchmarkTestCase):
+    """Benchmark changelist of bank payments."""
+
+    def setUp(self):
+        self.account = BankAccount.objects.create(account_number='123456789/0123', currency='CZK')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.url = reverse('admin:django_pain_bankpayment_changelist')
+
+    def _get(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+
+    def test_changelist(self):
+        self.client.force_login(self.admin)
+        for size in get_sizes():
+            with self.subTest(size=size):
+                # Realized payments are listed by default.
+                create_payments(self.account, size, state=PaymentState.PROCESSED)
+                pages = (size - 1) // 100 + 1
+                variable_symbol = list(generate_payments(size))[size // 2]['var_symbol']
+
+                self.measure('changelist_first_page/{}'.format(size), lambda: self._get({}))
+                self.measure('changelist_middle_page/{}'.format(size), lambda: self._get({'p': pages // 2}))
+                self.measure('changelist_last_page/{}'.format(size), lambda: self._get({'p': pages}))
+                self.measure('changelist_search/{}'.format(size), lambda: self._get({'q': variable_symbol}))
+                with override_settings(PAIN_ADMIN_KEYSET_PAGINATION=True):
+                    payment = BankPayment.objects.order_by(*KeysetChangeList.keyset_ordering)[size // 2]
+                    cursor = KeysetChangeList._encode_cursor(payment)
+                    self.measure('changelist_keyset_middle_page/{}'.format(size),
+                                 lambda: self._get({AFTER_VAR: cursor}))
+                BankPayment.objects.all().delete()
@@ -0,0 +1,81 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks of payments import."""
+import os
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+from django.core.management import call_command
+from django.test import override_settings
+
+from benchmarks.utils import BenchmarkTestCase, FakeStatementParser, get_sizes, write_transproc_xml
+from django_pain.models import BankAccount, BankPayment
+
+PARSER = 'django_pain.parsers.transproc.TransprocXMLParser'
+
+
+class BenchmarkImportPayments(BenchmarkTestCase):
+    """Benchmark import_payments command."""
+
+    def setUp(self):
+        BankAccount.objects.create(account_number='123456789/0123', currency='CZK')
+
+    def _benchmark(self, name, *options):
+        for size in get_sizes():
+            with self.subTest(size=size), NamedTemporaryFile('w', suffix='.xml', delete=False) as statement:
+                self.addCleanup(os.remove, statement.name)
+                write_transproc_xml(statement, '123456789', '0123', size)
+                statement.close()
+
+                self.measure('{}/{}'.format(name, size),
+                             lambda: call_command('import_payments', '--parser', PARSER, statement.name, *options))
+                self.assertEqual(BankPayment.objects.count(), size)
+                # All payments already exist.
+                self.measure('{}_existing/{}'.format(name, size),
+                             lambda: call_command('import_payments', '--parser', PARSER, statement.name, *options))
+                BankPayment.objects.all().delete()
+
+    def test_import_payments(self):
+        self._benchmark('import_payments')
+
+    def test_import_payments_chunked(self):
+        self._benchmark('import_payments_chunked', '--chunk-size', '1000')
+
+
+class BenchmarkDownloadPayments(BenchmarkTestCase):
+    """Benchmark download_payments command with a fake teller downloader."""
+
+    def setUp(self):
+        BankAccount.objects.create(account_number=FakeStatementParser.account_number, currency='CZK')
+
+    def _benchmark(self, name, *options):
+        for size in get_sizes():
+            downloaders = OrderedDict([('fake', {'DOWNLOADER': 'benchmarks.utils.FakeStatementDownloader',
+                                                 'PARSER': 'benchmarks.utils.FakeStatementParser',
+                                                 'DOWNLOADER_PARAMS': {'count': size}})])
+            with self.subTest(size=size), override_settings(PAIN_DOWNLOADERS=downloaders):
+                self.measure('{}/{}'.format(name, size), lambda: call_command('download_payments', *options))
+                self.assertEqual(BankPayment.objects.count(), size)
+                BankPayment.objects.all().delete()
+
+    def test_download_payments(self):
+        self._benchmark('download_payments')
+
+    def test_download_payments_chunked(self):
+        self._benchmark('download_payments_chunked', '--chunk-size', '1000')
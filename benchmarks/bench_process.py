@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks of payments processing."""
+from django.core.management import call_command
+from django.test import override_settings
+
+from benchmarks.utils import BenchmarkTestCase, create_payments, get_sizes
+from django_pain.constants import PaymentState
+from django_pain.models import BankAccount, BankPayment
+
+
+@override_settings(PAIN_PROCESSORS={
+    'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+class BenchmarkProcessPayments(BenchmarkTestCase):
+    """Benchmark process_payments command."""
+
+    def setUp(self):
+        self.account = BankAccount.objects.create(account_number='123456789/0123', currency='CZK')
+
+    def _benchmark(self, name, *options):
+        for size in get_sizes():
+            with self.subTest(size=size):
+                create_payments(self.account, size)
+
+                self.measure('{}/{}'.format(name, size), lambda: call_command('process_payments', *options))
+                self.assertEqual(BankPayment.objects.filter(state=PaymentState.PROCESSED).count(), size)
+                # No payments left to process.
+                self.measure('{}_empty/{}'.format(name, size), lambda: call_command('process_payments', *options))
+                BankPayment.objects.all().delete()
+
+    def test_process_payments(self):
+        self._benchmark('process_payments')
+
+    def test_process_payments_batches(self):
+        self._benchmark('process_payments_batches', '--batch-size', '1000')
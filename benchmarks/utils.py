@@ -0,0 +1,206 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Utilities for benchmarks.
+
+Benchmarks are run by Django test runner, see README for details.
+They are configured by environment variables:
+
+PAIN_BENCHMARK_SIZES
+    Comma separated numbers of payments, default is ``1000``.
+PAIN_BENCHMARK_OUTPUT
+    Path to a JSON file where the results are saved.
+PAIN_BENCHMARK_BASELINE
+    Path to a JSON file with results of a previous run.
+    Benchmark fails if it runs more queries or takes longer than the baseline (with tolerance).
+PAIN_BENCHMARK_TOLERANCE
+    Allowed relative slowdown against the baseline, default is ``0.25``.
+"""
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from io import BytesIO
+from itertools import islice
+from types import SimpleNamespace
+from typing import IO, Any, Callable, Dict, Iterator, List, NamedTuple
+from xml.sax.saxutils import escape
+
+from django.db import connection
+from django.test import TransactionTestCase
+from djmoney.money import Money
+
+from django_pain.models import BankAccount, BankPayment
+
+SEED = 42
+
+Measurement = NamedTuple('Measurement', [('seconds', float), ('queries', int)])
+
+
+def get_sizes() -> List[int]:
+    """Return numbers of payments used by benchmarks."""
+    return [int(size) for size in os.environ.get('PAIN_BENCHMARK_SIZES', '1000').split(',')]
+
+
+def generate_payments(count: int, seed: int = SEED) -> Iterator[Dict[str, Any]]:
+    """Generate attributes of synthetic payments, the same ones for the same seed."""
+    rand = random.Random(seed)
+    first_date = date(2020, 1, 1)
+    for index in range(count):
+        yield {
+            'ident': 'BENCH{:08d}'.format(index),
+            'account_number': str(rand.randrange(10 ** 5, 10 ** 10)),
+            'account_bank_code': rand.choice(('0100', '0300', '0800', '2010', '5500')),
+            'const_symbol': '0558',
+            'var_symbol': str(rand.randrange(10 ** 9)),
+            'spec_symbol': '',
+            'price': str(Decimal(rand.randrange(100, 10 ** 7)) / 100),
+            'memo': 'Payment {} for services & goods'.format(index),
+            'date': (first_date + timedelta(days=rand.randrange(730))).isoformat(),
+            'name': 'Customer <{}>'.format(rand.randrange(10 ** 4)),
+        }
+
+
+def write_transproc_xml(stream: IO[str], account_number: str, bank_code: str, count: int) -> None:
+    """Write transproc XML bank statement with synthetic payments into the stream."""
+    stream.write('<?xml version="1.0" encoding="UTF-8"?>\n<statements><statement>\n')
+    stream.write('<account_number>{}</account_number><account_bank_code>{}</account_bank_code>\n'.format(
+        account_number, bank_code))
+    stream.write('<items>\n')
+    for payment in generate_payments(count):
+        stream.write('<item>')
+        for key, value in payment.items():
+            stream.write('<{0}>{1}</{0}>'.format(key, escape(value)))
+        stream.write('<status>1</status><code>1</code></item>\n')
+    stream.write('</items></statement></statements>\n')
+
+
+def create_payments(account: BankAccount, count: int, batch_size: int = 10000, **kwargs: Any) -> None:
+    """Create synthetic payments in the database."""
+    payments = (BankPayment(identifier=payment['ident'],
+                            account=account,
+                            transaction_date=date.fromisoformat(payment['date']),
+                            counter_account_number='{}/{}'.format(payment['account_number'],
+                                                                  payment['account_bank_code']),
+                            counter_account_name=payment['name'],
+                            amount=Money(payment['price'], account.currency),
+                            description=payment['memo'],
+                            constant_symbol=payment['const_symbol'],
+                            variable_symbol=payment['var_symbol'],
+                            **kwargs)
+                for payment in generate_payments(count))
+    while True:
+        batch = list(islice(payments, batch_size))
+        if not batch:
+            break
+        BankPayment.objects.bulk_create(batch)
+
+
+class FakeBankStatement(SimpleNamespace):
+    """Bank statement with the interface of `teller.statement.BankStatement`."""
+
+    def __iter__(self):
+        return iter(self.payments)
+
+
+class FakeStatementDownloader(object):
+    """Downloader with the interface of teller downloaders, which returns a synthetic statement."""
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def get_statements(self, start_date, end_date) -> List[SimpleNamespace]:
+        """Return single raw statement with the number of payments."""
+        return [SimpleNamespace(name='statement.fake', buffer=BytesIO(str(self.count).encode()), encoding='ascii')]
+
+
+class FakeStatementParser(object):
+    """Parser with the interface of teller parsers, which generates payments of the fake statement."""
+
+    account_number = '1234567890/2010'
+
+    @classmethod
+    def parse_file(cls, source: IO[bytes], encoding=None) -> FakeBankStatement:
+        """Return statement with synthetic payments."""
+        payments = [SimpleNamespace(identifier=payment['ident'],
+                                    counter_account='{}/{}'.format(payment['account_number'],
+                                                                   payment['account_bank_code']),
+                                    name=payment['name'],
+                                    amount=Money(payment['price'], 'CZK'),
+                                    transaction_date=date.fromisoformat(payment['date']),
+                                    description=payment['memo'],
+                                    constant_symbol=payment['const_symbol'],
+                                    variable_symbol=payment['var_symbol'],
+                                    specific_symbol=None)
+                    for payment in generate_payments(int(source.read().decode(encoding)))]
+        return FakeBankStatement(account_number=cls.account_number, payments=payments)
+
+
+class BenchmarkTestCase(TransactionTestCase):
+    """Test case which measures time and number of queries of its benchmarks."""
+
+    def measure(self, name: str, func: Callable[[], Any]) -> Measurement:
+        """Measure the function, report the result and compare it with the baseline."""
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        measurement = Measurement(seconds, queries)
+        key = '{}[{}]'.format(name, connection.vendor)
+        sys.stderr.write('\n{}: {:.3f} s, {} queries '.format(key, seconds, queries))
+        self._save(key, measurement)
+        self._compare(key, measurement)
+        return measurement
+
+    @staticmethod
+    def _save(key: str, measurement: Measurement) -> None:
+        path = os.environ.get('PAIN_BENCHMARK_OUTPUT')
+        if not path:
+            return
+        results = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                results = json.load(handle)
+        results[key] = measurement._asdict()
+        with open(path, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    def _compare(self, key: str, measurement: Measurement) -> None:
+        path = os.environ.get('PAIN_BENCHMARK_BASELINE')
+        if not path:
+            return
+        with open(path) as handle:
+            baseline = json.load(handle).get(key)
+        if baseline is None:
+            return
+        tolerance = float(os.environ.get('PAIN_BENCHMARK_TOLERANCE', '0.25'))
+        self.assertLessEqual(measurement.queries, baseline['queries'],
+                             '{} runs more queries than the baseline.'.format(key))
+        self.assertLessEqual(measurement.seconds, baseline['seconds'] * (1 + tolerance),
+                             '{} is slower than the baseline.'.format(key))
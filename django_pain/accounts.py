@@ -0,0 +1,101 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Process-local registry of bank accounts."""
+import copy
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from django_pain.models import BankAccount
+from django_pain.settings import SETTINGS
+
+
+class BankAccountRegistry(object):
+    """
+    Registry of bank accounts by their account numbers.
+
+    The registry is cleared whenever a bank account is saved or deleted in this process.
+    Changes made by other processes are noticed when the accounts expire after PAIN_BANK_ACCOUNT_CACHE_TIMEOUT seconds.
+    Missing accounts are not remembered, so accounts created elsewhere are found immediately.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Accounts and their expiration times.
+        self._accounts: Dict[str, Tuple[BankAccount, Optional[float]]] = {}
+        # Incremented by every clear, so accounts fetched before the clear are not stored.
+        self._generation = 0
+
+    def get(self, account_number: str) -> BankAccount:
+        """Return the account or raise BankAccount.DoesNotExist."""
+        accounts = self.get_many([account_number])
+        if account_number not in accounts:
+            raise BankAccount.DoesNotExist('Bank account {} does not exist.'.format(account_number))
+        return accounts[account_number]
+
+    def get_many(self, account_numbers: Iterable[str]) -> Dict[str, BankAccount]:
+        """Return existing accounts with the account numbers, missing accounts are fetched by a single query."""
+        now = time.monotonic()
+        accounts = {}  # type: Dict[str, BankAccount]
+        missing = set()
+        with self._lock:
+            generation = self._generation
+            for account_number in account_numbers:
+                account, expiration = self._accounts.get(account_number, (None, None))
+                if account is not None and (expiration is None or expiration > now):
+                    accounts[account_number] = account
+                else:
+                    missing.add(account_number)
+
+        if missing:
+            timeout = SETTINGS.bank_account_cache_timeout
+            expiration = None if timeout is None else now + timeout
+            fetched = list(BankAccount.objects.filter(account_number__in=missing))
+            with self._lock:
+                for account in fetched:
+                    accounts[account.account_number] = account
+                    if self._generation == generation:
+                        self._accounts[account.account_number] = (account, expiration)
+
+        # Callers get their own copies, so they can't change the registered accounts.
+        return {account_number: copy.copy(account) for account_number, account in accounts.items()}
+
+    def clear(self) -> None:
+        """Forget all accounts."""
+        with self._lock:
+            self._accounts.clear()
+            self._generation += 1
+
+
+BANK_ACCOUNTS = BankAccountRegistry()
+
+
+def get_bank_account(account_number: str) -> BankAccount:
+    """Return bank account with the account number or raise BankAccount.DoesNotExist."""
+    return BANK_ACCOUNTS.get(account_number)
+
+
+def get_bank_accounts(account_numbers: Iterable[str]) -> Dict[str, BankAccount]:
+    """Return existing bank accounts with the account numbers."""
+    return BANK_ACCOUNTS.get_many(account_numbers)
+
+
+def clear_bank_accounts(sender, **kwargs) -> None:
+    """Clear the registry of bank accounts, connected to signals of BankAccount changes."""
+    BANK_ACCOUNTS.clear()
@@ -23,7 +23,8 @@ from datetime import date
 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import Count, Prefetch, Q
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils.formats import date_format
@@ -32,12 +33,13 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import get_language, gettext_lazy as _, to_locale
 from moneyed.localization import format_money
 
-from django_pain.constants import PaymentState
+from django_pain.constants import InvoiceType, PaymentState
 from django_pain.models import BankPayment, Invoice
-from django_pain.settings import get_processor_instance
+from django_pain.settings import SETTINGS, get_processor_instance
 
 from .filters import PaymentStateListFilter
 from .forms import BankAccountForm, BankPaymentForm, UserCreationForm
+from .paginators import ApproximateCountChangeList, ApproximateCountPaginator, KeysetChangeList
 
 
 class BankAccountAdmin(admin.ModelAdmin):
@@ -114,7 +116,17 @@ class InvoicesInline(admin.TabularInline):
         return super().get_queryset(request).select_for_update()
 
 
-class BankPaymentAdmin(admin.ModelAdmin):
+class ApproximateCountAdminMixin(object):
+    """Model admin mixin which estimates number of objects in large tables."""
+
+    paginator = ApproximateCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        """Return change list which estimates the total number of objects."""
+        return ApproximateCountChangeList
+
+
+class BankPaymentAdmin(ApproximateCountAdminMixin, admin.ModelAdmin):
     """Model admin for BankPayment."""
 
     form = BankPaymentForm
@@ -159,7 +171,40 @@ class BankPaymentAdmin(admin.ModelAdmin):
         if request.method == 'POST':
             return super().get_queryset(request).select_for_update()
         else:
-            return super().get_queryset(request)
+            # Fetch data displayed in the list at once instead of row by row.
+            advance_invoices = Invoice.objects.filter(invoice_type=InvoiceType.ADVANCE).order_by('pk')
+            return super().get_queryset(request).select_related('account', 'client').annotate(
+                invoices_count=Count('invoices', distinct=True),
+            ).prefetch_related(Prefetch('invoices', queryset=advance_invoices, to_attr='advance_invoices'))
+
+    def get_changelist(self, request, **kwargs):
+        """Return change list which supports keyset pagination."""
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Return payments matching the search term.
+
+        If full-text search is enabled on PostgreSQL, variable symbol must start with the search term,
+        counter account name must contain a word similar to it and description must contain all its words.
+        These lookups are served by indexes created in migrations. Otherwise default search is used.
+        """
+        search_term = search_term.strip()
+        if (not search_term or not SETTINGS.admin_fulltext_search
+                or connections[queryset.db].vendor != 'postgresql'):
+            return super().get_search_results(request, queryset, search_term)
+
+        # Imported here, because it requires psycopg2.
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+
+        # Unlike icontains, trigram_word_similar is served by the trigram index on the counter account name.
+        # The lookup is registered in DjangoPainConfig.ready.
+        queryset = queryset.alias(description_vector=SearchVector('description', config='simple')).filter(
+            Q(variable_symbol__startswith=search_term)
+            | Q(counter_account_name__trigram_word_similar=search_term)
+            | Q(description_vector=SearchQuery(search_term, config='simple'))
+        )
+        return queryset, False
 
     class Media:
         """Media class."""
@@ -276,6 +321,8 @@ class BankPaymentAdmin(admin.ModelAdmin):
 
     def short_transaction_date(self, obj):
         """Short transaction date."""
+        if obj.transaction_date is None:
+            return None
         return date_format(obj.transaction_date, format='SHORT_DATE_FORMAT')
     short_transaction_date.short_description = _('Date')  # type: ignore
 
@@ -286,8 +333,14 @@ class BankPaymentAdmin(admin.ModelAdmin):
         If there are any other invoices, number of remaining (not displayed)
         invoices is displayed as well.
         """
-        advance_invoice = obj.advance_invoice
-        invoices_count = obj.invoices.count()
+        if hasattr(obj, 'advance_invoices'):
+            advance_invoice = obj.advance_invoices[0] if obj.advance_invoices else None
+        else:
+            advance_invoice = obj.advance_invoice
+        if hasattr(obj, 'invoices_count'):
+            invoices_count = obj.invoices_count
+        else:
+            invoices_count = obj.invoices.count()
         if advance_invoice is not None:
             processor = get_processor_instance(obj.processor)
             if hasattr(processor, 'get_invoice_url'):
@@ -329,12 +382,15 @@ class BankPaymentAdmin(admin.ModelAdmin):
         return False
 
 
-class PaymentImportHistoryAdmin(admin.ModelAdmin):
+class PaymentImportHistoryAdmin(ApproximateCountAdminMixin, admin.ModelAdmin):
     """Model admin for PaymenImportHistory."""
 
-    list_display = ('start_datetime', 'origin', 'filenames', 'errors', 'finished', 'success')
-    fields = ('start_datetime', 'origin', 'filenames', 'errors', 'finished', 'success')
-    readonly_fields = ('start_datetime', 'origin', 'filenames', 'errors', 'finished', 'success')
+    list_display = ('start_datetime', 'origin', 'filenames', 'imported', 'skipped', 'errors', 'finished', 'success',
+                    'duration')
+    fields = ('start_datetime', 'origin', 'filenames', 'imported', 'skipped', 'errors', 'finished', 'success',
+              'duration', 'timings')
+    readonly_fields = ('start_datetime', 'origin', 'filenames', 'imported', 'skipped', 'errors', 'finished', 'success',
+                       'duration', 'timings')
 
     ordering = ('-start_datetime',)
     actions = None
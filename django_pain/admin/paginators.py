@@ -0,0 +1,237 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Admin paginators."""
+import json
+from typing import Any, List, Optional, Tuple
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import BooleanField, F, Func, QuerySet, Value
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.functional import cached_property
+
+from django_pain.settings import SETTINGS
+
+# Querysets estimated to be smaller are counted exactly.
+APPROXIMATE_COUNT_THRESHOLD = 100000
+
+# Query string parameters with keyset pagination cursors.
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+
+def _get_estimate(queryset: QuerySet) -> Optional[int]:
+    """Return number of objects in the queryset estimated by PostgreSQL planner or None if not available."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            # Size of the whole table is kept in statistics.
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            estimate = cursor.fetchone()[0]
+        else:
+            # Joins and grouping added to display the objects spoil the estimate, so only the objects are estimated.
+            queryset = queryset.model._base_manager.using(queryset.db).filter(pk__in=queryset.order_by().values('pk'))
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = plan[0]['Plan']['Plan Rows']
+    # Tables which were never analyzed have negative estimate.
+    if estimate < 0:
+        return None
+    return int(estimate)
+
+
+def _compare_rows(model, operator: str, **values: Any) -> Func:
+    """Return condition comparing the row value of the fields with the row value of the given values."""
+    fields = Func(*(F(name) for name in values), function='')
+    params = Func(*(Value(value, output_field=model._meta.get_field(name)) for name, value in values.items()),
+                  function='')
+    return Func(fields, params, template='%(expressions)s', arg_joiner=' {} '.format(operator),
+                output_field=BooleanField())
+
+
+def get_approximate_count(queryset: QuerySet, threshold: int = APPROXIMATE_COUNT_THRESHOLD) -> int:
+    """
+    Return number of objects in the queryset.
+
+    Number of objects in large querysets is estimated by PostgreSQL planner.
+    Small querysets and querysets in other databases are counted exactly.
+    """
+    estimate = _get_estimate(queryset)
+    if estimate is None or estimate < threshold:
+        return queryset.count()
+    return estimate
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator which estimates number of objects in large querysets.
+
+    The last pages may be empty if number of objects is overestimated.
+    """
+
+    @cached_property
+    def count(self):
+        """Return the estimated number of objects."""
+        return get_approximate_count(self.object_list)
+
+
+class ApproximateCountChangeList(ChangeList):
+    """Change list which estimates the total number of objects."""
+
+    root_queryset: QuerySet
+
+    def get_results(self, request):
+        """Get results, estimate the total number of objects instead of counting them."""
+        root_queryset = self.root_queryset
+        # Prevent super from counting all objects.
+        self.root_queryset = root_queryset.none()
+        try:
+            super().get_results(request)
+        finally:
+            self.root_queryset = root_queryset
+
+        if self.show_full_result_count:
+            self.full_result_count = get_approximate_count(root_queryset)
+            self.show_admin_actions = bool(self.full_result_count)
+
+
+class KeysetChangeList(ApproximateCountChangeList):
+    """
+    Change list of bank payments with optional keyset pagination.
+
+    If PAIN_ADMIN_KEYSET_PAGINATION is set and the list is in the default order, pages are selected by
+    the (transaction_date, create_time, id) of the last payment on the previous page instead of offset.
+    Then only links to the previous and next pages are available.
+    """
+
+    # Same as the default ordering of bank payments on PostgreSQL and the keyset index.
+    keyset_ordering = (F('transaction_date').desc(nulls_first=True), F('create_time').desc(), F('pk').desc())
+    reverse_keyset_ordering = (F('transaction_date').asc(nulls_last=True), F('create_time').asc(), F('pk').asc())
+
+    def __init__(self, request, *args, **kwargs):
+        self.keyset_after = request.GET.get(AFTER_VAR)
+        self.keyset_before = request.GET.get(BEFORE_VAR)
+        self.keyset_pagination = False
+        self.previous_page_url: Optional[str] = None
+        self.next_page_url: Optional[str] = None
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        """Return all params except the ignored ones and keyset cursors."""
+        lookup_params = super().get_filters_params(params)
+        for name in (AFTER_VAR, BEFORE_VAR):
+            lookup_params.pop(name, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        """Return query string, cursors are kept only if explicitly set."""
+        new_params = dict(new_params or {})
+        for name in (AFTER_VAR, BEFORE_VAR):
+            new_params.setdefault(name, None)
+        return super().get_query_string(new_params, remove)
+
+    def get_results(self, request):
+        """Get results, use keyset pagination if enabled."""
+        super().get_results(request)
+        self.keyset_pagination = (SETTINGS.admin_keyset_pagination and ORDER_VAR not in self.params
+                                  and self.multi_page and not (self.show_all and self.can_show_all))
+        if self.keyset_pagination:
+            self._get_keyset_results()
+
+    @staticmethod
+    def _encode_cursor(payment) -> str:
+        transaction_date = payment.transaction_date.isoformat() if payment.transaction_date else ''
+        return '{}_{}_{}'.format(transaction_date, payment.create_time.isoformat(), payment.pk)
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[Any, Any, int]:
+        try:
+            transaction_date, create_time, pk = cursor.split('_')
+            values = (parse_date(transaction_date) if transaction_date else None, parse_datetime(create_time), int(pk))
+        except ValueError as error:
+            raise IncorrectLookupParameters(error)
+        if values[1] is None or (transaction_date and values[0] is None):
+            raise IncorrectLookupParameters('Invalid cursor {}.'.format(cursor))
+        return values
+
+    @staticmethod
+    def _following(queryset: QuerySet, cursor: Tuple[Any, Any, int], reverse: bool = False) -> List[QuerySet]:
+        """
+        Return segments of payments following the cursor in the keyset order (or preceding it).
+
+        Payments without transaction date come first in the keyset order, so they form a separate segment.
+        Each segment compares a row value with the cursor, which may be served by the keyset index.
+        """
+        transaction_date, create_time, pk = cursor
+        operator = '>' if reverse else '<'
+        undated = queryset.filter(transaction_date__isnull=True)
+        if transaction_date is None:
+            undated = undated.filter(_compare_rows(queryset.model, operator, create_time=create_time, id=pk))
+            if reverse:
+                return [undated]
+            return [undated, queryset.filter(transaction_date__isnull=False)]
+        dated = queryset.filter(_compare_rows(queryset.model, operator, transaction_date=transaction_date,
+                                              create_time=create_time, id=pk))
+        if reverse:
+            return [dated, undated]
+        return [dated]
+
+    @staticmethod
+    def _fetch(segments: List[QuerySet], ordering: Tuple[Any, ...], limit: int) -> List[Any]:
+        """Return at most limit payments from the segments in the given order."""
+        result_list: List[Any] = []
+        for segment in segments:
+            result_list.extend(segment.order_by(*ordering)[:limit - len(result_list)])
+            if len(result_list) >= limit:
+                break
+        return result_list
+
+    def _get_keyset_results(self) -> None:
+        queryset = self.queryset
+        has_previous = has_next = False
+        if self.keyset_before:
+            segments = self._following(queryset, self._decode_cursor(self.keyset_before), reverse=True)
+            result_list = self._fetch(segments, self.reverse_keyset_ordering, self.list_per_page + 1)
+            has_previous = len(result_list) > self.list_per_page
+            result_list = result_list[:self.list_per_page][::-1]
+            has_next = True
+        else:
+            if self.keyset_after:
+                segments = self._following(queryset, self._decode_cursor(self.keyset_after))
+                has_previous = True
+            else:
+                segments = [queryset]
+            result_list = self._fetch(segments, self.keyset_ordering, self.list_per_page + 1)
+            has_next = len(result_list) > self.list_per_page
+            result_list = result_list[:self.list_per_page]
+
+        if has_previous and result_list:
+            self.previous_page_url = self.get_query_string({BEFORE_VAR: self._encode_cursor(result_list[0])})
+        if has_next and result_list:
+            self.next_page_url = self.get_query_string({AFTER_VAR: self._encode_cursor(result_list[-1])})
+        self.result_list = result_list
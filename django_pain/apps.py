@@ -19,7 +19,8 @@
 """Django app configuration."""
 from django.apps import AppConfig, apps
 from django.contrib.admin.apps import AdminConfig
-from django.db.models.signals import post_migrate
+from django.db.models import TextField
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.utils.translation import gettext_lazy as _
 
 from django_pain.settings import SETTINGS, PainSettings, get_processor_instance
@@ -50,6 +51,20 @@ def create_permissions(app_config, **kwargs):
         )
 
 
+def register_trigram_lookup():
+    """
+    Register trigram_word_similar lookup on text fields used by the admin full-text search.
+
+    The lookup is otherwise registered only if django.contrib.postgres is installed.
+    It requires psycopg2, so it is not registered if psycopg2 is not available.
+    """
+    try:
+        from django.contrib.postgres.lookups import TrigramWordSimilar
+    except ImportError:
+        return
+    TextField.register_lookup(TrigramWordSimilar)
+
+
 class DjangoPainConfig(AppConfig):
     """Configuration of django_pain app."""
 
@@ -57,10 +72,17 @@ class DjangoPainConfig(AppConfig):
     verbose_name = _('Payments and Invoices')
 
     def ready(self):
-        """Check whether configuration is OK."""
+        """Check whether configuration is OK, connect signal receivers and register lookups."""
         PainSettings.check()
         post_migrate.connect(create_permissions, sender=self)
 
+        from django_pain.accounts import clear_bank_accounts
+        BankAccount = self.get_model('BankAccount')
+        post_save.connect(clear_bank_accounts, sender=BankAccount)
+        post_delete.connect(clear_bank_accounts, sender=BankAccount)
+
+        register_trigram_lookup()
+
 
 class DjangoPainAdminConfig(AdminConfig):
     """Override default django-admin site."""
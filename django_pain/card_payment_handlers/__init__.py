@@ -17,11 +17,13 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """CardPaymentHandler module."""
-from .common import AbstractCardPaymentHandler, CartItem, PaymentHandlerConnectionError, PaymentHandlerError
+from .common import (AbstractCardPaymentHandler, CardPaymentState, CartItem, PaymentHandlerConnectionError,
+                     PaymentHandlerError)
 from .csob import CSOBCardPaymentHandler
 
 __all__ = [
     'AbstractCardPaymentHandler',
+    'CardPaymentState',
     'CartItem',
     'CSOBCardPaymentHandler',
     'PaymentHandlerError',
@@ -18,10 +18,11 @@
 
 """Base payment processor module."""
 from abc import ABC, abstractmethod
-from typing import List, NamedTuple, Tuple
+from typing import Any, List, Mapping, NamedTuple, Tuple
 
 from djmoney.money import Money
 
+from django_pain.constants import PaymentState
 from django_pain.models import BankPayment
 
 CartItem = NamedTuple('CartItem', [
@@ -31,6 +32,11 @@ CartItem = NamedTuple('CartItem', [
     ('description', str),
 ])
 
+CardPaymentState = NamedTuple('CardPaymentState', [
+    ('card_payment_state', str),
+    ('state', PaymentState),
+])
+
 
 class PaymentHandlerError(Exception):
     """Generic payment handler error."""
@@ -47,6 +53,11 @@ class PaymentHandlerConnectionError(PaymentHandlerError):
 class AbstractCardPaymentHandler(ABC):
     """Card payment handler."""
 
+    # Whether the handler implements `get_payment_state`.
+    supports_payment_state = False
+    # Whether the handler implements `verify_notification`.
+    supports_notifications = False
+
     def __init__(self, name):
         self.name = name
 
@@ -74,3 +85,29 @@ class AbstractCardPaymentHandler(ABC):
     @abstractmethod
     def update_payments_state(self, payment: BankPayment) -> None:
         """Update state of the payment form Card Gateway and if newly paid, process the payment."""
+
+    def get_payment_state(self, payment: BankPayment) -> CardPaymentState:
+        """
+        Get state of the payment from Card Gateway without changing the payment.
+
+        It may be called concurrently from several threads and it must not access the database.
+        Handlers which implement it have to set `supports_payment_state`,
+        payments of other handlers are updated by `update_payments_state`.
+
+        Returns card payment state and the corresponding payment state.
+        """
+        raise NotImplementedError
+
+    def verify_notification(self, data: Mapping[str, Any]) -> Tuple[str, CardPaymentState]:
+        """
+        Verify notification about the payment sent by Card Gateway.
+
+        Args:
+            data: Parameters of the notification.
+
+        Returns identifier of the payment and its card payment state and the corresponding payment state.
+        Raises PaymentHandlerError if the notification is not valid.
+        Handlers which implement it have to set `supports_notifications`,
+        other handlers do not accept notifications.
+        """
+        raise NotImplementedError
@@ -18,17 +18,28 @@
 
 """Card handler for CSOB Gateway."""
 import logging
-from typing import List, Tuple
+import threading
+import uuid
+from functools import partial
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 import requests
 from django.utils import timezone
 from djmoney.money import Money
 from pycsob import conf as CSOB
 from pycsob.client import CsobClient
+from pycsob.utils import CsobVerifyError
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
-from django_pain.card_payment_handlers.common import (AbstractCardPaymentHandler, CartItem,
+from django_pain.accounts import get_bank_account
+from django_pain.card_payment_handlers.common import (AbstractCardPaymentHandler, CardPaymentState, CartItem,
                                                       PaymentHandlerConnectionError, PaymentHandlerError)
 from django_pain.constants import PaymentState, PaymentType
+from django_pain.metrics import CARD_GATEWAY_REQUEST_DURATION
 from django_pain.models import BankAccount, BankPayment
 from django_pain.settings import SETTINGS
 
@@ -49,25 +60,131 @@ CSOB_GATEWAY_TO_PAYMENT_STATE_MAPPING = {
 }
 
 
+class _CountingConnectionMixin(object):
+    """Connection which counts its connects."""
+
+    def __init__(self, *args, connect_counter: Callable[[], None], **kwargs):
+        self._connect_counter = connect_counter
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        """Count the connect and connect."""
+        self._connect_counter()
+        super().connect()  # type: ignore
+
+
+class _CountingHTTPConnection(_CountingConnectionMixin, HTTPConnection):
+    """HTTP connection which counts its connects."""
+
+
+class _CountingHTTPSConnection(_CountingConnectionMixin, HTTPSConnection):
+    """HTTPS connection which counts its connects."""
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool whose connections count their connects."""
+
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool whose connections count their connects."""
+
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class CSOBHTTPAdapter(HTTPAdapter):
+    """HTTP adapter with default timeout which keeps statistics of connection reuse."""
+
+    def __init__(self, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'connections': 0}
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create pool manager with connections which count their connects."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': partial(_CountingHTTPConnectionPool, connect_counter=self._count_connection),  # type: ignore
+            'https': partial(_CountingHTTPSConnectionPool, connect_counter=self._count_connection),  # type: ignore
+        }
+
+    def _count_connection(self) -> None:
+        with self._stats_lock:
+            self._stats['connections'] += 1
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        """Send the request with the default timeout unless other timeout is set."""
+        if timeout is None:
+            timeout = self.timeout
+        with self._stats_lock:
+            self._stats['requests'] += 1
+        return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+
+    def get_connection_stats(self) -> Dict[str, int]:
+        """Return number of sent requests and number of connections opened for them."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+
 class CSOBCardPaymentHandler(AbstractCardPaymentHandler):
     """CSOB Gateway card payment processor."""
 
+    supports_payment_state = True
+    supports_notifications = True
+
     def __init__(self, name):
         super().__init__(name)
         self._client = None
+        self._adapter: Optional[CSOBHTTPAdapter] = None
 
     @property
     def client(self):
         """Get CSOB Gateway Client."""
         if self._client is None:
-            self._client = CsobClient(
+            client = CsobClient(
                 SETTINGS.csob_card['merchant_id'],
                 SETTINGS.csob_card['api_url'],
                 str(SETTINGS.csob_card['merchant_private_key']),
                 str(SETTINGS.csob_card['api_public_key'])
             )
+            self._adapter = self._get_adapter()
+            # CsobClient doesn't allow to configure its session, so its private attribute is used.
+            # It is present in pycsob 1.0, the version is pinned in install requirements.
+            session = client._client
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            # Session headers are shared with pycsob module, make them private to the session.
+            session.headers = CaseInsensitiveDict(session.headers)
+            if not SETTINGS.csob_card['keep_alive']:
+                session.headers.update({'Connection': 'close'})
+            self._client = client
         return self._client
 
+    @staticmethod
+    def _get_adapter() -> CSOBHTTPAdapter:
+        """Return HTTP adapter configured by settings."""
+        retries = SETTINGS.csob_card['retries']
+        # Only status requests are retried after server errors, other requests change the payments.
+        max_retries = Retry(total=retries, backoff_factor=SETTINGS.csob_card['retry_backoff'],
+                            status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+                            raise_on_status=False)
+        pool_size = SETTINGS.csob_card['pool_size']
+        return CSOBHTTPAdapter(timeout=(SETTINGS.csob_card['connect_timeout'], SETTINGS.csob_card['read_timeout']),
+                               pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+
+    def get_connection_stats(self) -> Dict[str, int]:
+        """
+        Return statistics of connections to the gateway.
+
+        Returns number of requests sent to the gateway (retries are not counted)
+        and number of connections opened for them. Other requests reused open connections.
+        """
+        if self._adapter is None:
+            return {'requests': 0, 'connections': 0}
+        return self._adapter.get_connection_stats()
+
     def init_payment(self, amount: Money, variable_symbol: str, processor: str, return_url: str,
                      return_method: str, cart: List[CartItem], language: str) -> Tuple[BankPayment, str]:
         """Initialize card payment on the CSOB gateway, see parent class for detailed description."""
@@ -78,64 +195,109 @@ class CSOBCardPaymentHandler(AbstractCardPaymentHandler):
             dict_item['amount'] = int(dict_item['amount'] * 100)
             dict_cart.append(dict_item)
 
-        # Init payment on CSOB Gateway
-        try:
-            response = self.client.payment_init(
-                order_no=variable_symbol,
-                total_amount=int(amount.amount * 100),
-                currency=str(amount.currency),
-                return_url=return_url,
-                description='Dummy value',
-                cart=dict_cart,
-                return_method=return_method,
-                language=language,
-                # logo_version=PAYMENTS_SETTINGS.PAYMENTS_CSOB_LOGO_VERSION,
-                # color_scheme_version=PAYMENTS_SETTINGS.PAYMENTS_CSOB_COLOR_SCHEME_VERSION,
-                # merchant_data=merchant_data
-            )
-        except requests.ConnectionError:
-            raise PaymentHandlerConnectionError('Gateway connection error')
-
-        data = self.client.gateway_return(response.json())
-        if data['resultCode'] != CSOB.RETURN_CODE_OK:
-            raise PaymentHandlerError('init resultCode != OK', data)
-        if data['paymentStatus'] != CSOB.PAYMENT_STATUS_INIT:
-            raise PaymentHandlerError('Init paymentStatus != PAYMENT_STATUS_INIT', data)
-
-        redirect_url = self.client.get_payment_process_url(data['payId'])
-
+        # The payment is reserved before the gateway is called, so no database transaction stays open
+        # during the request. Reservations orphaned by failures are removed by clean_card_payment_reservations.
         account = self._get_account(amount)
+        # Payment ID is not known until the payment is initialized, reservations are identified by their UUID.
+        payment_uuid = uuid.uuid4()
         payment = BankPayment.objects.create(
-            identifier=data['payId'],
+            identifier=str(payment_uuid),
+            uuid=payment_uuid,
             payment_type=PaymentType.CARD_PAYMENT,
             account=account,
             transaction_date=timezone.now(),
             amount=amount,
             description=cart[0].name,
-            state=PaymentState.INITIALIZED,
-            card_payment_state=CSOB.PAYMENT_STATUSES[data['paymentStatus']],
+            state=PaymentState.RESERVED,
             variable_symbol=variable_symbol,
             processor=processor,
             card_handler=self.name
         )
+        try:
+            data = self._init_gateway_payment(amount, variable_symbol, return_url, return_method, dict_cart, language)
+        except Exception:
+            payment.delete()
+            raise
+
+        payment.identifier = data['payId']
+        payment.state = PaymentState.INITIALIZED
+        payment.card_payment_state = CSOB.PAYMENT_STATUSES[data['paymentStatus']]
+        payment.save(update_fields=['identifier', 'state', 'card_payment_state'])
+
+        redirect_url = self.client.get_payment_process_url(data['payId'])
         return payment, redirect_url
 
-    def update_payments_state(self, payment: BankPayment) -> None:
-        """Update status of the payment form CSOB Gateway and if newly paid, process the payment."""
+    def _call_gateway(self, operation: str, **kwargs: Any) -> Any:
+        """
+        Send request to CSOB Gateway by the client method of the same name and return its result.
+
+        All requests to the gateway are sent by this method, so their durations are measured.
+        Other methods of the client, e.g. `gateway_return`, only sign or verify data locally.
+        """
         try:
-            gateway_result = self.client.payment_status(payment.identifier).payload
-        except requests.ConnectionError:
+            with CARD_GATEWAY_REQUEST_DURATION.time(handler=self.name, operation=operation):
+                return getattr(self.client, operation)(**kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            # Read timeouts are not connection errors in requests, but the gateway is unavailable all the same.
             raise PaymentHandlerConnectionError('Gateway connection error')
-        if gateway_result['resultCode'] == CSOB.RETURN_CODE_OK:
-            payment.card_payment_state = CSOB.PAYMENT_STATUSES[gateway_result['paymentStatus']]
-            # `state` attribute must not be updated unless it's INITIALIZED, as we would easily go from
-            # PROCESSED to READY_TO_PROCESS again.
-            if payment.state == PaymentState.INITIALIZED:
-                payment.state = CSOB_GATEWAY_TO_PAYMENT_STATE_MAPPING[gateway_result['paymentStatus']]
-            payment.save()
-        else:
+
+    def _init_gateway_payment(self, amount: Money, variable_symbol: str, return_url: str, return_method: str,
+                              cart: List[dict], language: str) -> Dict[str, Any]:
+        """Init payment on CSOB Gateway and return verified response data."""
+        response = self._call_gateway(
+            'payment_init',
+            order_no=variable_symbol,
+            total_amount=int(amount.amount * 100),
+            currency=str(amount.currency),
+            return_url=return_url,
+            description='Dummy value',
+            cart=cart,
+            return_method=return_method,
+            language=language,
+            # logo_version=PAYMENTS_SETTINGS.PAYMENTS_CSOB_LOGO_VERSION,
+            # color_scheme_version=PAYMENTS_SETTINGS.PAYMENTS_CSOB_COLOR_SCHEME_VERSION,
+            # merchant_data=merchant_data
+        )
+
+        data = self.client.gateway_return(response.json())
+        if data['resultCode'] != CSOB.RETURN_CODE_OK:
+            raise PaymentHandlerError('init resultCode != OK', data)
+        if data['paymentStatus'] != CSOB.PAYMENT_STATUS_INIT:
+            raise PaymentHandlerError('Init paymentStatus != PAYMENT_STATUS_INIT', data)
+        return data
+
+    def get_payment_state(self, payment: BankPayment) -> CardPaymentState:
+        """Get status of the payment from CSOB Gateway."""
+        gateway_result = self._call_gateway('payment_status', pay_id=payment.identifier).payload
+        if gateway_result['resultCode'] != CSOB.RETURN_CODE_OK:
             LOGGER.error('payment_status resultCode != OK: %s', gateway_result)
             raise PaymentHandlerError('payment_status resultCode != OK', gateway_result)
+        return CardPaymentState(CSOB.PAYMENT_STATUSES[gateway_result['paymentStatus']],
+                                CSOB_GATEWAY_TO_PAYMENT_STATE_MAPPING[gateway_result['paymentStatus']])
+
+    def verify_notification(self, data: Mapping[str, Any]) -> Tuple[str, CardPaymentState]:
+        """Verify signature of the return from CSOB Gateway, see parent class for detailed description."""
+        try:
+            gateway_result = self.client.gateway_return(data)
+        except (KeyError, ValueError, CsobVerifyError) as error:
+            raise PaymentHandlerError('Unverified gateway return data') from error
+        if gateway_result.get('resultCode') != CSOB.RETURN_CODE_OK:
+            raise PaymentHandlerError('gateway return resultCode != OK', gateway_result)
+        if 'payId' not in gateway_result or gateway_result.get('paymentStatus') not in CSOB.PAYMENT_STATUSES:
+            raise PaymentHandlerError('Invalid gateway return data', gateway_result)
+        return gateway_result['payId'], CardPaymentState(
+            CSOB.PAYMENT_STATUSES[gateway_result['paymentStatus']],
+            CSOB_GATEWAY_TO_PAYMENT_STATE_MAPPING[gateway_result['paymentStatus']])
+
+    def update_payments_state(self, payment: BankPayment) -> None:
+        """Update status of the payment form CSOB Gateway and if newly paid, process the payment."""
+        card_payment_state, state = self.get_payment_state(payment)
+        payment.card_payment_state = card_payment_state
+        # `state` attribute must not be updated unless it's INITIALIZED, as we would easily go from
+        # PROCESSED to READY_TO_PROCESS again.
+        if payment.state == PaymentState.INITIALIZED:
+            payment.state = state
+        payment.save()
 
     def _get_account(self, amount: Money) -> BankAccount:
         csob_accounts = SETTINGS.csob_card['account_numbers']
@@ -145,7 +307,7 @@ class CSOBCardPaymentHandler(AbstractCardPaymentHandler):
             raise ValueError('No account for currency {}.'.format(amount.currency)) from error
 
         try:
-            account = BankAccount.objects.get(account_number=account_number)
+            account = get_bank_account(account_number)
         except BankAccount.DoesNotExist as error:
             message = 'CSOBCardPaymentHandler configured with non-existing account "{}".'.format(account_number)
             raise ValueError(message) from error
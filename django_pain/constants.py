@@ -38,6 +38,7 @@ class PaymentType(StrEnum):
 class PaymentState(StrEnum):
     """Payment states constants."""
 
+    RESERVED = 'reserved'
     INITIALIZED = 'initialized'
     READY_TO_PROCESS = 'ready_to_process'
     PROCESSED = 'processed'
@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Locks preventing concurrent runs of commands."""
+import fcntl
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from typing import IO, Optional, Tuple
+from zlib import crc32
+
+from django.db import DatabaseError, connection
+
+from django_pain.settings import SETTINGS
+
+
+class LockError(Exception):
+    """Lock could not be acquired due to an error."""
+
+
+class AbstractLock(ABC):
+    """
+    Lock preventing concurrent runs of a command.
+
+    Lock is identified by a name of the command and optionally by a key, e.g. an account number.
+    Shared lock may be held by several runs at once, exclusive lock excludes any other holder.
+    Locks using files may be placed in the given path instead of the default one.
+    """
+
+    def __init__(self, name: str, key: Optional[str] = None, path: Optional[str] = None) -> None:
+        self.name = name
+        self.key = key
+        self.lock_path = path
+
+    def __str__(self) -> str:
+        """Return string representation of the lock."""
+        if self.key is None:
+            return self.name
+        return '{}:{}'.format(self.name, self.key)
+
+    @abstractmethod
+    def acquire(self, shared: bool = False) -> bool:
+        """
+        Acquire the lock without blocking.
+
+        Returns:
+            True if the lock was acquired, False if it is held by someone else.
+
+        Raises:
+            LockError if the lock could not be acquired due to an error.
+        """
+
+    @abstractmethod
+    def release(self) -> None:
+        """
+        Release the acquired lock.
+
+        Raises:
+            LockError if the lock could not be released due to an error.
+        """
+
+
+class FileLock(AbstractLock):
+    """
+    Lock using flock on a local file.
+
+    It prevents concurrent runs on a single host only.
+    """
+
+    def __init__(self, name: str, key: Optional[str] = None, path: Optional[str] = None) -> None:
+        super().__init__(name, key, path)
+        self._file: Optional[IO] = None
+
+    @property
+    def path(self) -> str:
+        """Return path to the lock file."""
+        path = self.lock_path or os.path.join(tempfile.gettempdir(), 'pain_{}.lock'.format(self.name))
+        if self.key is not None:
+            path = '{}.{}'.format(path, re.sub(r'[^\w-]', '_', self.key))
+        return path
+
+    def acquire(self, shared: bool = False) -> bool:
+        """Acquire the lock without blocking."""
+        try:
+            lock_file = open(self.path, 'a')
+        except OSError as error:
+            raise LockError('Error occured while opening lockfile {}: {}'.format(self.path, error)) from error
+        try:
+            fcntl.flock(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self) -> None:
+        """Release the acquired lock."""
+        if self._file is not None:
+            lock_file, self._file = self._file, None
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except OSError as error:
+                raise LockError('Error occured while unlocking lockfile {}: {}'.format(self.path, error)) from error
+            finally:
+                lock_file.close()
+
+
+class PostgresAdvisoryLock(AbstractLock):
+    """
+    Lock using session level advisory lock of PostgreSQL.
+
+    It prevents concurrent runs on all hosts sharing the database.
+    """
+
+    def __init__(self, name: str, key: Optional[str] = None, path: Optional[str] = None) -> None:
+        super().__init__(name, key, path)
+        self._shared: Optional[bool] = None
+
+    @property
+    def lock_id(self) -> Tuple[int, int]:
+        """Return pair of 32-bit integers identifying the advisory lock."""
+        # Checksums are shifted to the range of signed integers used by PostgreSQL.
+        return (crc32(self.name.encode()) - 2 ** 31, crc32((self.key or '').encode()) - 2 ** 31)
+
+    def _execute(self, function: str) -> bool:
+        if connection.vendor != 'postgresql':
+            raise LockError('Advisory lock {} requires PostgreSQL database.'.format(self))
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT {}(%s, %s)'.format(function), self.lock_id)
+                return cursor.fetchone()[0]
+        except DatabaseError as error:
+            raise LockError('Error occured while using advisory lock {}: {}'.format(self, error)) from error
+
+    def acquire(self, shared: bool = False) -> bool:
+        """Acquire the lock without blocking."""
+        acquired = self._execute('pg_try_advisory_lock_shared' if shared else 'pg_try_advisory_lock')
+        if acquired:
+            self._shared = shared
+        return acquired
+
+    def release(self) -> None:
+        """Release the acquired lock."""
+        if self._shared is not None:
+            self._execute('pg_advisory_unlock_shared' if self._shared else 'pg_advisory_unlock')
+            self._shared = None
+
+
+def get_lock(name: str, key: Optional[str] = None, path: Optional[str] = None) -> AbstractLock:
+    """Return lock of the configured lock backend."""
+    return SETTINGS.lock_backend(name, key, path)
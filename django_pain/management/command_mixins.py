@@ -19,75 +19,197 @@
 """Module with mixins used in commands."""
 import logging
 from abc import ABC
-from collections import namedtuple
-from typing import Iterable
+from collections import defaultdict, namedtuple
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.db.utils import IntegrityError
+from django.utils import timezone
 
-from django_pain.models import BankPayment
+from django_pain.metrics import CommandMetrics
+from django_pain.models import BankPayment, PaymentImportHistory
 from django_pain.settings import SETTINGS
 
 LOGGER = logging.getLogger(__name__)
 
+# Maximal number of identifiers in a single query for existing payments.
+EXISTING_PAYMENTS_CHUNK_SIZE = 500
+
 Result = namedtuple('Result', ('saved', 'skipped', 'errors'))
 
+# Outcome of an attempt to save a single payment - the payment, whether it was saved and an error if any occured.
+SaveOutcome = Tuple[BankPayment, bool, Optional[Exception]]
+
 
 class SavePaymentsMixin(ABC):
     """Mixin to give ability to save BankPayments."""
 
-    def save_payments(self: BaseCommand, payments: Iterable[BankPayment]) -> Result:
-        """Save payments and related objects to database."""
+    # Metrics of the command run.
+    metrics: CommandMetrics
+
+    def _save_import_history(self, import_history: PaymentImportHistory, timings: Dict[str, float]) -> None:
+        """Save the import history with its duration and timings of stages since the given copy of timings."""
+        import_history.duration = timezone.now() - import_history.start_datetime
+        import_history.timings = self.metrics.get_timings_since(timings)
+        import_history.save()
+
+    def save_payments(self: BaseCommand, payments: Iterable[BankPayment], chunk_size: Optional[int] = None) -> Result:
+        """
+        Save payments and related objects to database.
+
+        If chunk_size is set, payments are saved in chunks of that size.
+        Existing payments are looked up by a single query per chunk and new payments are inserted in bulk.
+        """
+        if chunk_size:
+            outcomes = self._save_in_chunks(payments, chunk_size)
+        else:
+            outcomes = self._save_one_by_one(payments)
+
         saved = 0
         skipped = 0
         errors = 0
-        for payment in payments:
-            try:
-                payment_saved = self._save_if_not_exists(payment)
-            except (ValidationError, IntegrityError) as error:
+        for payment, payment_saved, error in outcomes:
+            if error is not None:
                 errors += 1
                 self._process_error(payment, error)
+            elif payment_saved:
+                saved += 1
+                if self.options['verbosity'] >= 2:
+                    self.stdout.write(self.style.SUCCESS(
+                        'Payment ID {} has been imported.'.format(payment.identifier)))
             else:
-                if payment_saved:
-                    saved += 1
-                    if self.options['verbosity'] >= 2:
-                        self.stdout.write(self.style.SUCCESS(
-                            'Payment ID {} has been imported.'.format(payment.identifier)))
-                else:
-                    skipped += 1
-                    if self.options['verbosity'] >= 2:
-                        self.stdout.write(self.style.SUCCESS(
-                            'Payment ID {} was skipped.'.format(payment.identifier)))
+                skipped += 1
+                if self.options['verbosity'] >= 2:
+                    self.stdout.write(self.style.SUCCESS(
+                        'Payment ID {} was skipped.'.format(payment.identifier)))
+        self.metrics.count('save', saved)
         if skipped:
             LOGGER.info('Skipped %d payments.', skipped)
         if errors:
             LOGGER.info('%d payments not saved due to errors.', errors)
         return Result(saved, skipped, errors)
 
-    def _save_if_not_exists(self: BaseCommand, payment: BankPayment) -> bool:
-        """Return True if payment was saved."""
-        with transaction.atomic():
-            if self._payment_exists(payment):
-                LOGGER.info('Payment ID %s already exists - skipping.', payment)
-                return False
+    def _save_one_by_one(self: BaseCommand, payments: Iterable[BankPayment]) -> Iterator[SaveOutcome]:
+        payments = list(payments)
+        with self.metrics.stage('deduplicate'):
+            existing = self._get_existing_payments(payments)
+        for payment in payments:
+            try:
+                payment_saved = self._save_if_not_exists(payment, existing)
+            except (ValidationError, IntegrityError) as error:
+                yield payment, False, error
             else:
-                payment.full_clean()
-                for callback in SETTINGS.import_callbacks:
-                    # Store payment id in case it is turned to None by the callback.
-                    payment_id = payment.identifier
-                    payment = callback(payment)
-                    if payment is None:
-                        LOGGER.info('Payment ID %s skipped by callback %s', payment_id, callback.__name__)
-                        return False
-                payment.save()
-                return True
+                yield payment, payment_saved, None
+
+    def _save_if_not_exists(self: BaseCommand, payment: BankPayment, existing: Set[Tuple[int, str]]) -> bool:
+        """
+        Return True if payment was saved.
+
+        Existing contains account ids and identifiers of payments already in database, saved payment is added to it.
+        """
+        key = (payment.account.pk, payment.identifier)
+        if key in existing:
+            LOGGER.info('Payment ID %s already exists - skipping.', payment)
+            return False
+        with self.metrics.stage('save'), transaction.atomic():
+            # Uniqueness is checked against the prefetched payments and account is enforced by the database.
+            with self.metrics.stage('validate'):
+                payment.full_clean(exclude=['account'], validate_unique=False)
+            with self.metrics.stage('callbacks'):
+                processed_payment = self._run_import_callbacks(payment)
+            if processed_payment is None:
+                return False
+            processed_payment.save()
+        existing.add(key)
+        return True
 
     @staticmethod
-    def _payment_exists(payment: BankPayment) -> bool:
-        query = BankPayment.objects.filter(account=payment.account, identifier=payment.identifier)
-        return query.exists()
+    def _run_import_callbacks(payment: BankPayment) -> Optional[BankPayment]:
+        """Pass payment through import callbacks, return None if any of them skipped the payment."""
+        for callback in SETTINGS.import_callbacks:
+            # Store payment id in case it is turned to None by the callback.
+            payment_id = payment.identifier
+            payment = callback(payment)
+            if payment is None:
+                LOGGER.info('Payment ID %s skipped by callback %s', payment_id, callback.__name__)
+                return None
+        return payment
+
+    def _save_in_chunks(self: BaseCommand, payments: Iterable[BankPayment], chunk_size: int) -> Iterator[SaveOutcome]:
+        iterator = iter(payments)
+        chunk = list(islice(iterator, chunk_size))
+        while chunk:
+            yield from self._save_chunk(chunk)
+            chunk = list(islice(iterator, chunk_size))
+
+    def _save_chunk(self: BaseCommand, chunk: List[BankPayment]) -> Iterator[SaveOutcome]:
+        """Save chunk of payments using bulk insert."""
+        with self.metrics.stage('deduplicate'):
+            existing = self._get_existing_payments(chunk)
+        # Pairs of original payments and payments returned by import callbacks.
+        prepared = []  # type: List[Tuple[BankPayment, BankPayment]]
+        for payment in chunk:
+            key = (payment.account.pk, payment.identifier)
+            if key in existing:
+                LOGGER.info('Payment ID %s already exists - skipping.', payment)
+                yield payment, False, None
+                continue
+            try:
+                # Uniqueness is checked against the prefetched payments and account is enforced by the database.
+                with self.metrics.stage('validate'):
+                    payment.full_clean(exclude=['account'], validate_unique=False)
+                with self.metrics.stage('callbacks'):
+                    processed_payment = self._run_import_callbacks(payment)
+            except ValidationError as error:
+                yield payment, False, error
+                continue
+            if processed_payment is None:
+                yield payment, False, None
+                continue
+            existing.add(key)
+            prepared.append((payment, processed_payment))
+
+        try:
+            with self.metrics.stage('save'), transaction.atomic():
+                BankPayment.objects.bulk_create(processed for _, processed in prepared)
+        except IntegrityError:
+            # Retry payment by payment, so only the offending payments are reported as errors.
+            LOGGER.debug('Bulk insert of %d payments failed, saving them one by one.', len(prepared))
+            for payment, processed_payment in prepared:
+                try:
+                    with self.metrics.stage('save'), transaction.atomic():
+                        processed_payment.save(force_insert=True)
+                except IntegrityError as error:
+                    yield payment, False, error
+                else:
+                    yield payment, True, None
+        else:
+            for payment, _ in prepared:
+                yield payment, True, None
+
+    @staticmethod
+    def _get_existing_payments(payments: List[BankPayment]) -> Set[Tuple[int, str]]:
+        """
+        Return account ids and identifiers of those payments which already exist in database.
+
+        Payments are looked up by a query per account, identifiers are split into chunks if there are too many of them.
+        """
+        identifiers = defaultdict(set)  # type: Dict[int, Set[str]]
+        for payment in payments:
+            identifiers[payment.account.pk].add(payment.identifier)
+
+        existing = set()  # type: Set[Tuple[int, str]]
+        for account_id, account_identifiers in identifiers.items():
+            iterator = iter(sorted(account_identifiers))
+            chunk = list(islice(iterator, EXISTING_PAYMENTS_CHUNK_SIZE))
+            while chunk:
+                query = BankPayment.objects.filter(account=account_id, identifier__in=chunk)
+                existing.update(query.values_list('account_id', 'identifier'))
+                chunk = list(islice(iterator, EXISTING_PAYMENTS_CHUNK_SIZE))
+        return existing
 
     def _process_error(self: BaseCommand, payment, error):
         message = 'Payment ID %s has not been saved due to the following errors:'
@@ -0,0 +1,55 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command for removing orphaned reservations of card payments."""
+import logging
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, no_translations
+from django.utils import timezone
+
+from django_pain.constants import PaymentState
+from django_pain.models import BankPayment
+from django_pain.utils import parse_positive_int
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Remove orphaned reservations of card payments."""
+
+    help = 'Remove reservations of card payments which were never initialized by their card handler.'
+
+    def add_arguments(self, parser):
+        """Command takes optional age of removed reservations."""
+        parser.add_argument('--older-than', type=parse_positive_int, default=3600,
+                            help='Minimal age of removed reservations in seconds, default: 3600')
+
+    @no_translations
+    def handle(self, *args, **options):
+        """
+        Run the command.
+
+        Card payments are reserved before they are initialized on card gateways.
+        Reservations are left behind if the card handler failed to initialize or to remove them.
+        """
+        LOGGER.info('Command clean_card_payment_reservations started.')
+        create_time = timezone.now() - timedelta(seconds=options['older_than'])
+        deleted, _ = BankPayment.objects.filter(state=PaymentState.RESERVED, create_time__lt=create_time).delete()
+        LOGGER.info('Removed %s card payment reservation(s).', deleted)
+        LOGGER.info('Command clean_card_payment_reservations finished.')
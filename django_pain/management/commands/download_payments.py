@@ -19,18 +19,21 @@
 """Command for downloading payments from bank."""
 import logging
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 from warnings import warn
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError, no_translations
 from django.utils import timezone
 
+from django_pain.accounts import get_bank_account
 from django_pain.management.command_mixins import SavePaymentsMixin
+from django_pain.metrics import CommandMetrics
 from django_pain.models import BankAccount, BankPayment, PaymentImportHistory
 from django_pain.settings import SETTINGS
-from django_pain.utils import parse_datetime_safe
+from django_pain.utils import cancel_on_error, parse_datetime_safe, parse_positive_int
 
 try:
     from teller.downloaders import RawStatement
@@ -50,6 +53,10 @@ class Command(BaseCommand, SavePaymentsMixin):
     help = 'Download payments from the banks.'
     default_interval = 7
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = CommandMetrics('download_payments')
+
     def add_arguments(self, parser):
         """Command takes two argument - end date and interval in days."""
         parser.add_argument('-e', '--end', type=parse_datetime_safe, required=False,
@@ -59,6 +66,10 @@ class Command(BaseCommand, SavePaymentsMixin):
         parser.add_argument('-d', '--downloader', type=str, action='append', choices=SETTINGS.downloaders.keys(),
                             dest='downloaders', required=False,
                             help='select subset of PAIN_DOWNLOADERS, default: all defined downloaders')
+        parser.add_argument('--chunk-size', type=parse_positive_int, required=False,
+                            help='save payments in chunks of given size using bulk inserts')
+        parser.add_argument('--max-workers', type=parse_positive_int, default=1,
+                            help='number of downloaders run concurrently, default: 1')
 
     @no_translations
     def handle(self, *args, **options):
@@ -69,46 +80,96 @@ class Command(BaseCommand, SavePaymentsMixin):
         start_date, end_date = self._set_dates(options['start'], options['end'])
         downloaders = self._filter_downloaders(options['downloaders'])
 
-        for key, value in downloaders.items():
-            LOGGER.info('Processing: {}'.format(key))
-            import_history = PaymentImportHistory(origin=key)
-            import_history.save()
-
-            downloader_class = value['DOWNLOADER']
-            parser_class = value['PARSER']
-
-            try:
-                downloader = downloader_class(**value['DOWNLOADER_PARAMS'])
-            except Exception:
-                # Do not log the error message here as it may contain sensitive information such as login credentials.
-                LOGGER.error('Could not init Downloader for %s.', key)
-                continue
-            try:
-                # TODO: urllib3.connectionpool logs the URL in the DEBUG mode
-                LOGGER.debug('Downloading payments for %s.', key)
-                raw_statements = downloader.get_statements(start_date, end_date)
-            except Exception:
-                # Do not log the error message here as it may contain sensitive information such as login credentials.
-                LOGGER.error('Downloading payments for %s failed.', key)
-                continue
+        try:
+            if options['max_workers'] > 1:
+                self._process_concurrently(downloaders, start_date, end_date, options['max_workers'])
+            else:
+                for key, value in downloaders.items():
+                    import_history = self._start_import_history(key)
+                    timings = dict(self.metrics.timings)
+                    with self.metrics.stage('download'):
+                        raw_statements = self._download_statements(key, value, start_date, end_date)
+                    if raw_statements is not None:
+                        self._import_statements(key, value['PARSER'], raw_statements, import_history, timings)
+                    else:
+                        self._save_import_history(import_history, timings)
+        finally:
+            self.metrics.finish()
 
-            for statement in raw_statements:
-                if statement.name:
-                    import_history.add_filename(statement.name)
-            import_history.save()
+        LOGGER.info('Command download_payments finished.')
 
-            LOGGER.debug('Parsing payments for %s.', key)
+    def _process_concurrently(self, downloaders: Dict[str, Dict[str, Any]], start_date: datetime, end_date: datetime,
+                              max_workers: int) -> None:
+        """
+        Download statements in a thread pool.
+
+        Only the downloads run concurrently, statements are parsed and saved one downloader after another.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloads: Dict[str, Tuple[PaymentImportHistory, Future]] = OrderedDict()
+            for key, value in downloaders.items():
+                import_history = self._start_import_history(key)
+                future = executor.submit(self._download_statements, key, value, start_date, end_date)
+                downloads[key] = (import_history, future)
+
+            with cancel_on_error(future for _, future in downloads.values()):
+                for key, (import_history, future) in downloads.items():
+                    timings = dict(self.metrics.timings)
+                    # Only the time spent waiting for the download is measured.
+                    with self.metrics.stage('download'):
+                        raw_statements = future.result()
+                    if raw_statements is not None:
+                        self._import_statements(key, downloaders[key]['PARSER'], raw_statements, import_history,
+                                                timings)
+                    else:
+                        self._save_import_history(import_history, timings)
+
+    def _start_import_history(self, key: str) -> PaymentImportHistory:
+        LOGGER.info('Processing: {}'.format(key))
+        import_history = PaymentImportHistory(origin=key)
+        import_history.save()
+        return import_history
+
+    def _download_statements(self, key: str, value: Dict[str, Any], start_date: datetime,
+                             end_date: datetime) -> Optional[Sequence[RawStatement]]:
+        """Download raw statements, return None if the download failed."""
+        downloader_class = value['DOWNLOADER']
+        try:
+            downloader = downloader_class(**value['DOWNLOADER_PARAMS'])
+        except Exception:
+            # Do not log the error message here as it may contain sensitive information such as login credentials.
+            LOGGER.error('Could not init Downloader for %s.', key)
+            return None
+        try:
+            # TODO: urllib3.connectionpool logs the URL in the DEBUG mode
+            LOGGER.debug('Downloading payments for %s.', key)
+            return downloader.get_statements(start_date, end_date)
+        except Exception:
+            # Do not log the error message here as it may contain sensitive information such as login credentials.
+            LOGGER.error('Downloading payments for %s failed.', key)
+            return None
+
+    def _import_statements(self, key: str, parser_class: Any, raw_statements: Sequence[RawStatement],
+                           import_history: PaymentImportHistory, timings: Dict[str, float]) -> None:
+        for statement in raw_statements:
+            if statement.name:
+                import_history.add_filename(statement.name)
+        import_history.save()
+
+        LOGGER.debug('Parsing payments for %s.', key)
+        with self.metrics.stage('parse'):
             payments, parsing_errors = self._parse_payments(parser_class, raw_statements)
+        self.metrics.count('parse', len(payments))
 
-            if len(payments) > 0:
-                LOGGER.debug('Saving payments for %s.', key)
-            result = self.save_payments(payments)
-
-            import_history.errors = result.errors + parsing_errors
-            import_history.finished = True
-            import_history.save()
+        if len(payments) > 0:
+            LOGGER.debug('Saving payments for %s.', key)
+        result = self.save_payments(payments, chunk_size=self.options['chunk_size'])
 
-        LOGGER.info('Command download_payments finished.')
+        import_history.imported = result.saved
+        import_history.skipped = result.skipped
+        import_history.errors = result.errors + parsing_errors
+        import_history.finished = True
+        self._save_import_history(import_history, timings)
 
     def _set_dates(self, start_date: Optional[datetime], end_date: Optional[datetime]) -> Tuple[datetime, datetime]:
         if end_date is None:
@@ -159,7 +220,7 @@ class Command(BaseCommand, SavePaymentsMixin):
     def _convert_to_models(self, statement: BankStatement) -> Iterable[BankPayment]:
         account_number = statement.account_number
         try:
-            account = BankAccount.objects.get(account_number=account_number)
+            account = get_bank_account(account_number)
         except BankAccount.DoesNotExist:
             raise CommandError('Bank account {} does not exist.'.format(account_number))
         payments = []
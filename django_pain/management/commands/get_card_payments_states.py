@@ -18,56 +18,139 @@
 
 """Command for updating states of card payments in non-final state."""
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 
 from django.core.management.base import BaseCommand, no_translations
 from django.db import transaction
 
 from django_pain.card_payment_handlers import PaymentHandlerConnectionError, PaymentHandlerError
 from django_pain.constants import PaymentState
+from django_pain.metrics import CommandMetrics
 from django_pain.models import BankPayment
 from django_pain.settings import get_card_payment_handler_instance
-from django_pain.utils import parse_datetime_safe
+from django_pain.utils import parse_datetime_safe, parse_positive_int
 
 LOGGER = logging.getLogger(__name__)
 
+# Marks payments whose handler can only update them by `update_payments_state`.
+UPDATE_BY_HANDLER = object()
+
 
 class Command(BaseCommand):
     """Update states of card payments."""
 
     help = 'Update states of payments by their card handler.'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = CommandMetrics('get_card_payments_states')
+
     def add_arguments(self, parser):
         """Command takes optional arguments restricting processed time interval."""
         parser.add_argument('-f', '--from', dest='time_from', type=parse_datetime_safe,
                             help="ISO datetime after which payments should be processed")
         parser.add_argument('-t', '--to', dest='time_to', type=parse_datetime_safe,
                             help="ISO datetime before which payments should be processed")
+        parser.add_argument('--threads', type=parse_positive_int, default=1,
+                            help='Number of concurrent requests to card gateways, default: 1')
+        parser.add_argument('--batch-size', type=parse_positive_int, default=1000,
+                            help='Number of payments updated in a single transaction, default: 1000')
+
+    @staticmethod
+    def _get_payment_state(payment: BankPayment) -> Any:
+        """Get state of the payment from its card handler, return None on error."""
+        try:
+            card_payment_handler = get_card_payment_handler_instance(payment.card_handler)
+            return card_payment_handler.get_payment_state(payment)
+        except PaymentHandlerConnectionError:
+            LOGGER.error('Connection error while updating state of payment identifier=%s', payment.identifier)
+        except PaymentHandlerError:
+            LOGGER.error('Error while updating state of payment identifier=%s', payment.identifier)
+        return None
+
+    @staticmethod
+    def _update_payment_state(payment: BankPayment) -> None:
+        """Update state of the payment by its card handler."""
+        try:
+            card_payment_handler = get_card_payment_handler_instance(payment.card_handler)
+            card_payment_handler.update_payments_state(payment)
+        except PaymentHandlerConnectionError:
+            LOGGER.error('Connection error while updating state of payment identifier=%s', payment.identifier)
+        except PaymentHandlerError:
+            LOGGER.error('Error while updating state of payment identifier=%s', payment.identifier)
+
+    def _save_payments_states(self, states: Dict[int, Any]) -> None:
+        """
+        Save states of the payments.
+
+        Payments are locked only while they are saved. Payments locked by others or changed since their states
+        were requested are skipped.
+        """
+        with transaction.atomic():
+            payments = BankPayment.objects.select_for_update(skip_locked=True)
+            payments = payments.filter(pk__in=states, state=PaymentState.INITIALIZED)
+            updated_payments = []
+            for payment in payments:
+                state = states[payment.pk]
+                if state is UPDATE_BY_HANDLER:
+                    self._update_payment_state(payment)
+                else:
+                    payment.card_payment_state, payment.state = state
+                    updated_payments.append(payment)
+            BankPayment.objects.bulk_update(updated_payments, ('card_payment_state', 'state'))
 
-    def _get_payments_states(self, payments):
+    def _get_payments_states(self, payments: List[BankPayment], options: Dict[str, Any]) -> None:
         """Get states of the payments using their card_payment_handler."""
+        batch_size = options['batch_size']
+        requested_payments = []
+        updated_payments = []
         for payment in payments:
-            try:
-                card_payment_handler = get_card_payment_handler_instance(payment.card_handler)
-                card_payment_handler.update_payments_state(payment)
-            except PaymentHandlerConnectionError:
-                LOGGER.error('Connection error while updating state of payment identifier=%s', payment.identifier)
-            except PaymentHandlerError:
-                LOGGER.error('Error while updating state of payment identifier=%s', payment.identifier)
+            if get_card_payment_handler_instance(payment.card_handler).supports_payment_state:
+                requested_payments.append(payment)
+            else:
+                updated_payments.append(payment)
+
+        # Payments of handlers which can't get the state are updated by the handlers in this thread.
+        for offset in range(0, len(updated_payments), batch_size):
+            updates = {payment.pk: UPDATE_BY_HANDLER for payment in updated_payments[offset:offset + batch_size]}
+            with self.metrics.stage('update'):
+                self._save_payments_states(updates)
+            self.metrics.count('update', len(updates))
+
+        if not requested_payments:
+            return
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            for offset in range(0, len(requested_payments), batch_size):
+                batch = requested_payments[offset:offset + batch_size]
+                # States are requested by the threads, only the time spent waiting for them is measured.
+                states = self.metrics.iterate('get_states', executor.map(self._get_payment_state, batch))
+                states_by_pk = {payment.pk: state for payment, state in zip(batch, states) if state is not None}
+                with self.metrics.stage('save'):
+                    self._save_payments_states(states_by_pk)
+                self.metrics.count('save', len(states_by_pk))
 
     @no_translations
     def handle(self, *args, **options):
-        """Run the command."""
+        """
+        Run the command.
+
+        States of payments are requested concurrently by several threads without locking the payments.
+        The received states are then saved in batches.
+        """
         LOGGER.info('Command get_card_payments_states started.')
-        with transaction.atomic():
-            payments = BankPayment.objects.select_for_update(skip_locked=True)
-            payments = payments.filter(state__in=[PaymentState.INITIALIZED])
-            if options['time_from'] is not None:
-                payments = payments.filter(create_time__gte=options['time_from'])
-            if options['time_to'] is not None:
-                payments = payments.filter(create_time__lte=options['time_to'])
-            payments = payments.order_by('create_time')
+        payments = BankPayment.objects.filter(state__in=[PaymentState.INITIALIZED])
+        if options['time_from'] is not None:
+            payments = payments.filter(create_time__gte=options['time_from'])
+        if options['time_to'] is not None:
+            payments = payments.filter(create_time__lte=options['time_to'])
+        with self.metrics.stage('select'):
+            payments = list(payments.order_by('create_time'))
+        try:
             if payments:
-                LOGGER.info('Getting state of %s payment(s).', payments.count())
-                self._get_payments_states(payments)
+                LOGGER.info('Getting state of %s payment(s).', len(payments))
+                self._get_payments_states(payments, options)
             else:
                 LOGGER.info('No payments to update state.')
+        finally:
+            self.metrics.finish()
@@ -19,26 +19,44 @@
 """Command for importing payments from bank."""
 import logging
 import sys
+from concurrent.futures import Future
+from typing import List, Sequence, Tuple, Type
 
 from django.core.management.base import BaseCommand, CommandError, no_translations
 from django.utils import module_loading
 
 from django_pain.management.command_mixins import SavePaymentsMixin
-from django_pain.models import BankAccount, PaymentImportHistory
+from django_pain.metrics import CommandMetrics
+from django_pain.models import BankAccount, BankPayment, PaymentImportHistory
 from django_pain.parsers.common import AbstractBankStatementParser
+from django_pain.utils import cancel_on_error, get_worker_pool, parse_positive_int
 
 LOGGER = logging.getLogger(__name__)
 
 
+def _parse_file(parser_class: Type[AbstractBankStatementParser], input_file: str) -> List[BankPayment]:
+    """Parse payments from the file in a worker process."""
+    with open(input_file) as handle:
+        return list(parser_class().parse(handle))
+
+
 class Command(BaseCommand, SavePaymentsMixin):
     """Import payments from bank."""
 
     help = 'Import payments from the bank. Bank statement should be provided on standard input.'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = CommandMetrics('import_payments')
+
     def add_arguments(self, parser):
         """Command takes one argument - dotted path to parser class."""
         parser.add_argument('-p', '--parser', type=str, required=True, help='dotted path to parser class')
         parser.add_argument('input_file', nargs='*', type=str, default=['-'], help='input file with bank statement')
+        parser.add_argument('--chunk-size', type=parse_positive_int, required=False,
+                            help='save payments in chunks of given size using bulk inserts')
+        parser.add_argument('-j', '--jobs', type=parse_positive_int, default=1,
+                            help='number of processes parsing the input files, default: 1')
 
     @no_translations
     def handle(self, *args, **options):
@@ -49,13 +67,20 @@ class Command(BaseCommand, SavePaymentsMixin):
         parser_class = module_loading.import_string(options['parser'])
         if not issubclass(parser_class, AbstractBankStatementParser):
             raise CommandError('Parser argument has to be subclass of AbstractBankStatementParser.')
-        parser = parser_class()  # type: AbstractBankStatementParser
 
-        for input_file in options['input_file']:
-            LOGGER.debug('Importing payments from %s.', input_file)
-            import_history = PaymentImportHistory(origin='transproc')
-            import_history.add_filename(input_file)
-            import_history.save()
+        try:
+            if options['jobs'] > 1:
+                self._import_in_parallel(parser_class, options['input_file'])
+            else:
+                self._import_sequentially(parser_class(), options['input_file'])
+        finally:
+            self.metrics.finish()
+        LOGGER.info('Command import_payments finished.')
+
+    def _import_sequentially(self, parser: AbstractBankStatementParser, input_files: Sequence[str]) -> None:
+        for input_file in input_files:
+            import_history = self._start_import_history(input_file)
+            timings = dict(self.metrics.timings)
 
             if input_file == '-':
                 handle = sys.stdin
@@ -68,11 +93,20 @@ class Command(BaseCommand, SavePaymentsMixin):
 
             try:
                 LOGGER.debug('Parsing payments from %s.', input_file)
-                payments = list(parser.parse(handle))
+                if self.options['chunk_size']:
+                    # Stream parsed payments directly to the database so the whole statement is never in memory.
+                    LOGGER.debug('Saving payments from %s to database in chunks of %s.', input_file,
+                                 self.options['chunk_size'])
+                    result = self.save_payments(self.metrics.iterate('parse', parser.parse(handle)),
+                                                chunk_size=self.options['chunk_size'])
+                else:
+                    payments = list(self.metrics.iterate('parse', parser.parse(handle)))
 
-                LOGGER.debug('Saving %s payments from %s to database.', len(payments), input_file)
-                result = self.save_payments(payments)
+                    LOGGER.debug('Saving %s payments from %s to database.', len(payments), input_file)
+                    result = self.save_payments(payments)
 
+                import_history.imported = result.saved
+                import_history.skipped = result.skipped
                 import_history.errors = result.errors
                 import_history.finished = True
             except BankAccount.DoesNotExist as error:
@@ -80,6 +114,57 @@ class Command(BaseCommand, SavePaymentsMixin):
                 import_history.errors = 1
                 raise CommandError(error)
             finally:
-                import_history.save()
+                self._save_import_history(import_history, timings)
                 handle.close()
-        LOGGER.info('Command import_payments finished.')
+
+    def _import_in_parallel(self, parser_class: Type[AbstractBankStatementParser], input_files: Sequence[str]) -> None:
+        """
+        Parse input files in worker processes and save the payments in this process.
+
+        Files are saved in the order in which they were given.
+        """
+        if '-' in input_files:
+            raise CommandError('Standard input can not be imported in parallel.')
+
+        with get_worker_pool(self.options['jobs']) as executor:
+            futures: List[Tuple[str, Future]] = [
+                (input_file, executor.submit(_parse_file, parser_class, input_file)) for input_file in input_files]
+            with cancel_on_error(future for _, future in futures):
+                for input_file, future in futures:
+                    self._save_parsed_file(input_file, future)
+
+    def _save_parsed_file(self, input_file: str, future: Future) -> None:
+        """Wait for the file to be parsed and save its payments."""
+        import_history = self._start_import_history(input_file)
+        timings = dict(self.metrics.timings)
+        try:
+            LOGGER.debug('Parsing payments from %s.', input_file)
+            try:
+                # Files are parsed by workers, only the time spent waiting for them is measured.
+                with self.metrics.stage('parse'):
+                    payments = future.result()
+                self.metrics.count('parse', len(payments))
+            except OSError as error:
+                LOGGER.info('File %s could not be open: %s.', input_file, error)
+                raise CommandError(error) from error
+
+            LOGGER.debug('Saving %s payments from %s to database.', len(payments), input_file)
+            result = self.save_payments(payments, chunk_size=self.options['chunk_size'])
+
+            import_history.imported = result.saved
+            import_history.skipped = result.skipped
+            import_history.errors = result.errors
+            import_history.finished = True
+        except BankAccount.DoesNotExist as error:
+            LOGGER.error(str(error))
+            import_history.errors = 1
+            raise CommandError(error)
+        finally:
+            self._save_import_history(import_history, timings)
+
+    def _start_import_history(self, input_file: str) -> PaymentImportHistory:
+        LOGGER.debug('Importing payments from %s.', input_file)
+        import_history = PaymentImportHistory(origin='transproc')
+        import_history.add_filename(input_file)
+        import_history.save()
+        return import_history
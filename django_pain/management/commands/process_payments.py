@@ -17,22 +17,33 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Command for processing bank payments."""
-import fcntl
 import logging
-from copy import deepcopy
+from datetime import date
 from itertools import zip_longest
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from django.core.management.base import BaseCommand, CommandError, no_translations
 from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
+from django_pain.accounts import get_bank_accounts
 from django_pain.constants import PaymentState, PaymentType
-from django_pain.models import BankAccount, BankPayment
-from django_pain.processors import PaymentProcessorError
+from django_pain.locks import AbstractLock, LockError, get_lock
+from django_pain.metrics import CommandMetrics
+from django_pain.models import UNPROCESSED_STATES, BankPayment
+from django_pain.processors import PaymentProcessorError, copy_payment
 from django_pain.settings import SETTINGS, get_processor_instance
-from django_pain.utils import parse_datetime_safe
+from django_pain.utils import cancel_on_error, get_worker_pool, parse_datetime_safe, parse_positive_int
 
 LOGGER = logging.getLogger(__name__)
 
+# Options passed to the worker processes.
+WORKER_OPTIONS = ('time_from', 'time_to', 'batch_size', 'update_batch_size')
+
+# Fields of BankPayment which may be changed by payment processing.
+PROCESSING_FIELDS = ('state', 'processor', 'processing_error', 'processing_attempts', 'next_processing_time')
+
 
 class AccountDoesNotExist(Exception):
     """Account number does not exist."""
@@ -43,6 +54,10 @@ class Command(BaseCommand):
 
     help = 'Process unprocessed payments by predefined payment processors.'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = CommandMetrics('process_payments')
+
     def add_arguments(self, parser):
         """Command takes optional arguments restricting processed time interval."""
         parser.add_argument('-f', '--from', dest='time_from', type=parse_datetime_safe,
@@ -54,19 +69,29 @@ class Command(BaseCommand):
                            help='Comma separated list of account numbers that should be included')
         group.add_argument('--exclude-accounts', type=(lambda x: set(x.split(','))),
                            help='Comma separated list of account numbers that should be excluded')
+        parser.add_argument('--batch-size', type=parse_positive_int,
+                            help='Process payments in batches of given size, each in a separate transaction')
+        parser.add_argument('--workers', type=parse_positive_int, default=1,
+                            help='Number of processes processing payments of different accounts, default: 1')
+        parser.add_argument('--update-batch-size', type=parse_positive_int, default=1000,
+                            help='Number of payments saved by a single query, default: 1000')
 
     @staticmethod
     def _check_accounts_existence(account_numbers):
         """Raise AccountDoesNotExist when an account does not exist."""
-        db_account_numbers = set(BankAccount.objects.filter(account_number__in=account_numbers).values_list(
-            'account_number', flat=True))
+        db_account_numbers = set(get_bank_accounts(account_numbers))
         if len(db_account_numbers) != len(account_numbers):
             non_existing_accounts = sorted(account_numbers.difference(db_account_numbers))
             raise AccountDoesNotExist('Following accounts do not exist: %s. Terminating.'
                                       % ', '.join(non_existing_accounts))
 
-    @staticmethod
-    def _process_transfer_payments(payments):
+    def _save_processed_payments(self, payments: List[BankPayment], batch_size: int) -> None:
+        """Save changes made by payment processing in batches."""
+        with self.metrics.stage('save'):
+            BankPayment.objects.bulk_update(payments, PROCESSING_FIELDS, batch_size=batch_size)
+        self.metrics.count('save', len(payments))
+
+    def _process_transfer_payments(self, payments, batch_size: int):
         """Process the payments made by bank transfer."""
         for processor_name in SETTINGS.processors:
             processor = get_processor_instance(processor_name)
@@ -74,21 +99,25 @@ class Command(BaseCommand):
                 break
 
             LOGGER.info('Processing payments with processor %s.', processor_name)
+            changed_payments = []  # type: List[BankPayment]
+            stage = 'process.{}'.format(processor_name)
             try:
-                results = processor.process_payments(deepcopy(payment) for payment in payments)
+                results = self.metrics.iterate(stage, processor.process_payments(copy_payment(payment)
+                                                                                 for payment in payments))
                 unprocessed_payments = []
                 for payment, processed in zip_longest(payments, results):
                     if processed.result:
                         payment.state = PaymentState.PROCESSED
+                        payment.next_processing_time = None
                         payment.processor = processor_name
                         payment.processing_error = processed.error
-                        payment.save()
+                        changed_payments.append(payment)
                     elif processed.error is not None:
                         LOGGER.info('Saving payment %s as DEFERRED with error %s.', payment.uuid, processed.error)
-                        payment.state = PaymentState.DEFERRED
+                        payment.defer()
                         payment.processor = processor_name
                         payment.processing_error = processed.error
-                        payment.save()
+                        changed_payments.append(payment)
                     else:
                         unprocessed_payments.append(payment)
                 payments = unprocessed_payments
@@ -97,14 +126,16 @@ class Command(BaseCommand):
                              processor_name,
                              str(error))
                 continue
+            finally:
+                # Results obtained before a processor error are saved as well.
+                self._save_processed_payments(changed_payments, batch_size)
 
         LOGGER.info('Marking %s unprocessed payments as DEFERRED.', len(payments))
         for unprocessed_payment in payments:
-            unprocessed_payment.state = PaymentState.DEFERRED
-            unprocessed_payment.save()
+            unprocessed_payment.defer()
+        self._save_processed_payments(list(payments), batch_size)
 
-    @staticmethod
-    def _process_card_payments(payments):
+    def _process_card_payments(self, payments, batch_size: int):
         """Process the payments made by card."""
         if not payments:
             return
@@ -118,19 +149,144 @@ class Command(BaseCommand):
             processors_payments = payments.filter(processor=processor_name)
 
             LOGGER.info('Processing card payments with processor %s.', processor_name)
-            results = processor.process_payments(
-                deepcopy(payment) for payment in processors_payments)
+            stage = 'process.{}'.format(processor_name)
+            results = self.metrics.iterate(stage, processor.process_payments(
+                copy_payment(payment) for payment in processors_payments))
 
+            changed_payments = []  # type: List[BankPayment]
             for payment, processed in zip_longest(processors_payments, results):
                 if processed.result:
                     payment.state = PaymentState.PROCESSED
+                    payment.next_processing_time = None
                     payment.processing_error = processed.error
-                    payment.save()
                 else:
                     LOGGER.info('Saving payment %s as DEFERRED with error %s.', payment.uuid, processed.error)
-                    payment.state = PaymentState.DEFERRED
+                    payment.defer()
                     payment.processing_error = processed.error
-                    payment.save()
+                changed_payments.append(payment)
+            self._save_processed_payments(changed_payments, batch_size)
+
+    def _get_payments(self, options):
+        """Return payments which should be processed."""
+        # Accounts are needed for payment snapshots.
+        payments = BankPayment.objects.select_related('account')
+        payments = payments.filter(state__in=UNPROCESSED_STATES)
+        # Skip deferred payments which are not due yet.
+        payments = payments.exclude(state=PaymentState.DEFERRED, next_processing_time__gt=timezone.now())
+        if options['time_from'] is not None:
+            payments = payments.filter(create_time__gte=options['time_from'])
+        if options['time_to'] is not None:
+            payments = payments.filter(create_time__lte=options['time_to'])
+        if options['include_accounts']:
+            self._check_accounts_existence(options['include_accounts'])
+            payments = payments.filter(account__account_number__in=options['include_accounts'])
+        if options['exclude_accounts']:
+            self._check_accounts_existence(options['exclude_accounts'])
+            payments = payments.exclude(account__account_number__in=options['exclude_accounts'])
+        return payments
+
+    def _process_payments(self, payments, options):
+        """Process card payments and then payments made by bank transfer."""
+        self._process_card_payments(payments.filter(payment_type=PaymentType.CARD_PAYMENT),
+                                    options['update_batch_size'])
+        self._process_transfer_payments(payments.filter(payment_type=PaymentType.TRANSFER),
+                                        options['update_batch_size'])
+
+    @staticmethod
+    def _following(transaction_date: Optional[date], pk: int) -> Q:
+        """Return condition matching payments ordered after the given one."""
+        if transaction_date is None:
+            return Q(transaction_date__isnull=True, pk__gt=pk)
+        return (Q(transaction_date=transaction_date, pk__gt=pk) | Q(transaction_date__gt=transaction_date)
+                | Q(transaction_date__isnull=True))
+
+    def _process_in_batches(self, payments, options):
+        """
+        Process payments in batches, each of them in a separate transaction.
+
+        Only payments of the current batch are locked and each batch is committed once it is processed.
+        Payments are walked through by transaction date and id, so payments deferred in this run
+        are not offered to the processors again.
+        """
+        payments = payments.order_by(F('transaction_date').asc(nulls_last=True), 'pk')
+        last_payment: Optional[Tuple[Optional[date], int]] = None
+        while True:
+            with transaction.atomic():
+                batch = payments
+                if last_payment is not None:
+                    batch = batch.filter(self._following(*last_payment))
+                batch = batch.select_for_update(skip_locked=True, of=('self',))
+                with self.metrics.stage('select'):
+                    keys = list(batch.values_list('transaction_date', 'pk')[:options['batch_size']])
+                if not keys:
+                    break
+
+                LOGGER.info('Processing batch of %s unprocessed payments.', len(keys))
+                self._process_payments(payments.filter(pk__in=[pk for _, pk in keys]), options)
+            last_payment = keys[-1]
+
+    def _process(self, payments, options):
+        """Lock and process payments either at once or in batches."""
+        if options['batch_size']:
+            self._process_in_batches(payments, options)
+        else:
+            with transaction.atomic():
+                payments = payments.select_for_update(skip_locked=True, of=('self',))
+                payments = payments.order_by('transaction_date')
+
+                with self.metrics.stage('select'):
+                    count = payments.count()
+                LOGGER.info('Processing %s unprocessed payments.', count)
+                self._process_payments(payments, options)
+
+    def _process_in_workers(self, payments, options):
+        """
+        Split payments by their account between worker processes.
+
+        Each worker processes payments of its accounts using its own database connection.
+        """
+        account_ids = sorted(set(payments.values_list('account_id', flat=True)))
+        shards = [account_ids[i::options['workers']] for i in range(min(options['workers'], len(account_ids)))]
+        LOGGER.info('Processing payments of %s accounts in %s workers.', len(account_ids), len(shards))
+        if not shards:
+            return
+
+        worker_options = {key: options[key] for key in WORKER_OPTIONS}
+        with get_worker_pool(len(shards)) as executor:
+            futures = [executor.submit(_process_accounts, shard, worker_options) for shard in shards]
+            with cancel_on_error(futures):
+                for future in futures:
+                    # Durations of stages are summed over the workers.
+                    self.metrics.add(*future.result())
+
+    def _lock_accounts(self, account_numbers: Iterable[str]) -> Optional[List[AbstractLock]]:
+        """
+        Lock accounts, so they are not processed by other runs of the command.
+
+        Return None if any of the accounts is already locked.
+        """
+        locks: List[AbstractLock] = []
+        try:
+            for account_number in sorted(account_numbers):
+                lock = get_lock('process_payments', account_number, SETTINGS.process_payments_lock_file)
+                if not lock.acquire():
+                    self._unlock(locks)
+                    return None
+                locks.append(lock)
+        except LockError as error:
+            self._unlock(locks)
+            LOGGER.error('%s. Terminating.', error)
+            raise CommandError('{}. Terminating.'.format(error))
+        return locks
+
+    @staticmethod
+    def _unlock(locks: Iterable[AbstractLock]) -> None:
+        """Release the locks, errors are only logged so they don't mask errors of the command."""
+        for lock in locks:
+            try:
+                lock.release()
+            except LockError as error:
+                LOGGER.error('Lock %s could not be released: %s', lock, error)
 
     @no_translations
     def handle(self, *args, **options):
@@ -138,52 +294,50 @@ class Command(BaseCommand):
         Run command.
 
         If can't acquire lock, display warning and terminate.
+        Runs restricted by --include-accounts share the command lock and lock the included accounts instead.
         """
         LOGGER.info('Command process_payments started.')
-        LOCK = None
+        LOCK = get_lock('process_payments', path=SETTINGS.process_payments_lock_file)
         try:
-            LOCK = open(SETTINGS.process_payments_lock_file, 'a')
-            fcntl.flock(LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            LOGGER.info('Lock acquired.')
-        except OSError as error:
-            if LOCK is not None:
-                self.stderr.write(self.style.WARNING('Command process_payments is already running. Terminating.'))
-                LOCK.close()
-                LOGGER.warning('Command already running. Terminating.')
-                return
-            else:
-                LOGGER.error(
-                    'Error occured while opening lockfile %s: %s. Terminating.',
-                    SETTINGS.process_payments_lock_file, str(error)
-                )
-                raise CommandError('Error occured while opening lockfile {}: {}. Terminating.'.format(
-                    SETTINGS.process_payments_lock_file, str(error)))
+            acquired = LOCK.acquire(shared=bool(options['include_accounts']))
+        except LockError as error:
+            LOGGER.error('%s. Terminating.', error)
+            raise CommandError('{}. Terminating.'.format(error))
+        if not acquired:
+            self.stderr.write(self.style.WARNING('Command process_payments is already running. Terminating.'))
+            LOGGER.warning('Command already running. Terminating.')
+            return
+        LOGGER.info('Lock acquired.')
 
+        account_locks: List[AbstractLock] = []
         try:
-            with transaction.atomic():
-                payments = BankPayment.objects.select_for_update(skip_locked=True)
-                payments = payments.filter(state__in=[PaymentState.READY_TO_PROCESS, PaymentState.DEFERRED])
-                if options['time_from'] is not None:
-                    payments = payments.filter(create_time__gte=options['time_from'])
-                if options['time_to'] is not None:
-                    payments = payments.filter(create_time__lte=options['time_to'])
-                if options['include_accounts']:
-                    self._check_accounts_existence(options['include_accounts'])
-                    payments = payments.filter(account__account_number__in=options['include_accounts'])
-                if options['exclude_accounts']:
-                    self._check_accounts_existence(options['exclude_accounts'])
-                    payments = payments.exclude(account__account_number__in=options['exclude_accounts'])
-                payments = payments.order_by('transaction_date')
-
-                LOGGER.info('Processing %s unprocessed payments.', payments.count())
+            payments = self._get_payments(options)
+            if options['include_accounts']:
+                locks = self._lock_accounts(options['include_accounts'])
+                if locks is None:
+                    self.stderr.write(self.style.WARNING(
+                        'Command process_payments is already running for some of the accounts. Terminating.'))
+                    LOGGER.warning('Command already running for some of the accounts. Terminating.')
+                    return
+                account_locks = locks
 
-                self._process_card_payments(payments.filter(payment_type=PaymentType.CARD_PAYMENT))
-                self._process_transfer_payments(payments.filter(payment_type=PaymentType.TRANSFER))
+            if options['workers'] > 1:
+                self._process_in_workers(payments, options)
+            else:
+                self._process(payments, options)
 
         except AccountDoesNotExist as e:
             LOGGER.error(str(e))
             raise CommandError(str(e))
         finally:
-            fcntl.flock(LOCK, fcntl.LOCK_UN)
-            LOCK.close()
+            self._unlock(account_locks + [LOCK])
+            self.metrics.finish()
         LOGGER.info('Command process_payments finished.')
+
+
+def _process_accounts(account_ids: List[int], options: Dict[str, Any]) -> Tuple[Dict[str, float], Dict[str, int]]:
+    """Process payments of given accounts in a worker process, return timings and counts of its stages."""
+    options = dict(options, include_accounts=None, exclude_accounts=None)
+    command = Command()
+    command._process(command._get_payments(options).filter(account__in=account_ids), options)
+    return command.metrics.timings, command.metrics.counts
@@ -0,0 +1,285 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Metrics of command runs."""
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple, TypeVar
+
+from django_pain.settings import SETTINGS
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Upper bounds of histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(**labels: str) -> str:
+    """Return labels of a metric in Prometheus text format."""
+    values = ('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for key, value in labels.items())
+    return '{' + ','.join(values) + '}'
+
+
+class CommandMetrics(object):
+    """
+    Durations of stages of a command run and numbers of items processed by them.
+
+    Stages may be nested, the time spent in a nested stage is not counted in the outer one.
+    Metrics are not thread safe, stages have to be measured in a single thread.
+    """
+
+    def __init__(self, command: str) -> None:
+        self.command = command
+        self.timings: Dict[str, float] = OrderedDict()
+        self.counts: Dict[str, int] = OrderedDict()
+        # Duration of the whole run, set when the run is finished.
+        self.duration = 0.0
+        self._start = time.perf_counter()
+        # Time spent in nested stages of the active stages.
+        self._nested: List[float] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Measure the duration of the stage."""
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed - nested
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Iterate over the items, measure the time needed to produce them and count them."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.count(name)
+            yield item
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Add number of items processed by the stage."""
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def add(self, timings: Mapping[str, float], counts: Mapping[str, int]) -> None:
+        """Add timings and counts of stages measured elsewhere, e.g. in a worker process."""
+        for name, duration in timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + duration
+        for name, count in counts.items():
+            self.count(name, count)
+
+    def get_rates(self) -> Dict[str, float]:
+        """Return numbers of items processed by stages per second."""
+        return OrderedDict((name, count / self.timings[name]) for name, count in self.counts.items()
+                           if self.timings.get(name))
+
+    def get_timings_since(self, timings: Mapping[str, float]) -> Dict[str, float]:
+        """Return durations of stages since the given copy of timings."""
+        return OrderedDict((name, duration - timings.get(name, 0.0)) for name, duration in self.timings.items()
+                           if name not in timings or duration != timings[name])
+
+    def finish(self) -> None:
+        """Finish the run and report the metrics by all metrics backends."""
+        self.duration = time.perf_counter() - self._start
+        for name, backend in get_metrics_backends().items():
+            try:
+                backend.report(self)
+            except Exception as error:
+                LOGGER.error('Metrics backend %s failed to report metrics: %s', name, error)
+
+
+class AbstractMetricsBackend(ABC):
+    """Backend reporting metrics of command runs."""
+
+    @abstractmethod
+    def report(self, metrics: CommandMetrics) -> None:
+        """Report metrics of the finished command run."""
+
+
+class LoggingMetricsBackend(AbstractMetricsBackend):
+    """Metrics backend which logs the metrics."""
+
+    def __init__(self, level: str = 'INFO') -> None:
+        self.level = logging.getLevelName(level)
+
+    def report(self, metrics: CommandMetrics) -> None:
+        """Log the metrics."""
+        rates = metrics.get_rates()
+        for name, duration in metrics.timings.items():
+            if name in rates:
+                LOGGER.log(self.level, 'Command %s stage %s took %.3f s, %d items, %.1f items/s.', metrics.command,
+                           name, duration, metrics.counts[name], rates[name])
+            else:
+                LOGGER.log(self.level, 'Command %s stage %s took %.3f s.', metrics.command, name, duration)
+        LOGGER.log(self.level, 'Command %s took %.3f s.', metrics.command, metrics.duration)
+
+
+class StatsdMetricsBackend(AbstractMetricsBackend):
+    """Metrics backend which sends the metrics to StatsD over UDP."""
+
+    def __init__(self, host: str = 'localhost', port: int = 8125, prefix: str = 'pain') -> None:
+        self.address = (host, port)
+        self.prefix = prefix
+
+    @staticmethod
+    def _name(*parts: str) -> str:
+        return '.'.join(re.sub(r'[^\w.-]', '_', part) for part in parts if part)
+
+    def report(self, metrics: CommandMetrics) -> None:
+        """Send stage durations as timers and numbers of items as gauges."""
+        lines = ['{}:{:.3f}|ms'.format(self._name(self.prefix, metrics.command, name), duration * 1000)
+                 for name, duration in metrics.timings.items()]
+        lines.extend('{}:{}|g'.format(self._name(self.prefix, metrics.command, 'items', name), count)
+                     for name, count in metrics.counts.items())
+        lines.append('{}:{:.3f}|ms'.format(self._name(self.prefix, metrics.command, 'total'), metrics.duration * 1000))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for line in lines:
+                sock.sendto(line.encode(), self.address)
+
+
+class PrometheusTextfileMetricsBackend(AbstractMetricsBackend):
+    """
+    Metrics backend which writes the metrics for the textfile collector of Prometheus node exporter.
+
+    Metrics of each command are written to the file `pain_<command>.prom` in the given directory.
+    The file is replaced by every run of the command.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def report(self, metrics: CommandMetrics) -> None:
+        """Write the metrics file."""
+        lines = ['# HELP pain_command_stage_seconds Duration of the command stage in seconds.',
+                 '# TYPE pain_command_stage_seconds gauge']
+        lines.extend('pain_command_stage_seconds{} {}'.format(format_labels(command=metrics.command, stage=name),
+                                                              duration)
+                     for name, duration in metrics.timings.items())
+        lines.extend(['# HELP pain_command_stage_items Number of items processed by the command stage.',
+                      '# TYPE pain_command_stage_items gauge'])
+        lines.extend('pain_command_stage_items{} {}'.format(format_labels(command=metrics.command, stage=name), count)
+                     for name, count in metrics.counts.items())
+        lines.extend(['# HELP pain_command_duration_seconds Duration of the command in seconds.',
+                      '# TYPE pain_command_duration_seconds gauge',
+                      'pain_command_duration_seconds{} {}'.format(format_labels(command=metrics.command),
+                                                                  metrics.duration),
+                      '# HELP pain_command_last_run_timestamp_seconds Time when the command finished.',
+                      '# TYPE pain_command_last_run_timestamp_seconds gauge',
+                      'pain_command_last_run_timestamp_seconds{} {}'.format(format_labels(command=metrics.command),
+                                                                            time.time())])
+
+        # Write the file atomically, so the collector never reads a partial file.
+        handle = tempfile.NamedTemporaryFile('w', dir=self.directory, prefix='.pain_', suffix='.prom', delete=False)
+        try:
+            with handle:
+                handle.write('\n'.join(lines) + '\n')
+            os.chmod(handle.name, 0o644)
+            os.replace(handle.name, os.path.join(self.directory, 'pain_{}.prom'.format(metrics.command)))
+        except BaseException:
+            os.remove(handle.name)
+            raise
+
+
+class Histogram(object):
+    """
+    Histogram of values observed by the running process, e.g. durations of requests.
+
+    Values are kept in memory of the process, each process of the web server has its own histograms.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str],
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Numbers of values in the individual buckets and sum of values for each combination of labels.
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = OrderedDict()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Observe the value."""
+        key = tuple(labels[name] for name in self.labelnames)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def clear(self) -> None:
+        """Forget all observed values."""
+        with self._lock:
+            self._values.clear()
+
+    def collect(self) -> List[str]:
+        """Return the histogram in Prometheus text format."""
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        for key, counts, total in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(**labels, le=le), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(**labels), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(**labels), cumulative))
+        return lines
+
+
+CARD_GATEWAY_REQUEST_DURATION = Histogram(
+    'pain_card_gateway_request_duration_seconds', 'Duration of requests to card payment gateways in seconds.',
+    ('handler', 'operation'))
+REST_REQUEST_DURATION = Histogram(
+    'pain_rest_request_duration_seconds', 'Duration of REST API requests in seconds.', ('action', 'method', 'status'))
+
+
+@lru_cache()
+def get_metrics_backends() -> Dict[str, AbstractMetricsBackend]:
+    """Return instances of the configured metrics backends."""
+    return OrderedDict((name, value['BACKEND'](**value['PARAMS']))
+                       for name, value in SETTINGS.metrics_backends.items())
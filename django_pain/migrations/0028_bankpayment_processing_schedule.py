@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-16 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0027_remove_bankaccount_enforce_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankpayment',
+            name='next_processing_time',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Next processing time'),
+        ),
+        migrations.AddField(
+            model_name='bankpayment',
+            name='processing_attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='Processing attempts'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.10 on 2026-10-16 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0028_bankpayment_processing_schedule'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bankpayment',
+            index=models.Index(fields=['-transaction_date', '-create_time', '-id'], name='bankpayment_keyset_idx'),
+        ),
+    ]
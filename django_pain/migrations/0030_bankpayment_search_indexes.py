@@ -0,0 +1,55 @@
+# Generated by Django 4.0.10 on 2026-10-17 09:12
+
+from django.db import migrations
+
+
+def get_search_indexes():
+    # Imported here, because they require psycopg2.
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+    from django.db.models import Index
+
+    return [
+        Index(fields=['variable_symbol'], opclasses=['varchar_pattern_ops'], name='bankpayment_varsym_prefix_idx'),
+        GinIndex(fields=['counter_account_name'], opclasses=['gin_trgm_ops'], name='bankpayment_name_trgm_idx'),
+        GinIndex(SearchVector('description', config='simple'), name='bankpayment_description_fts_idx'),
+    ]
+
+
+def create_search_indexes(apps, schema_editor):
+    # Search indexes are supported only by PostgreSQL.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    BankPayment = apps.get_model('django_pain', 'BankPayment')
+    for index in get_search_indexes():
+        schema_editor.add_index(BankPayment, index)
+
+
+def remove_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    BankPayment = apps.get_model('django_pain', 'BankPayment')
+    for index in get_search_indexes():
+        schema_editor.remove_index(BankPayment, index)
+
+
+def get_extension_operations():
+    try:
+        # Imported here, because it requires psycopg2.
+        from django.contrib.postgres.operations import TrigramExtension
+    except ImportError:
+        # Extensions are needed only by PostgreSQL, which can't be used without psycopg2.
+        return []
+    # The operation is skipped by other databases.
+    return [TrigramExtension()]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0029_bankpayment_keyset_index'),
+    ]
+
+    operations = get_extension_operations() + [
+        migrations.RunPython(create_search_indexes, reverse_code=remove_search_indexes),
+    ]
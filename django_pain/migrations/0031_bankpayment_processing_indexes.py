@@ -0,0 +1,26 @@
+# Generated by Django 4.0.10 on 2026-10-17 09:40
+
+from django.db import migrations, models
+import django_pain.constants
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0030_bankpayment_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bankpayment',
+            index=models.Index(fields=['account', 'state', '-transaction_date', '-create_time'], name='bankpayment_account_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bankpayment',
+            index=models.Index(condition=models.Q(('state__in', (django_pain.constants.PaymentState['READY_TO_PROCESS'], django_pain.constants.PaymentState['DEFERRED']))), fields=['payment_type', 'transaction_date'], name='bankpayment_unprocessed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bankpayment',
+            index=models.Index(condition=models.Q(('state__in', (django_pain.constants.PaymentState['READY_TO_PROCESS'], django_pain.constants.PaymentState['DEFERRED']))), fields=['transaction_date', 'id'], name='bankpayment_unproc_batch_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django_pain.constants
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0031_bankpayment_processing_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bankpayment',
+            name='state',
+            field=models.TextField(choices=[(django_pain.constants.PaymentState['RESERVED'], 'reserved'), (django_pain.constants.PaymentState['INITIALIZED'], 'initialized'), (django_pain.constants.PaymentState['READY_TO_PROCESS'], 'ready to process'), (django_pain.constants.PaymentState['PROCESSED'], 'processed'), (django_pain.constants.PaymentState['DEFERRED'], 'not identified'), (django_pain.constants.PaymentState['EXPORTED'], 'exported'), (django_pain.constants.PaymentState['CANCELED'], 'canceled')], db_index=True, default=django_pain.constants.PaymentState['READY_TO_PROCESS'], verbose_name='Payment state'),
+        ),
+    ]
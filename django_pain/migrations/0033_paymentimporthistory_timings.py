@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0032_bankpayment_reserved_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentimporthistory',
+            name='duration',
+            field=models.DurationField(blank=True, help_text='Duration of the import.', null=True, verbose_name='Duration'),
+        ),
+        migrations.AddField(
+            model_name='paymentimporthistory',
+            name='timings',
+            field=models.JSONField(blank=True, help_text='Durations of the import stages in seconds.', null=True, verbose_name='Timings'),
+        ),
+    ]
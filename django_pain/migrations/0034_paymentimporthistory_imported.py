@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_pain', '0033_paymentimporthistory_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentimporthistory',
+            name='imported',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of imported payments.', null=True, verbose_name='Imported'),
+        ),
+        migrations.AddField(
+            model_name='paymentimporthistory',
+            name='skipped',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of payments skipped because they were already imported or due to import callbacks.', null=True, verbose_name='Skipped'),
+        ),
+    ]
@@ -17,8 +17,9 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Models module."""
-from .bank import PAYMENT_STATE_CHOICES, BankAccount, BankPayment, PaymentImportHistory
+from .bank import PAYMENT_STATE_CHOICES, UNPROCESSED_STATES, BankAccount, BankPayment, PaymentImportHistory
 from .client import Client
 from .invoices import Invoice
 
-__all__ = ['PAYMENT_STATE_CHOICES', 'BankAccount', 'BankPayment', 'Client', 'Invoice', 'PaymentImportHistory']
+__all__ = ['PAYMENT_STATE_CHOICES', 'UNPROCESSED_STATES', 'BankAccount', 'BankPayment', 'Client', 'Invoice',
+           'PaymentImportHistory']
@@ -18,11 +18,13 @@
 
 """Payments and invoices models."""
 import uuid
+from datetime import timedelta
 from typing import Tuple
 
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import BLANK_CHOICE_DASH, CheckConstraint, Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from djmoney.models.fields import CurrencyField, MoneyField
 
@@ -35,6 +37,7 @@ PAYMENT_TYPE_CHOICES = (
 )
 
 PAYMENT_STATE_CHOICES = (
+    (PaymentState.RESERVED, _('reserved')),
     (PaymentState.INITIALIZED, _('initialized')),
     (PaymentState.READY_TO_PROCESS, _('ready to process')),
     (PaymentState.PROCESSED, _('processed')),
@@ -52,6 +55,9 @@ PROCESSING_ERROR_CHOICES = (
     (PaymentProcessingError.TOO_OLD, _("Payment is older than 15 days, it can't be processed automatically")),
 )
 
+# States of payments waiting for process_payments.
+UNPROCESSED_STATES = (PaymentState.READY_TO_PROCESS, PaymentState.DEFERRED)
+
 
 class BankAccount(models.Model):
     """Bank account."""
@@ -93,6 +99,9 @@ class BankPayment(models.Model):
 
     processing_error = models.TextField(choices=PROCESSING_ERROR_CHOICES, null=True, blank=True,
                                         verbose_name=_('Automatic processing error'))
+    processing_attempts = models.PositiveIntegerField(default=0, verbose_name=_('Processing attempts'))
+    next_processing_time = models.DateTimeField(null=True, blank=True, db_index=True,
+                                                verbose_name=_('Next processing time'))
 
     # Payment symbols (specific for Czech Republic and Slovak Republic).
     constant_symbol = models.CharField(max_length=10, blank=True, verbose_name=_('Constant symbol'))
@@ -116,6 +125,19 @@ class BankPayment(models.Model):
             ),
             name='payment_counter_account_only_for_transfer'
         )]
+        indexes = [
+            # Used by keyset pagination in admin.
+            models.Index(fields=['-transaction_date', '-create_time', '-id'], name='bankpayment_keyset_idx'),
+            # Used by admin filters by account and state.
+            models.Index(fields=['account', 'state', '-transaction_date', '-create_time'],
+                         name='bankpayment_account_state_idx'),
+            # Used by process_payments to find unprocessed payments of given type.
+            models.Index(fields=['payment_type', 'transaction_date'], name='bankpayment_unprocessed_idx',
+                         condition=Q(state__in=UNPROCESSED_STATES)),
+            # Used by process_payments to walk through unprocessed payments in batches.
+            models.Index(fields=['transaction_date', 'id'], name='bankpayment_unproc_batch_idx',
+                         condition=Q(state__in=UNPROCESSED_STATES)),
+        ]
 
     def __str__(self):
         """Return string representation of bank payment."""
@@ -129,6 +151,30 @@ class BankPayment(models.Model):
             ))
         super().clean()
 
+    def save(self, *args, **kwargs):
+        """Save bank payment, only deferred payments keep their next processing time."""
+        if self.state != PaymentState.DEFERRED:
+            self.next_processing_time = None
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'state' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'next_processing_time'}
+        super().save(*args, **kwargs)
+
+    def defer(self) -> None:
+        """
+        Mark payment as deferred and schedule its next automatic processing.
+
+        The delay between processing attempts grows exponentially from PAIN_PROCESSING_RETRY_DELAY
+        up to PAIN_PROCESSING_RETRY_MAX_DELAY. Payment is offered to every run if the delay is not set.
+        """
+        self.state = PaymentState.DEFERRED
+        self.processing_attempts += 1
+        if SETTINGS.processing_retry_delay:
+            # Limit the exponent so the delay does not overflow.
+            exponent = min(self.processing_attempts - 1, 32)
+            delay = min(SETTINGS.processing_retry_delay * 2 ** exponent, SETTINGS.processing_retry_max_delay)
+            self.next_processing_time = timezone.now() + timedelta(seconds=delay)
+
     @property
     def advance_invoice(self):
         """Return advance invoice if it exists."""
@@ -164,10 +210,19 @@ class PaymentImportHistory(models.Model):
                                           help_text='Import start time.')
     _filenames = models.TextField(null=True, blank=True, verbose_name=_('File names'),
                                   help_text='Names of the files the data were imported from if known.')
+    imported = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Imported'),
+                                           help_text='Number of imported payments.')
+    skipped = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Skipped'),
+                                          help_text='Number of payments skipped because they were already imported '
+                                                    'or due to import callbacks.')
     errors = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name=_('Errors'),
                                               help_text='Number of payments skipped due to an error.')
     finished = models.BooleanField(default=False, verbose_name=_('Finished'),
                                    help_text='Indicates whether the import command finished without raising an error.')
+    duration = models.DurationField(null=True, blank=True, verbose_name=_('Duration'),
+                                    help_text='Duration of the import.')
+    timings = models.JSONField(null=True, blank=True, verbose_name=_('Timings'),
+                               help_text='Durations of the import stages in seconds.')
 
     class Meta:
         """Model Meta class."""
@@ -25,11 +25,12 @@ transforming them into unified XML format.
 URL: https://github.com/CZ-NIC/fred-transproc
 """
 from datetime import datetime
-from typing import IO, Iterator
+from typing import IO, Dict, Iterator, Optional
 
 from djmoney.money import Money
 from lxml import etree
 
+from django_pain.accounts import get_bank_account
 from django_pain.models import BankAccount, BankPayment
 from django_pain.parsers.czechslovak import CzechSlovakBankStatementParser
 from django_pain.settings import SETTINGS
@@ -41,42 +42,63 @@ def none_to_str(value: str) -> str:
 
 
 class TransprocXMLParser(CzechSlovakBankStatementParser):
-    """Transproc XML parser."""
+    """
+    Transproc XML parser.
 
-    def parse(self, bank_statement: IO[bytes]) -> Iterator[BankPayment]:
-        """Parse XML input."""
-        parser = etree.XMLParser(resolve_entities=False)
-        tree = etree.parse(bank_statement, parser)
+    The input is parsed incrementally and processed items are cleared,
+    so memory consumption does not grow with the size of the bank statement.
+    Account number of the statement has to precede its items.
+    """
 
-        account_number = self.compose_account_number(tree.find('//*/account_number').text,
-                                                     tree.find('//*/account_bank_code').text)
-        try:
-            account = BankAccount.objects.get(account_number=account_number)
-        except BankAccount.DoesNotExist:
-            raise BankAccount.DoesNotExist('Bank account {} does not exist.'.format(account_number))
+    def parse(self, bank_statement: IO) -> Iterator[BankPayment]:
+        """Parse XML input."""
+        # Text streams have to be read as bytes, iterparse can not read unicode strings.
+        source = getattr(bank_statement, 'buffer', bank_statement)
+        header = {}  # type: Dict[str, str]
+        account = None  # type: Optional[BankAccount]
 
-        for item in tree.findall('//*/*/item'):
-            attrs = dict((el.tag, el.text) for el in item.iterchildren())
+        for _, element in etree.iterparse(source, events=('end',), resolve_entities=False):
+            if element.tag == 'item':
+                if account is None:
+                    raise ValueError('Bank statement items precede its account number.')
+                attrs = dict((el.tag, el.text) for el in element.iterchildren())
+                payment = self._get_payment(account, attrs)
+                # Free the processed items.
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                if payment is not None:
+                    yield payment
+            elif account is None and element.tag in ('account_number', 'account_bank_code'):
+                parent = element.getparent()
+                if parent is not None and parent.getparent() is not None and parent.tag != 'item':
+                    header.setdefault(element.tag, element.text)
+                if len(header) == 2:
+                    account = self._get_account(header['account_number'], header['account_bank_code'])
 
-            if attrs.get('status', '1') == '1' and attrs.get('code', '1') == '1' and attrs.get('type', '1') == '1':
-                # Only import payments with code==1 (normal transaction) and status==1 (realized transfer)
-                if SETTINGS.trim_varsym:
-                    variable_symbol = none_to_str(attrs['var_symbol']).lstrip('0')
-                else:
-                    variable_symbol = none_to_str(attrs['var_symbol'])
+    def _get_account(self, number: str, bank_code: str) -> BankAccount:
+        return get_bank_account(self.compose_account_number(number, bank_code))
 
-                payment = BankPayment(
-                    identifier=attrs['ident'],
-                    account=account,
-                    transaction_date=datetime.strptime(attrs['date'], '%Y-%m-%d'),
-                    counter_account_number=self.compose_account_number(attrs['account_number'],
-                                                                       attrs['account_bank_code']),
-                    counter_account_name=none_to_str(attrs['name']),
-                    amount=Money(attrs['price'], account.currency),
-                    description=none_to_str(attrs['memo']),
-                    constant_symbol=none_to_str(attrs['const_symbol']),
-                    variable_symbol=variable_symbol,
-                    specific_symbol=none_to_str(attrs['spec_symbol']),
-                )
+    def _get_payment(self, account: BankAccount, attrs: Dict[str, str]) -> Optional[BankPayment]:
+        """Return payment created from item attributes or None if the item should not be imported."""
+        if attrs.get('status', '1') == '1' and attrs.get('code', '1') == '1' and attrs.get('type', '1') == '1':
+            # Only import payments with code==1 (normal transaction) and status==1 (realized transfer)
+            if SETTINGS.trim_varsym:
+                variable_symbol = none_to_str(attrs['var_symbol']).lstrip('0')
+            else:
+                variable_symbol = none_to_str(attrs['var_symbol'])
 
-                yield payment
+            return BankPayment(
+                identifier=attrs['ident'],
+                account=account,
+                transaction_date=datetime.strptime(attrs['date'], '%Y-%m-%d'),
+                counter_account_number=self.compose_account_number(attrs['account_number'],
+                                                                   attrs['account_bank_code']),
+                counter_account_name=none_to_str(attrs['name']),
+                amount=Money(attrs['price'], account.currency),
+                description=none_to_str(attrs['memo']),
+                constant_symbol=none_to_str(attrs['const_symbol']),
+                variable_symbol=variable_symbol,
+                specific_symbol=none_to_str(attrs['spec_symbol']),
+            )
+        return None
@@ -17,13 +17,17 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Processors module."""
-from .common import AbstractPaymentProcessor, InvalidTaxDateError, PaymentProcessorError, ProcessPaymentResult
+from .common import (AbstractPaymentProcessor, AccountSnapshot, InvalidTaxDateError, PaymentProcessorError,
+                     PaymentSnapshot, ProcessPaymentResult, copy_payment)
 from .ignore import IgnorePaymentProcessor
 
 __all__ = [
     'AbstractPaymentProcessor',
+    'AccountSnapshot',
     'InvalidTaxDateError',
     'PaymentProcessorError',
+    'PaymentSnapshot',
     'ProcessPaymentResult',
+    'copy_payment',
     'IgnorePaymentProcessor',
 ]
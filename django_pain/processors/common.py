@@ -18,10 +18,16 @@
 
 """Base payment processor module."""
 from abc import ABC, abstractmethod
-from typing import Iterable, Optional
+from copy import deepcopy
+from datetime import date, datetime
+from typing import Iterable, Optional, Union
+from uuid import UUID
+
+from djmoney.money import Money
 
 from django_pain.constants import PaymentProcessingError
-from django_pain.models import BankPayment
+from django_pain.models import BankAccount, BankPayment
+from django_pain.settings import SETTINGS
 
 
 class PaymentProcessorError(Exception):
@@ -53,6 +59,103 @@ class ProcessPaymentResult(object):
         return False
 
 
+class _Snapshot(object):
+    """Read-only copy of selected model fields."""
+
+    __slots__ = ()  # type: tuple
+
+    def __init__(self, **values) -> None:
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is read-only.'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is read-only.'.format(type(self).__name__))
+
+    @property
+    def pk(self):
+        """Return primary key of the original object."""
+        return getattr(self, 'id')
+
+    def __repr__(self) -> str:
+        """Return string representation of the snapshot."""
+        return '<{}: {}>'.format(type(self).__name__, getattr(self, 'id'))
+
+
+class AccountSnapshot(_Snapshot):
+    """Read-only copy of a bank account."""
+
+    __slots__ = ('id', 'account_number', 'account_name', 'currency')
+
+    id: int
+    account_number: str
+    account_name: str
+    currency: str
+
+    @classmethod
+    def from_account(cls, account: BankAccount) -> 'AccountSnapshot':
+        """Create snapshot of a bank account."""
+        return cls(**{name: getattr(account, name) for name in cls.__slots__})
+
+
+class PaymentSnapshot(_Snapshot):
+    """
+    Read-only copy of a bank payment passed to payment processors.
+
+    Snapshot is much cheaper to create than a deep copy of the payment and it
+    prevents processors from changing the payment being processed.
+    """
+
+    __slots__ = ('id', 'identifier', 'uuid', 'payment_type', 'account', 'create_time', 'transaction_date',
+                 'counter_account_number', 'counter_account_name', 'amount', 'description', 'state',
+                 'card_payment_state', 'processing_error', 'constant_symbol', 'variable_symbol', 'specific_symbol',
+                 'processor', 'card_handler')
+
+    id: int
+    identifier: str
+    uuid: UUID
+    payment_type: str
+    account: AccountSnapshot
+    create_time: datetime
+    transaction_date: Optional[date]
+    counter_account_number: str
+    counter_account_name: str
+    amount: Money
+    description: str
+    state: str
+    card_payment_state: str
+    processing_error: Optional[str]
+    constant_symbol: str
+    variable_symbol: str
+    specific_symbol: str
+    processor: str
+    card_handler: str
+
+    @classmethod
+    def from_payment(cls, payment: BankPayment) -> 'PaymentSnapshot':
+        """Create snapshot of a bank payment."""
+        values = {name: getattr(payment, name) for name in cls.__slots__ if name != 'account'}
+        values['account'] = AccountSnapshot.from_account(payment.account)
+        return cls(**values)
+
+    def __str__(self) -> str:
+        """Return string representation of the payment snapshot, same as of the payment."""
+        return self.identifier
+
+
+def copy_payment(payment: BankPayment) -> Union[BankPayment, PaymentSnapshot]:
+    """
+    Return copy of the payment to be passed to a payment processor.
+
+    Deep copy of the payment is returned if PAIN_PROCESSORS_DEEPCOPY_PAYMENTS is set.
+    """
+    if SETTINGS.processors_deepcopy_payments:
+        return deepcopy(payment)
+    return PaymentSnapshot.from_payment(payment)
+
+
 class AbstractPaymentProcessor(ABC):
     """
     Bank payment processor.
@@ -88,11 +191,14 @@ class AbstractPaymentProcessor(ABC):
         return False
 
     @abstractmethod
-    def process_payments(self, payments: Iterable[BankPayment]) -> Iterable[ProcessPaymentResult]:
+    def process_payments(self,
+                         payments: Iterable[Union[BankPayment, PaymentSnapshot]]) -> Iterable[ProcessPaymentResult]:
         """
         Process bank payment.
 
         Each processor class has to implement this method.
+        Payments are passed as read-only ``PaymentSnapshot`` objects
+        unless PAIN_PROCESSORS_DEEPCOPY_PAYMENTS is set.
 
         Returns:
             Iterable of named tuples (``ProcessPaymentResult``). If n-th payment
@@ -17,13 +17,13 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Ignore payment processor."""
-from typing import Iterable
+from typing import Iterable, Union
 
 from django.utils.translation import gettext_lazy as _
 
 from django_pain.models import BankPayment
 
-from .common import AbstractPaymentProcessor, ProcessPaymentResult
+from .common import AbstractPaymentProcessor, PaymentSnapshot, ProcessPaymentResult
 
 
 # FIXME: This class is sort of hack. It's similar to the way, how payments
@@ -40,7 +40,8 @@ class IgnorePaymentProcessor(AbstractPaymentProcessor):
 
     default_objective = _('Ignore payment')
 
-    def process_payments(self, payments: Iterable[BankPayment]) -> Iterable[ProcessPaymentResult]:
+    def process_payments(self,
+                         payments: Iterable[Union[BankPayment, PaymentSnapshot]]) -> Iterable[ProcessPaymentResult]:
         """Reject all payments."""
         for payment in payments:
             yield ProcessPaymentResult(result=False)
@@ -42,6 +42,7 @@ class ExternalPaymentState(str, Enum):
 
 
 CARD_PAYMENT_STATE_MAPPING = {
+    PaymentState.RESERVED: ExternalPaymentState.INITIALIZED,
     PaymentState.INITIALIZED: ExternalPaymentState.INITIALIZED,
     PaymentState.READY_TO_PROCESS: ExternalPaymentState.PAID,
     PaymentState.PROCESSED: ExternalPaymentState.PAID,
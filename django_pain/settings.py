@@ -134,6 +134,31 @@ class NamedClassSetting(appsettings.DictSetting):
                 raise ValidationError('{} is not subclass of {}'.format(full_class_name(cls), checked_class.__name__))
 
 
+class ClassSetting(appsettings.StringSetting):
+    """Dotted path to class setting. Class is checked to be specified type."""
+
+    def __init__(self, checked_class_str, *args, **kwargs):
+        self.checked_class_str = checked_class_str
+        kwargs.setdefault('transform_default', True)
+        super().__init__(*args, **kwargs)
+
+    def transform(self, value):
+        """Transform value from dotted string into class."""
+        return module_loading.import_string(value)
+
+    def validate(self, value):
+        """Check whether dotted path refers to subclass of class specified in checked_class_str."""
+        super().validate(value)
+        try:
+            cls = self.transform(value)
+        except ImportError as error:
+            raise ValidationError('{} can not be imported: {}'.format(value, error))
+
+        checked_class = module_loading.import_string(self.checked_class_str)
+        if not isinstance(cls, type) or not issubclass(cls, checked_class):
+            raise ValidationError('{} is not subclass of {}'.format(value, checked_class.__name__))
+
+
 class CallableListSetting(appsettings.ListSetting):
     """Contains list of dotted paths referring to callables."""
 
@@ -166,6 +191,25 @@ class PainSettings(appsettings.AppSettings):
     # Location of process_payments command lock file.
     process_payments_lock_file = appsettings.StringSetting(default='/tmp/pain_process_payments.lock')
 
+    # Lock class preventing concurrent runs of commands.
+    lock_backend = ClassSetting('django_pain.locks.AbstractLock', default='django_pain.locks.FileLock')
+
+    # Whether payment processors should get deep copies of payments instead of read-only snapshots.
+    processors_deepcopy_payments = appsettings.BooleanSetting(default=False)
+
+    # Delay in seconds before a deferred payment is processed again. It doubles with each unsuccessful attempt.
+    # Deferred payments are processed by every run of process_payments if not set.
+    processing_retry_delay = appsettings.PositiveIntegerSetting(default=None)
+
+    # Maximal delay in seconds between processing attempts of a deferred payment.
+    processing_retry_max_delay = appsettings.PositiveIntegerSetting(default=86400)
+
+    # Whether bank payments in admin should be paginated by keyset cursors instead of page numbers.
+    admin_keyset_pagination = appsettings.BooleanSetting(default=False)
+
+    # Whether bank payments in admin should be searched using PostgreSQL full-text and trigram indexes.
+    admin_fulltext_search = appsettings.BooleanSetting(default=False)
+
     # Whether variable symbol should be trimmed of leading zeros.
     trim_varsym = appsettings.BooleanSetting(default=False)
 
@@ -185,6 +229,32 @@ class PainSettings(appsettings.AppSettings):
         required=False
     )
 
+    # Backends reporting metrics of command runs.
+    metrics_backends = NamedDictSetting(
+        dict(
+            BACKEND=ClassSetting('django_pain.metrics.AbstractMetricsBackend', required=True),
+            PARAMS=appsettings.DictSetting(required=True, key_type=str)
+        ),
+        required=False
+    )
+
+    # Number of seconds for which bank accounts looked up by their numbers are cached by each process.
+    # Accounts are cached until changed by the same process if not set.
+    bank_account_cache_timeout = appsettings.PositiveIntegerSetting(default=300)
+
+    # Whether the view exposing metrics in Prometheus text format is enabled.
+    metrics_view = appsettings.BooleanSetting(default=False)
+
+    # Token which clients of the metrics view have to send as a bearer token. Token is not required if not set.
+    metrics_view_token = appsettings.StringSetting(default=None)
+
+    # Number of seconds for which metrics computed from the database are cached by the metrics view.
+    metrics_view_cache_timeout = appsettings.PositiveIntegerSetting(default=60)
+
+    # Number of seconds for which states of initialized card payments received from card gateways are cached.
+    # States are not cached if not set.
+    card_payment_state_cache_timeout = appsettings.PositiveIntegerSetting(default=None)
+
     # CSOB card settings
     csob_card = appsettings.NestedDictSetting(dict(
         api_url=appsettings.StringSetting(default='https://api.platebnibrana.csob.cz/api/v1.9/'),
@@ -192,6 +262,14 @@ class PainSettings(appsettings.AppSettings):
         merchant_id=appsettings.StringSetting(required=True),
         merchant_private_key=appsettings.FileSetting(required=True),
         account_numbers=appsettings.DictSetting(required=True),
+        # Connections to the gateway kept open for reuse.
+        pool_size=appsettings.PositiveIntegerSetting(default=10),
+        keep_alive=appsettings.BooleanSetting(default=True),
+        connect_timeout=appsettings.PositiveFloatSetting(default=3.05),
+        read_timeout=appsettings.PositiveFloatSetting(default=12),
+        # Retries of failed connections and of status requests which failed with server error.
+        retries=appsettings.IntegerSetting(default=0, minimum=0),
+        retry_backoff=appsettings.PositiveFloatSetting(default=0.5),
     ), default=None)
 
     class Meta:
@@ -21,12 +21,14 @@ from datetime import date
 from decimal import ROUND_HALF_UP
 from queue import Queue
 from threading import Event, Thread
+from unittest import skipIf, skipUnless
 
 from django.contrib import admin
 from django.contrib.auth.models import Permission, User
 from django.contrib.contenttypes.models import ContentType
-from django.db import close_old_connections, transaction
+from django.db import close_old_connections, connection, transaction
 from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from freezegun import freeze_time
 from moneyed.localization import _FORMATTER
@@ -469,6 +471,24 @@ class TestBankPaymentAdminLinks(TestBankPaymentAdmin):
         response = self.client.get(reverse('admin:django_pain_bankpayment_changelist'))
         self.assertContains(response, '<a href="http://example.com/invoice/">INV111222</a>&nbsp;(+1)')
 
+    def test_get_list_queries(self):
+        """Test number of queries of model list does not depend on number of payments."""
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('admin:django_pain_bankpayment_changelist'))
+        for index in range(10):
+            payment = get_payment(identifier='Other payment {}'.format(index), account=self.account,
+                                  state=PaymentState.PROCESSED, processor='linked_dummy')
+            payment.save()
+            get_client(handle='HANDLE{}'.format(index), payment=payment).save()
+            self.invoice.payments.add(payment)
+            self.invoice2.payments.add(payment)
+
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('admin:django_pain_bankpayment_changelist'))
+        self.assertContains(response, 'HANDLE9')
+        self.assertContains(response, '<a href="http://example.com/invoice/">INV111222</a>&nbsp;(+1)', count=11)
+
     def test_get_list_no_advance_invoice(self):
         """Test GET request on model list."""
         self.invoice.invoice_type = InvoiceType.ACCOUNT
@@ -487,6 +507,47 @@ class TestBankPaymentAdminLinks(TestBankPaymentAdmin):
         self.assertContains(response, '<a href="http://example.com/client/">HANDLE</a>')
 
 
+@override_settings(ROOT_URLCONF='django_pain.tests.urls', PAIN_ADMIN_FULLTEXT_SEARCH=True)
+class TestBankPaymentAdminSearch(TestCase):
+    """Test search in BankPaymentAdmin."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        account = get_account()
+        account.save()
+        get_payment(identifier='PAYMENT_1', account=account, variable_symbol='12345',
+                    counter_account_name='Acme Corporation', description='Payment for domain example.cz').save()
+        get_payment(identifier='PAYMENT_2', account=account, variable_symbol='67890',
+                    counter_account_name='Another account', description='Deposit').save()
+
+    def _search(self, search_term):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:django_pain_bankpayment_changelist'), {'q': search_term})
+        return sorted(payment.identifier for payment in response.context['cl'].result_list)
+
+    @override_settings(PAIN_ADMIN_FULLTEXT_SEARCH=False)
+    def test_search_default(self):
+        self.assertEqual(self._search('234'), ['PAYMENT_1'])
+        self.assertEqual(self._search('corp'), ['PAYMENT_1'])
+        self.assertEqual(self._search('doma'), ['PAYMENT_1'])
+        self.assertEqual(self._search(''), ['PAYMENT_1', 'PAYMENT_2'])
+
+    @skipIf(connection.vendor == 'postgresql', 'Requires other database than PostgreSQL.')
+    def test_search_fallback(self):
+        self.assertEqual(self._search('234'), ['PAYMENT_1'])
+        self.assertEqual(self._search('doma'), ['PAYMENT_1'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL database.')
+    def test_search_fulltext(self):
+        self.assertEqual(self._search('123'), ['PAYMENT_1'])
+        self.assertEqual(self._search('234'), [])
+        self.assertEqual(self._search('corp'), ['PAYMENT_1'])
+        self.assertEqual(self._search('domain payment'), ['PAYMENT_1'])
+        self.assertEqual(self._search('doma'), [])
+        self.assertEqual(self._search(' deposit '), ['PAYMENT_2'])
+        self.assertEqual(self._search(''), ['PAYMENT_1', 'PAYMENT_2'])
+
+
 @override_settings(ROOT_URLCONF='django_pain.tests.urls')
 class TestUserAdmin(TestCase):
     """Test UserAdmin."""
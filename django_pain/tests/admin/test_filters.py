@@ -51,6 +51,7 @@ class TestChoicesFieldListFilter(TestCase):
         self.assertEqual(choices, ([
             {'selected': True, 'query_string': '?', 'display': 'Realized'},
             {'selected': False, 'query_string': '?state__exact=all', 'display': 'All'},
+            {'selected': False, 'query_string': '?state__exact=reserved', 'display': 'reserved'},
             {'selected': False, 'query_string': '?state__exact=initialized', 'display': 'initialized'},
             {'selected': False, 'query_string': '?state__exact=ready_to_process', 'display': 'ready to process'},
             {'selected': False, 'query_string': '?state__exact=processed', 'display': 'processed'},
@@ -71,6 +72,7 @@ class TestChoicesFieldListFilter(TestCase):
         self.assertEqual(choices, ([
             {'selected': False, 'query_string': '?', 'display': 'Realized'},
             {'selected': True, 'query_string': '?state__exact=all', 'display': 'All'},
+            {'selected': False, 'query_string': '?state__exact=reserved', 'display': 'reserved'},
             {'selected': False, 'query_string': '?state__exact=initialized', 'display': 'initialized'},
             {'selected': False, 'query_string': '?state__exact=ready_to_process', 'display': 'ready to process'},
             {'selected': False, 'query_string': '?state__exact=processed', 'display': 'processed'},
@@ -92,6 +94,7 @@ class TestChoicesFieldListFilter(TestCase):
         self.assertEqual(choices, ([
             {'selected': False, 'query_string': '?', 'display': 'Realized'},
             {'selected': False, 'query_string': '?state__exact=all', 'display': 'All'},
+            {'selected': False, 'query_string': '?state__exact=reserved', 'display': 'reserved'},
             {'selected': True, 'query_string': '?state__exact=initialized', 'display': 'initialized'},
             {'selected': False, 'query_string': '?state__exact=ready_to_process', 'display': 'ready to process'},
             {'selected': False, 'query_string': '?state__exact=processed', 'display': 'processed'},
@@ -0,0 +1,183 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test admin paginators."""
+from datetime import date
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from django_pain.admin import BankPaymentAdmin
+from django_pain.admin.paginators import ApproximateCountPaginator, _get_estimate, get_approximate_count
+from django_pain.constants import PaymentState
+from django_pain.models import BankPayment
+from django_pain.tests.utils import get_account, get_payment
+
+
+class TestApproximateCount(TestCase):
+    """Test approximate counting of objects."""
+
+    def setUp(self):
+        account = get_account()
+        account.save()
+        for index in range(3):
+            get_payment(identifier='PAYMENT_{}'.format(index), account=account).save()
+
+    @skipIf(connection.vendor == 'postgresql', 'Requires other database than PostgreSQL.')
+    def test_no_estimate(self):
+        self.assertIsNone(_get_estimate(BankPayment.objects.all()))
+        self.assertEqual(get_approximate_count(BankPayment.objects.all(), threshold=1), 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL database.')
+    def test_estimate(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE django_pain_bankpayment')
+        self.assertEqual(_get_estimate(BankPayment.objects.all()), 3)
+        self.assertIsInstance(_get_estimate(BankPayment.objects.filter(identifier='PAYMENT_1')), int)
+
+    @patch('django_pain.admin.paginators._get_estimate', return_value=1000000)
+    def test_large_estimate(self, estimate_mock):
+        self.assertEqual(get_approximate_count(BankPayment.objects.all()), 1000000)
+
+    @patch('django_pain.admin.paginators._get_estimate', return_value=10)
+    def test_small_estimate(self, estimate_mock):
+        self.assertEqual(get_approximate_count(BankPayment.objects.all()), 3)
+
+    @patch('django_pain.admin.paginators._get_estimate', return_value=1000000)
+    def test_paginator(self, estimate_mock):
+        paginator = ApproximateCountPaginator(BankPayment.objects.order_by('pk'), 2)
+        self.assertEqual(paginator.count, 1000000)
+        self.assertEqual(paginator.num_pages, 500000)
+        self.assertEqual([payment.identifier for payment in paginator.page(1)], ['PAYMENT_0', 'PAYMENT_1'])
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls')
+class TestApproximateCountChangeList(TestCase):
+    """Test change list with approximate counts."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        account = get_account()
+        account.save()
+        get_payment(identifier='PAYMENT_1', account=account, state=PaymentState.PROCESSED,
+                    variable_symbol='VAR1').save()
+        get_payment(identifier='PAYMENT_2', account=account, state=PaymentState.DEFERRED).save()
+
+    def test_exact_count(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:django_pain_bankpayment_changelist'),
+                                   {'state__exact': PaymentState.DEFERRED})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertEqual(response.context['cl'].full_result_count, 2)
+
+    @patch('django_pain.admin.paginators._get_estimate', return_value=1000000)
+    def test_estimated_count(self, estimate_mock):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:django_pain_bankpayment_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 1000000)
+        self.assertEqual(response.context['cl'].full_result_count, 1000000)
+        self.assertContains(response, 'VAR1')
+
+    def test_import_history(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:django_pain_paymentimporthistory_changelist'))
+        self.assertEqual(response.context['cl'].full_result_count, 0)
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls', PAIN_ADMIN_KEYSET_PAGINATION=True)
+@patch.object(BankPaymentAdmin, 'list_per_page', 2)
+class TestKeysetChangeList(TestCase):
+    """Test change list with keyset pagination."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        account = get_account()
+        account.save()
+        transaction_dates = (date(2018, 5, 9), None, date(2018, 5, 10), date(2018, 5, 9), None, date(2018, 5, 8),
+                             date(2018, 5, 9))
+        for index, transaction_date in enumerate(transaction_dates):
+            get_payment(identifier='PAYMENT_{}'.format(index), account=account, transaction_date=transaction_date,
+                        variable_symbol='VAR{}'.format(index)).save()
+        self.expected = ['PAYMENT_4', 'PAYMENT_1', 'PAYMENT_2', 'PAYMENT_6', 'PAYMENT_3', 'PAYMENT_0', 'PAYMENT_5']
+        self.url = reverse('admin:django_pain_bankpayment_changelist')
+
+    def _get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context['cl']
+        self.assertTrue(cl.keyset_pagination)
+        return cl, [payment.identifier for payment in cl.result_list]
+
+    def test_navigation(self):
+        self.client.force_login(self.admin)
+        pages = []
+        cl, identifiers = self._get_page(self.url)
+        self.assertIsNone(cl.previous_page_url)
+        pages.append(identifiers)
+        while cl.next_page_url:
+            cl, identifiers = self._get_page(self.url + cl.next_page_url)
+            self.assertIsNotNone(cl.previous_page_url)
+            pages.append(identifiers)
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual(len(pages), 4)
+
+        while cl.previous_page_url:
+            cl, identifiers = self._get_page(self.url + cl.previous_page_url)
+            self.assertEqual(identifiers, pages[-2])
+            pages.pop()
+        self.assertEqual(len(pages), 1)
+        self.assertIsNotNone(cl.next_page_url)
+
+    def test_links(self):
+        self.client.force_login(self.admin)
+        cl, identifiers = self._get_page(self.url)
+        response = self.client.get(self.url + cl.next_page_url)
+        self.assertContains(response, 'Previous')
+        self.assertContains(response, 'Next')
+        self.assertNotContains(response, '?p=')
+
+    def test_filters(self):
+        self.client.force_login(self.admin)
+        cl, identifiers = self._get_page(self.url + '?q=VAR')
+        self.assertIn('q=VAR', cl.next_page_url)
+        cl, identifiers = self._get_page(self.url + cl.next_page_url)
+        self.assertEqual(identifiers, self.expected[2:4])
+
+    def test_invalid_cursor(self):
+        self.client.force_login(self.admin)
+        for cursor in ('invalid', '2018-05-09_invalid_1', 'invalid_2018-05-09T00:00:00_1', '_2018-05-09T00:00:00_x'):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(self.url, {'after': cursor})
+                self.assertRedirects(response, self.url + '?e=1', fetch_redirect_response=False)
+
+    def test_custom_ordering(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(self.url, {'o': '1'})
+        self.assertFalse(response.context['cl'].keyset_pagination)
+        self.assertContains(response, '?o=1&amp;p=2')
+
+    @override_settings(PAIN_ADMIN_KEYSET_PAGINATION=False)
+    def test_disabled(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(self.url)
+        self.assertFalse(response.context['cl'].keyset_pagination)
+        self.assertContains(response, '?p=2')
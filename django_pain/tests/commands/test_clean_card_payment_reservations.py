@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test clean_card_payment_reservations command."""
+import datetime
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from testfixtures import LogCapture
+
+from django_pain.constants import PaymentState, PaymentType
+from django_pain.models import BankAccount, BankPayment
+from django_pain.tests.utils import get_payment
+
+
+class TestCleanCardPaymentReservations(TestCase):
+    """Test clean_card_payment_reservations command."""
+
+    def setUp(self):
+        self.account = BankAccount(account_number='123456/7890', currency='CZK')
+        self.account.save()
+        now = timezone.now()
+        for identifier, state, age in (('RESERVED_1', PaymentState.RESERVED, 7200),
+                                       ('RESERVED_2', PaymentState.RESERVED, 60),
+                                       ('PAYMENT_1', PaymentState.INITIALIZED, 7200)):
+            payment = get_payment(identifier=identifier, account=self.account, state=state,
+                                  counter_account_number='', payment_type=PaymentType.CARD_PAYMENT,
+                                  card_handler='dummy')
+            payment.save()
+            BankPayment.objects.filter(pk=payment.pk).update(create_time=now - datetime.timedelta(seconds=age))
+
+    def test_clean(self):
+        with LogCapture('django_pain.management.commands.clean_card_payment_reservations') as log_handler:
+            call_command('clean_card_payment_reservations')
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state').order_by('create_time'),
+                                 [('RESERVED_2', PaymentState.RESERVED), ('PAYMENT_1', PaymentState.INITIALIZED)],
+                                 transform=tuple, ordered=False)
+        log_handler.check(
+            ('django_pain.management.commands.clean_card_payment_reservations', 'INFO',
+             'Command clean_card_payment_reservations started.'),
+            ('django_pain.management.commands.clean_card_payment_reservations', 'INFO',
+             'Removed 1 card payment reservation(s).'),
+            ('django_pain.management.commands.clean_card_payment_reservations', 'INFO',
+             'Command clean_card_payment_reservations finished.'),
+        )
+
+    def test_clean_older_than(self):
+        call_command('clean_card_payment_reservations', '--older-than', '30')
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', flat=True), ['PAYMENT_1'])
+
+    def test_invalid_older_than(self):
+        with self.assertRaises(CommandError):
+            call_command('clean_card_payment_reservations', '--older-than', '0')
@@ -18,6 +18,7 @@
 
 """Test import_payments command."""
 import sys
+import threading
 from collections import OrderedDict, namedtuple
 from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
@@ -39,6 +40,7 @@ from testfixtures import LogCapture
 
 from django_pain.management.commands.download_payments import Command as DownloadCommand
 from django_pain.models import BankAccount, BankPayment, PaymentImportHistory
+from django_pain.tests.mixins import CacheResetMixin
 
 try:
     from teller.downloaders import BankStatementDownloader, RawStatement, TellerDownloadError
@@ -118,9 +120,80 @@ class DummyStatementParser(BankStatementParser):
             raise ValueError('Expected DummyStatementDownloader.statement.encoding as encoding.')  # pragma: no cover
 
 
+class ConcurrentStatementDownloader(object):
+    """Downloader which downloads statements only if another downloader is downloading at the same time."""
+
+    barrier = threading.Barrier(2, timeout=5)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def get_statements(self, start_date: datetime, end_date: datetime) -> List[MagicMock]:
+        self.barrier.wait()
+        statement = MagicMock()
+        statement.name = '{}.xml'.format(self.name)
+        return [statement]
+
+
+class EmptyStatementParser(object):
+    """Parser which returns statements without payments."""
+
+    @classmethod
+    def parse_file(cls, source, encoding=None) -> MagicMock:
+        statement = MagicMock()
+        statement.payments = []
+        return statement
+
+
+class TestDownloadPaymentsConcurrently(CacheResetMixin, TestCase):
+    """Test download_payments command with concurrent downloaders."""
+
+    def setUp(self):
+        super().setUp()
+        ConcurrentStatementDownloader.barrier.reset()
+        self.log_handler = LogCapture('django_pain.management.commands.download_payments', propagate=False)
+
+    def tearDown(self):
+        self.log_handler.uninstall()
+
+    def _get_settings(self, name: str):
+        return {'DOWNLOADER': 'django_pain.tests.commands.test_download_payments.ConcurrentStatementDownloader',
+                'PARSER': 'django_pain.tests.commands.test_download_payments.EmptyStatementParser',
+                'DOWNLOADER_PARAMS': {'name': name}}
+
+    def test_download_concurrently(self):
+        with override_settings(PAIN_DOWNLOADERS=OrderedDict([('earth', self._get_settings('earth')),
+                                                             ('mars', self._get_settings('mars'))])):
+            call_command('download_payments', '--no-color', '--max-workers=2')
+
+        self.assertQuerysetEqual(
+            PaymentImportHistory.objects.order_by('pk').values_list('origin', '_filenames', 'errors', 'finished'),
+            [('earth', 'earth.xml', 0, True), ('mars', 'mars.xml', 0, True)],
+            transform=tuple)
+
+    def test_download_error(self):
+        settings = OrderedDict([('earth', self._get_settings('earth')),
+                                ('mars', dict(self._get_settings('mars'), DOWNLOADER_PARAMS={})),
+                                ('pluto', self._get_settings('pluto'))])
+        with override_settings(PAIN_DOWNLOADERS=settings):
+            call_command('download_payments', '--no-color', '--max-workers=3')
+
+        self.assertQuerysetEqual(
+            PaymentImportHistory.objects.order_by('pk').values_list('origin', '_filenames', 'errors', 'finished'),
+            [('earth', 'earth.xml', 0, True), ('mars', None, None, False), ('pluto', 'pluto.xml', 0, True)],
+            transform=tuple)
+        self.log_handler.check_present(
+            ('django_pain.management.commands.download_payments', 'ERROR', 'Could not init Downloader for mars.'))
+
+    def test_invalid_max_workers(self):
+        with override_settings(PAIN_DOWNLOADERS={'earth': self._get_settings('earth')}):
+            with self.assertRaisesRegex(CommandError, 'argument --max-workers: invalid parse_positive_int value'):
+                call_command('download_payments', '--no-color', '--max-workers=0')
+
+
 @skipUnless('teller' in sys.modules, 'Can not run without teller library.')
 @freeze_time("2020-01-09T23:30")
-class DownloadPaymentsTest(TestCase):
+class DownloadPaymentsTest(CacheResetMixin, TestCase):
 
     test_settings = {'DOWNLOADER': 'django_pain.tests.commands.test_download_payments.DummyStatementDownloader',
                      'PARSER': 'django_pain.tests.commands.test_download_payments.DummyStatementParser',
@@ -138,6 +211,7 @@ class DownloadPaymentsTest(TestCase):
             ordered=False)
 
     def setUp(self):
+        super().setUp()
         account = BankAccount(account_number='1234567890/2010', currency='CZK')
         account.save()
         self.account = account
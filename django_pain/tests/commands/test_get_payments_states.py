@@ -28,10 +28,32 @@ from django.db import close_old_connections, transaction
 from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
 from testfixtures import LogCapture
 
+from django_pain.card_payment_handlers import CardPaymentState
 from django_pain.constants import PaymentState
 from django_pain.models import BankAccount, BankPayment
 from django_pain.settings import get_card_payment_handler_class, get_card_payment_handler_instance
-from django_pain.tests.utils import get_payment
+from django_pain.tests.utils import DummyCardPaymentHandler, SynchronousExecutor, get_payment
+
+
+class DummyUpdatingCardPaymentHandler(DummyCardPaymentHandler):
+    """Dummy card payment handler which only updates the payments."""
+
+    supports_payment_state = False
+
+    def update_payments_state(self, payment):
+        """Update payment state."""
+        payment.card_payment_state = 'updated'
+        payment.state = PaymentState.CANCELED
+        payment.save()
+
+
+class DummyConcurrentCardPaymentHandler(DummyCardPaymentHandler):
+    """Dummy card payment handler whose payments are processed while their states are requested."""
+
+    def get_payment_state(self, payment):
+        """Process the payment and return its state."""
+        BankPayment.objects.filter(pk=payment.pk).update(state=PaymentState.PROCESSED)
+        return super().get_payment_state(payment)
 
 
 @override_settings(PAIN_CARD_PAYMENT_HANDLERS={
@@ -140,6 +162,55 @@ class TestGetPaymentsStates(TestCase):
                                   ('PAYMENT_3', PaymentState.INITIALIZED.value)],
                                  transform=tuple)
 
+    def test_threads(self):
+        """Test payments states are requested by several threads and saved in batches."""
+        for index in range(5):
+            get_payment(identifier='PAYMENT_{}'.format(index), account=self.account, state=PaymentState.INITIALIZED,
+                        card_handler='dummy').save()
+
+        call_command('get_card_payments_states', '--threads', '3', '--batch-size', '2')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'card_payment_state', 'state').order_by('identifier'),
+            [('PAYMENT_{}'.format(index), 'paid', PaymentState.READY_TO_PROCESS.value) for index in range(5)],
+            transform=tuple)
+
+    @override_settings(PAIN_CARD_PAYMENT_HANDLERS={
+        'dummy_update': 'django_pain.tests.commands.test_get_payments_states.DummyUpdatingCardPaymentHandler'}
+    )
+    def test_update_by_handler(self):
+        """Test payments of handlers which can't only get the state are updated by the handler."""
+        get_payment(identifier='PAYMENT_1', account=self.account, state=PaymentState.INITIALIZED,
+                    card_handler='dummy_update').save()
+
+        with patch('django_pain.management.commands.get_card_payments_states.ThreadPoolExecutor') as executor_mock:
+            call_command('get_card_payments_states')
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'card_payment_state', 'state'),
+                                 [('PAYMENT_1', 'updated', PaymentState.CANCELED.value)], transform=tuple)
+        # No states are requested, so no threads are started.
+        executor_mock.assert_not_called()
+
+    @override_settings(PAIN_CARD_PAYMENT_HANDLERS={
+        'dummy_concurrent': 'django_pain.tests.commands.test_get_payments_states.DummyConcurrentCardPaymentHandler'}
+    )
+    @patch('django_pain.management.commands.get_card_payments_states.ThreadPoolExecutor', SynchronousExecutor)
+    def test_changed_payments_not_overwritten(self):
+        """Test payments changed while their states are requested are not overwritten."""
+        get_payment(identifier='PAYMENT_1', account=self.account, state=PaymentState.INITIALIZED,
+                    card_handler='dummy_concurrent').save()
+
+        call_command('get_card_payments_states')
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'card_payment_state', 'state'),
+                                 [('PAYMENT_1', '', PaymentState.PROCESSED.value)], transform=tuple)
+
+    def test_invalid_threads(self):
+        with self.assertRaises(CommandError):
+            call_command('get_card_payments_states', '--threads', '0')
+        with self.assertRaises(CommandError):
+            call_command('get_card_payments_states', '--batch-size', '0')
+
     def test_invalid_from_to_raises_exception(self):
         with self.assertRaises(CommandError):
             call_command('get_card_payments_states', '--from', '2009-01-32 00:00', '--to', '2017-02-01 00:00')
@@ -228,11 +299,10 @@ class TestGetPaymentsStatesLocking(TransactionTestCase):
         p1.save()
         p2.save()
 
-        def mock_update_state(payment):
+        def mock_get_state(payment):
             processing_started.set()
             query_finished.wait()
-            payment.state = PaymentState.READY_TO_PROCESS
-            payment.save()
+            return CardPaymentState('paid', PaymentState.READY_TO_PROCESS)
 
         def target_processing():
             try:
@@ -241,7 +311,7 @@ class TestGetPaymentsStatesLocking(TransactionTestCase):
                 get_card_payment_handler_class.cache_clear()
                 with patch('django_pain.tests.utils.DummyCardPaymentHandler') as MockClass:
                     instance = MockClass.return_value
-                    instance.update_payments_state = mock_update_state
+                    instance.get_payment_state = mock_get_state
                     call_command('get_card_payments_states', '--from', datetime.datetime(2018, 5, 1))
             except Exception as e:  # pragma: no cover
                 self.errors.put(e)
@@ -276,6 +346,6 @@ class TestGetPaymentsStatesLocking(TransactionTestCase):
 
         self.assertTrue(self.errors.empty())
         self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state').order_by('identifier'),
-                                 [('PAYMENT_1', PaymentState.READY_TO_PROCESS.value),
+                                 [('PAYMENT_1', PaymentState.PROCESSED.value),
                                   ('PAYMENT_2', PaymentState.PROCESSED.value)],
                                  transform=tuple)
@@ -18,10 +18,11 @@
 
 """Test import_payments command."""
 from collections import namedtuple
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 from io import StringIO
 from typing import List, Optional, Tuple, cast
+from unittest.mock import patch
 
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
@@ -31,9 +32,11 @@ from djmoney.money import Money
 from freezegun import freeze_time
 from testfixtures import LogCapture, TempDirectory
 
+from django_pain.management.commands.import_payments import Command
 from django_pain.models import BankAccount, BankPayment, PaymentImportHistory
 from django_pain.parsers import AbstractBankStatementParser
-from django_pain.tests.utils import get_payment
+from django_pain.tests.mixins import CacheResetMixin
+from django_pain.tests.utils import SynchronousExecutor, get_payment
 
 
 def modify_payment_callback(payment: BankPayment) -> Optional[BankPayment]:
@@ -49,6 +52,12 @@ def raise_exception_callback(payment: BankPayment) -> Optional[BankPayment]:
     raise ValidationError('Raised by callback')
 
 
+def duplicate_uuid_callback(payment: BankPayment) -> Optional[BankPayment]:
+    if payment.identifier == 'PAYMENT_2':
+        payment.uuid = BankPayment.objects.get(identifier='EXISTING').uuid
+    return payment
+
+
 class DummyPaymentsParser(AbstractBankStatementParser):
     """Simple parser that just returns two fixed payments."""
 
@@ -60,6 +69,20 @@ class DummyPaymentsParser(AbstractBankStatementParser):
         ]
 
 
+class DummyDuplicatesParser(AbstractBankStatementParser):
+    """Simple parser that returns fixed payments including duplicates."""
+
+    def parse(self, bank_statement) -> List[BankPayment]:
+        account = BankAccount.objects.get(account_number='123456/7890')
+        return [
+            get_payment(identifier='PAYMENT_1', account=account),
+            get_payment(identifier='PAYMENT_2', account=account),
+            get_payment(identifier='PAYMENT_1', account=account),
+            get_payment(identifier='PAYMENT_3', account=account),
+            get_payment(identifier='PAYMENT_4', account=account),
+        ]
+
+
 class DummyExceptionParser(AbstractBankStatementParser):
     """Simple parser that just throws account not exist exception."""
 
@@ -68,7 +91,7 @@ class DummyExceptionParser(AbstractBankStatementParser):
 
 
 @freeze_time("2020-01-09T23:30")
-class TestImportPayments(TestCase):
+class TestImportPayments(CacheResetMixin, TestCase):
     """Test import_payments command."""
 
     fake_date = datetime(2020, 1, 9, 23, 30)
@@ -82,6 +105,7 @@ class TestImportPayments(TestCase):
             ordered=False)
 
     def setUp(self):
+        super().setUp()
         account = BankAccount(account_number='123456/7890', currency='CZK')
         account.save()
         self.account = account
@@ -122,6 +146,65 @@ class TestImportPayments(TestCase):
             ('django_pain.management.commands.import_payments', 'INFO', 'Command import_payments finished.'),
         )
 
+    def test_duplicates(self):
+        """Test duplicate payments within the input and in database are skipped."""
+        get_payment(identifier='PAYMENT_3', account=self.account).save()
+        out = StringIO()
+        call_command('import_payments',
+                     '--parser=django_pain.tests.commands.test_import_payments.DummyDuplicatesParser',
+                     '--no-color', '--verbosity=3', stdout=out)
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', flat=True),
+                                 ['PAYMENT_1', 'PAYMENT_2', 'PAYMENT_3', 'PAYMENT_4'], ordered=False)
+        self.assertEqual(out.getvalue().strip().split('\n'), [
+            'Payment ID PAYMENT_1 has been imported.',
+            'Payment ID PAYMENT_2 has been imported.',
+            'Payment ID PAYMENT_1 was skipped.',
+            'Payment ID PAYMENT_3 was skipped.',
+            'Payment ID PAYMENT_4 has been imported.',
+        ])
+        self.assertEqual(PaymentImportHistory.objects.values_list('imported', 'skipped', 'errors').get(),
+                         (3, 2, 0))
+
+    def test_number_of_queries(self):
+        """Test existing payments are looked up by a single query."""
+        command = Command()
+        command.options = {'verbosity': 0}
+        payments = DummyDuplicatesParser().parse(None)
+        get_payment(identifier='PAYMENT_3', account=self.account).save()
+        # Query for existing payments and insert wrapped in a savepoint for each saved payment.
+        with self.assertNumQueries(10):
+            result = command.save_payments(payments)
+
+        self.assertEqual(result, (3, 2, 0))
+
+    @patch('django_pain.management.command_mixins.EXISTING_PAYMENTS_CHUNK_SIZE', 2)
+    def test_existing_payments_in_chunks(self):
+        """Test existing payments are looked up in chunks of identifiers for each account."""
+        other_account = BankAccount.objects.create(account_number='987654/3210', currency='CZK')
+        for identifier in ('PAYMENT_1', 'PAYMENT_3', 'PAYMENT_4'):
+            get_payment(identifier=identifier, account=self.account).save()
+        get_payment(identifier='PAYMENT_2', account=other_account).save()
+        payments = [get_payment(identifier='PAYMENT_{}'.format(i), account=account)
+                    for account in (self.account, other_account) for i in range(1, 6)]
+
+        # Three chunks of identifiers for each account.
+        with self.assertNumQueries(6):
+            existing = Command._get_existing_payments(payments)
+
+        self.assertEqual(existing, {(self.account.pk, 'PAYMENT_1'), (self.account.pk, 'PAYMENT_3'),
+                                    (self.account.pk, 'PAYMENT_4'), (other_account.pk, 'PAYMENT_2')})
+
+    def test_import_history_timings(self):
+        """Test durations of the import stages are saved in the import history."""
+        call_command('import_payments', '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                     '--no-color', '--verbosity=0')
+
+        import_history = PaymentImportHistory.objects.get()
+        self.assertEqual(import_history.duration, timedelta(0))
+        self.assertEqual(sorted(import_history.timings.keys()),
+                         ['callbacks', 'deduplicate', 'parse', 'save', 'validate'])
+
     def test_account_not_exist(self):
         """Test command while account does not exist."""
         with self.assertRaises(CommandError) as cm:
@@ -148,6 +231,9 @@ class TestImportPayments(TestCase):
 
         self.assertImportHistory(self.ImportHistoryRow('transproc', self.fake_date, '-', 0, True),
                                  self.ImportHistoryRow('transproc', self.fake_date, '-', 0, True))
+        self.assertQuerysetEqual(
+            PaymentImportHistory.objects.order_by('pk').values_list('imported', 'skipped', 'errors'),
+            [(2, 0, 0), (0, 2, 0)], transform=tuple)
 
         self.log_handler.check(
             ('django_pain.management.commands.import_payments', 'INFO', 'Command import_payments started.'),
@@ -312,3 +398,201 @@ class TestImportPayments(TestCase):
             ('django_pain.management.commands.import_payments', 'INFO',
                 "File non_existent_file could not be open: [Errno 2] No such file or directory: 'non_existent_file'."),
         )
+
+
+@freeze_time("2020-01-09T23:30")
+@patch('django_pain.utils.ProcessPoolExecutor', SynchronousExecutor)
+class TestImportPaymentsInParallel(CacheResetMixin, TestCase):
+    """Test import_payments command with multiple jobs."""
+
+    def setUp(self):
+        super().setUp()
+        self.account = BankAccount.objects.create(account_number='123456/7890', currency='CZK')
+
+    def test_import_payments(self):
+        with TempDirectory() as d:
+            first = d.write('first.xml', b'<whatever></whatever>')
+            second = d.write('second.xml', b'<whatever></whatever>')
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyDuplicatesParser',
+                         '--no-color', '--verbosity=0', '--jobs=2', first, second)
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', flat=True),
+                                 ['PAYMENT_1', 'PAYMENT_2', 'PAYMENT_3', 'PAYMENT_4'], ordered=False)
+        self.assertQuerysetEqual(
+            PaymentImportHistory.objects.order_by('pk').values_list('_filenames', 'errors', 'finished'),
+            [(first, 0, True), (second, 0, True)],
+            transform=tuple)
+
+    def test_file_not_found(self):
+        with TempDirectory() as d:
+            first = d.write('first.xml', b'<whatever></whatever>')
+            with self.assertRaisesMessage(CommandError, "No such file or directory: 'non_existent_file'"):
+                call_command('import_payments',
+                             '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                             '--no-color', '--jobs=2', first, 'non_existent_file')
+
+        self.assertQuerysetEqual(
+            PaymentImportHistory.objects.order_by('pk').values_list('_filenames', 'errors', 'finished'),
+            [(first, 0, True), ('non_existent_file', None, False)],
+            transform=tuple)
+
+    def test_account_not_exist(self):
+        with TempDirectory() as d:
+            first = d.write('first.xml', b'<whatever></whatever>')
+            with self.assertRaisesMessage(CommandError, 'Bank account ACCOUNT does not exist.'):
+                call_command('import_payments',
+                             '--parser=django_pain.tests.commands.test_import_payments.DummyExceptionParser',
+                             '--no-color', '--jobs=2', first)
+
+        self.assertQuerysetEqual(PaymentImportHistory.objects.values_list('_filenames', 'errors', 'finished'),
+                                 [(first, 1, False)], transform=tuple)
+
+    def test_standard_input(self):
+        with self.assertRaisesMessage(CommandError, 'Standard input can not be imported in parallel.'):
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                         '--no-color', '--jobs=2')
+        self.assertFalse(PaymentImportHistory.objects.exists())
+
+
+@freeze_time("2020-01-09T23:30")
+class TestImportPaymentsInChunks(CacheResetMixin, TestCase):
+    """Test import_payments command with chunk size set."""
+
+    def setUp(self):
+        super().setUp()
+        self.account = BankAccount.objects.create(account_number='123456/7890', currency='CZK')
+        self.log_handler = LogCapture('django_pain.management.command_mixins', propagate=False)
+
+    def tearDown(self):
+        self.log_handler.uninstall()
+
+    def test_import_payments(self):
+        out = StringIO()
+        call_command('import_payments', '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                     '--no-color', '--verbosity=3', '--chunk-size=10', stdout=out)
+
+        self.assertEqual(out.getvalue().strip().split('\n'), [
+            'Payment ID PAYMENT_1 has been imported.',
+            'Payment ID PAYMENT_2 has been imported.',
+        ])
+        self.assertQuerysetEqual(BankPayment.objects.values_list(
+            'identifier', 'account', 'counter_account_number', 'transaction_date', 'amount', 'amount_currency',
+            'variable_symbol', 'create_time',
+        ), [
+            ('PAYMENT_1', self.account.pk, '098765/4321', date(2018, 5, 9), Decimal('42.00'), 'CZK', '1234',
+             datetime(2020, 1, 9, 23, 30)),
+            ('PAYMENT_2', self.account.pk, '098765/4321', date(2018, 5, 9), Decimal('370.00'), 'CZK', '',
+             datetime(2020, 1, 9, 23, 30)),
+        ], transform=tuple, ordered=False)
+        self.log_handler.check()
+
+    def test_number_of_queries(self):
+        parser = DummyDuplicatesParser()
+        command = Command()
+        command.options = {'verbosity': 0}
+        payments = parser.parse(None)
+        get_payment(identifier='PAYMENT_3', account=self.account).save()
+        # Query for existing payments and insert wrapped in a savepoint for each chunk.
+        with self.assertNumQueries(8):
+            result = command.save_payments(payments, chunk_size=3)
+
+        self.assertEqual(result, (3, 2, 0))
+
+    def test_duplicates(self):
+        get_payment(identifier='PAYMENT_3', account=self.account).save()
+        out = StringIO()
+        call_command('import_payments',
+                     '--parser=django_pain.tests.commands.test_import_payments.DummyDuplicatesParser',
+                     '--no-color', '--verbosity=3', '--chunk-size=2', stdout=out)
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', flat=True),
+                                 ['PAYMENT_1', 'PAYMENT_2', 'PAYMENT_3', 'PAYMENT_4'], ordered=False)
+        self.assertEqual(out.getvalue().strip().split('\n'), [
+            'Payment ID PAYMENT_1 has been imported.',
+            'Payment ID PAYMENT_2 has been imported.',
+            'Payment ID PAYMENT_1 was skipped.',
+            'Payment ID PAYMENT_3 was skipped.',
+            'Payment ID PAYMENT_4 has been imported.',
+        ])
+        self.log_handler.check(
+            ('django_pain.management.command_mixins', 'INFO', 'Payment ID PAYMENT_1 already exists - skipping.'),
+            ('django_pain.management.command_mixins', 'INFO', 'Payment ID PAYMENT_3 already exists - skipping.'),
+            ('django_pain.management.command_mixins', 'INFO', 'Skipped 2 payments.'),
+        )
+
+    def test_import_callback_exception(self):
+        err = StringIO()
+        with override_settings(PAIN_IMPORT_CALLBACKS=[
+                'django_pain.tests.commands.test_import_payments.raise_exception_callback']):
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                         '--no-color', '--chunk-size=10', stderr=err)
+
+        self.assertFalse(BankPayment.objects.exists())
+        self.assertEqual(PaymentImportHistory.objects.get().errors, 2)
+        self.assertEqual(err.getvalue().strip().split('\n'), [
+            'Payment ID PAYMENT_1 has not been saved due to the following errors:',
+            'Raised by callback',
+            'Payment ID PAYMENT_2 has not been saved due to the following errors:',
+            'Raised by callback',
+        ])
+
+    def test_integrity_error(self):
+        get_payment(identifier='EXISTING', account=self.account).save()
+        err = StringIO()
+        with override_settings(PAIN_IMPORT_CALLBACKS=[
+                'django_pain.tests.commands.test_import_payments.duplicate_uuid_callback']):
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                         '--no-color', '--chunk-size=10', stderr=err)
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', flat=True),
+                                 ['EXISTING', 'PAYMENT_1'], ordered=False)
+        self.assertEqual(PaymentImportHistory.objects.get().errors, 1)
+        self.assertEqual(err.getvalue().strip().split('\n')[0],
+                         'Payment ID PAYMENT_2 has not been saved due to the following errors:')
+
+    def test_import_from_file(self):
+        xml_input = '''<?xml version="1.0" encoding="UTF-8"?>
+            <statements><statement>
+                <account_number>123456</account_number><account_bank_code>7890</account_bank_code>
+                <items>
+                    <item>
+                        <ident>111</ident><account_number>42</account_number><account_bank_code>0123</account_bank_code>
+                        <const_symbol/><var_symbol/><spec_symbol/><price>100.00</price><memo>Žluťoučký</memo>
+                        <date>2012-12-20</date><name/>
+                    </item>
+                    <item>
+                        <ident>222</ident><account_number>42</account_number><account_bank_code>0123</account_bank_code>
+                        <const_symbol/><var_symbol/><spec_symbol/><price>200.00</price><memo/>
+                        <date>2012-12-21</date><name/>
+                    </item>
+                </items>
+            </statement></statements>'''.encode()
+        with TempDirectory() as d:
+            d.write('input_file.xml', xml_input)
+            call_command('import_payments', '--parser=django_pain.parsers.transproc.TransprocXMLParser',
+                         '--no-color', '--verbosity=0', '--chunk-size=1', '/'.join([d.path, 'input_file.xml']))
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'amount', 'description'), [
+            ('111', Decimal('100.00'), 'Žluťoučký'),
+            ('222', Decimal('200.00'), ''),
+        ], transform=tuple, ordered=False)
+        self.assertEqual(PaymentImportHistory.objects.get().errors, 0)
+
+    def test_account_not_exist(self):
+        with self.assertRaises(CommandError) as cm:
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyExceptionParser', '--no-color',
+                         '--chunk-size=10')
+
+        self.assertEqual(str(cm.exception), 'Bank account ACCOUNT does not exist.')
+        self.assertEqual(PaymentImportHistory.objects.get().errors, 1)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(CommandError):
+            call_command('import_payments',
+                         '--parser=django_pain.tests.commands.test_import_payments.DummyPaymentsParser',
+                         '--no-color', '--chunk-size=0')
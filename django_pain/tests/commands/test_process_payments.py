@@ -22,7 +22,7 @@ import fcntl
 import os
 import threading
 from collections import OrderedDict
-from datetime import date
+from datetime import date, datetime
 from io import StringIO
 from queue import Queue
 from typing import cast
@@ -30,17 +30,20 @@ from unittest.mock import patch
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.db import close_old_connections, transaction
+from django.db import close_old_connections, connection, transaction
 from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from testfixtures import LogCapture, TempDirectory
 
 from django_pain.constants import PaymentProcessingError, PaymentState, PaymentType
+from django_pain.locks import FileLock, LockError
 from django_pain.models import BankAccount, BankPayment
-from django_pain.processors import PaymentProcessorError, ProcessPaymentResult
+from django_pain.processors import PaymentProcessorError, PaymentSnapshot, ProcessPaymentResult
 from django_pain.settings import SETTINGS, get_processor_class, get_processor_instance
 from django_pain.tests.mixins import CacheResetMixin
-from django_pain.tests.utils import DummyPaymentProcessor, get_payment
+from django_pain.tests.test_metrics import DummyMetricsBackend
+from django_pain.tests.utils import DummyPaymentProcessor, SynchronousExecutor, get_payment
 
 
 class DummyTruePaymentProcessor(DummyPaymentProcessor):
@@ -77,6 +80,24 @@ class DummyFalseErrorPaymentProcessor(DummyPaymentProcessor):
             yield ProcessPaymentResult(result=False, error=PaymentProcessingError.DUPLICITY)
 
 
+class DummySnapshotPaymentProcessor(DummyPaymentProcessor):
+    """Simple processor that accepts only payment snapshots."""
+
+    def process_payments(self, payments):
+        for payment in payments:
+            yield ProcessPaymentResult(result=isinstance(payment, PaymentSnapshot))
+
+
+class DummyCrashingPaymentProcessor(DummyPaymentProcessor):
+    """Simple processor that accepts payments until it crashes on PAYMENT_CRASH."""
+
+    def process_payments(self, payments):
+        for payment in payments:
+            if payment.identifier == 'PAYMENT_CRASH':
+                raise RuntimeError('Crash!')
+            yield ProcessPaymentResult(result=True)
+
+
 class DummyBrokenProcessor(DummyPaymentProcessor):
     """Simple processor that rises error every time it is called."""
 
@@ -88,6 +109,21 @@ class DummyBrokenProcessor(DummyPaymentProcessor):
         raise PaymentProcessorError('It is broken!')
 
 
+class DummyHeldLock(FileLock):
+    """Lock which is always held by someone else."""
+
+    def acquire(self, shared=False):
+        return False
+
+
+class DummyUnreleasableLock(FileLock):
+    """Lock which can't be released."""
+
+    def release(self):
+        super().release()
+        raise LockError('Lock is stuck')
+
+
 @skipUnlessDBFeature('has_select_for_update')
 class TestProcessPaymentsLocks(CacheResetMixin, TransactionTestCase):
 
@@ -617,3 +653,249 @@ class TestProcessPayments(CacheResetMixin, TestCase):
                  'Marking 0 unprocessed payments as DEFERRED.'),
                 ('django_pain.management.commands.process_payments', 'INFO', 'Command process_payments finished.'),
             )
+
+    @override_settings(PAIN_PROCESSORS=OrderedDict([
+        ('dummy_error', 'django_pain.tests.commands.test_process_payments.DummyFalseErrorPaymentProcessor'),
+        ('dummy', 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'),
+    ]))
+    def test_payments_saved_in_batches(self):
+        """Test payments are saved in batches."""
+        get_payment(identifier='PAYMENT_2', account=self.account, state=PaymentState.DEFERRED).save()
+        get_payment(identifier='PAYMENT_3', account=self.account, state=PaymentState.READY_TO_PROCESS).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            with CaptureQueriesContext(connection) as queries:
+                call_command('process_payments', '--update-batch-size', '2')
+
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        for update in updates:
+            self.assertNotIn('"description"', update)
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state', 'processor', 'processing_error'),
+            [('PAYMENT_1', PaymentState.DEFERRED, 'dummy_error', PaymentProcessingError.DUPLICITY),
+             ('PAYMENT_2', PaymentState.DEFERRED, 'dummy_error', PaymentProcessingError.DUPLICITY),
+             ('PAYMENT_3', PaymentState.DEFERRED, 'dummy_error', PaymentProcessingError.DUPLICITY)],
+            transform=tuple, ordered=False)
+
+    def test_invalid_update_batch_size(self):
+        with self.assertRaises(CommandError):
+            call_command('process_payments', '--update-batch-size', '0')
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'},
+        PAIN_METRICS_BACKENDS={'dummy': {'BACKEND': 'django_pain.tests.test_metrics.DummyMetricsBackend',
+                                         'PARAMS': {}}})
+    def test_metrics_reported(self):
+        """Test metrics of the run are reported."""
+        DummyMetricsBackend.reported = []
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments')
+
+        metrics, = DummyMetricsBackend.reported
+        self.assertEqual(metrics.command, 'process_payments')
+        self.assertEqual(set(metrics.timings.keys()), {'select', 'process.dummy', 'save'})
+        self.assertEqual(metrics.counts, {'process.dummy': 1, 'save': 1})
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummySnapshotPaymentProcessor'})
+    def test_payments_snapshots(self):
+        """Test processors get payment snapshots."""
+        get_payment(identifier='PAYMENT_2', account=self.account, state=PaymentState.READY_TO_PROCESS).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            with CaptureQueriesContext(connection) as queries:
+                call_command('process_payments')
+
+        # Accounts of the payments are not fetched one by one.
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('SELECT') and 'django_pain_bankpayment' not in query['sql']])
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state'),
+                                 [('PAYMENT_1', PaymentState.PROCESSED), ('PAYMENT_2', PaymentState.PROCESSED)],
+                                 transform=tuple, ordered=False)
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummySnapshotPaymentProcessor'},
+        PAIN_PROCESSORS_DEEPCOPY_PAYMENTS=True)
+    def test_payments_deepcopy(self):
+        """Test processors get payment copies if required."""
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments')
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state'),
+                                 [('PAYMENT_1', PaymentState.DEFERRED)], transform=tuple)
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyFalsePaymentProcessor'})
+    def test_payments_in_batches(self):
+        """Test payments are processed in batches."""
+        get_payment(identifier='PAYMENT_2', account=self.account, transaction_date=None).save()
+        get_payment(identifier='PAYMENT_3', account=self.account, transaction_date=None).save()
+        get_payment(identifier='PAYMENT_4', account=self.account, transaction_date=date(2018, 5, 10),
+                    state=PaymentState.DEFERRED).save()
+        get_payment(identifier='PAYMENT_5', account=self.account, state=PaymentState.PROCESSED).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments', '--batch-size', '3')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state'),
+            [('PAYMENT_1', PaymentState.DEFERRED), ('PAYMENT_2', PaymentState.DEFERRED),
+             ('PAYMENT_3', PaymentState.DEFERRED), ('PAYMENT_4', PaymentState.DEFERRED),
+             ('PAYMENT_5', PaymentState.PROCESSED)],
+            transform=tuple, ordered=False)
+        self.log_handler.check(
+            ('django_pain.management.commands.process_payments', 'INFO', 'Command process_payments started.'),
+            ('django_pain.management.commands.process_payments', 'INFO', 'Lock acquired.'),
+            ('django_pain.management.commands.process_payments', 'INFO',
+                'Processing batch of 3 unprocessed payments.'),
+            ('django_pain.management.commands.process_payments', 'INFO', 'Processing payments with processor dummy.'),
+            ('django_pain.management.commands.process_payments', 'INFO',
+                'Marking 3 unprocessed payments as DEFERRED.'),
+            ('django_pain.management.commands.process_payments', 'INFO',
+                'Processing batch of 1 unprocessed payments.'),
+            ('django_pain.management.commands.process_payments', 'INFO', 'Processing payments with processor dummy.'),
+            ('django_pain.management.commands.process_payments', 'INFO',
+                'Marking 1 unprocessed payments as DEFERRED.'),
+            ('django_pain.management.commands.process_payments', 'INFO', 'Command process_payments finished.'),
+        )
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyCrashingPaymentProcessor'})
+    def test_payments_in_batches_crash(self):
+        """Test processed batches are kept if the command crashes."""
+        get_payment(identifier='PAYMENT_2', account=self.account, transaction_date=date(2018, 5, 10)).save()
+        get_payment(identifier='PAYMENT_CRASH', account=self.account, transaction_date=date(2018, 5, 11)).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            with self.assertRaisesRegex(RuntimeError, 'Crash!'):
+                call_command('process_payments', '--batch-size', '2')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state'),
+            [('PAYMENT_1', PaymentState.PROCESSED), ('PAYMENT_2', PaymentState.PROCESSED),
+             ('PAYMENT_CRASH', PaymentState.READY_TO_PROCESS)],
+            transform=tuple, ordered=False)
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyCrashingPaymentProcessor'},
+        PAIN_LOCK_BACKEND='django_pain.tests.commands.test_process_payments.DummyUnreleasableLock')
+    def test_release_error_does_not_mask_crash(self):
+        """Test errors of releasing the lock are logged, the original error is raised."""
+        get_payment(identifier='PAYMENT_CRASH', account=self.account, transaction_date=date(2018, 5, 11)).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            with self.assertRaisesRegex(RuntimeError, 'Crash!'):
+                call_command('process_payments')
+
+        self.assertIn(('django_pain.management.commands.process_payments', 'ERROR',
+                       'Lock process_payments could not be released: Lock is stuck'), self.log_handler.actual())
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(CommandError):
+            call_command('process_payments', '--batch-size', '0')
+
+    @freeze_time('2018-01-01 12:00')
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyFalsePaymentProcessor'},
+        PAIN_PROCESSING_RETRY_DELAY=3600)
+    def test_payments_retry_delay(self):
+        """Test deferred payments are not processed before their next processing time."""
+        get_payment(identifier='PAYMENT_2', account=self.account, state=PaymentState.DEFERRED, processing_attempts=1,
+                    next_processing_time=datetime(2018, 1, 1, 12, 30)).save()
+        get_payment(identifier='PAYMENT_3', account=self.account, state=PaymentState.DEFERRED, processing_attempts=1,
+                    next_processing_time=datetime(2018, 1, 1, 11, 30)).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state', 'processing_attempts', 'next_processing_time'),
+            [('PAYMENT_1', PaymentState.DEFERRED, 1, datetime(2018, 1, 1, 13)),
+             ('PAYMENT_2', PaymentState.DEFERRED, 1, datetime(2018, 1, 1, 12, 30)),
+             ('PAYMENT_3', PaymentState.DEFERRED, 2, datetime(2018, 1, 1, 14))],
+            transform=tuple, ordered=False)
+
+    @freeze_time('2018-01-01 12:00')
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+    def test_processed_payments_not_scheduled(self):
+        """Test next processing time applies to deferred payments only and is cleared once they are processed."""
+        get_payment(identifier='PAYMENT_2', account=self.account, state=PaymentState.DEFERRED, processing_attempts=1,
+                    next_processing_time=datetime(2018, 1, 1, 11, 30)).save()
+        # Payments ready to process are processed regardless of a stale processing time.
+        BankPayment.objects.filter(identifier='PAYMENT_1').update(next_processing_time=datetime(2018, 1, 1, 12, 30))
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state', 'next_processing_time'),
+            [('PAYMENT_1', PaymentState.PROCESSED, None), ('PAYMENT_2', PaymentState.PROCESSED, None)],
+            transform=tuple, ordered=False)
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+    @patch('django_pain.utils.ProcessPoolExecutor', SynchronousExecutor)
+    def test_payments_in_workers(self):
+        """Test payments are split between workers by accounts."""
+        for number in range(2, 4):
+            account = BankAccount.objects.create(account_number='{0}{0}/7890'.format(number), currency='CZK')
+            get_payment(identifier='PAYMENT_{}'.format(number), account=account).save()
+        get_payment(identifier='PAYMENT_4', account=account).save()
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            call_command('process_payments', '--workers', '2')
+
+        self.assertQuerysetEqual(
+            BankPayment.objects.values_list('identifier', 'state'),
+            [('PAYMENT_1', PaymentState.PROCESSED), ('PAYMENT_2', PaymentState.PROCESSED),
+             ('PAYMENT_3', PaymentState.PROCESSED), ('PAYMENT_4', PaymentState.PROCESSED)],
+            transform=tuple, ordered=False)
+        messages = [record[2] for record in self.log_handler.actual()]
+        self.assertIn('Processing payments of 3 accounts in 2 workers.', messages)
+        # One account is processed by the first worker, the other two by the second.
+        self.assertEqual(messages.count('Processing 1 unprocessed payments.'), 1)
+        self.assertEqual(messages.count('Processing 3 unprocessed payments.'), 1)
+
+    def test_account_lock(self):
+        """Test runs restricted to included accounts lock the accounts."""
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            lock = open(SETTINGS.process_payments_lock_file, 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            account_lock = open(SETTINGS.process_payments_lock_file + '.123456_7890', 'a')
+            fcntl.flock(account_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            out = StringIO()
+            err = StringIO()
+            call_command('process_payments', '--no-color', '--include-accounts', '123456/7890', stdout=out, stderr=err)
+            lock.close()
+            account_lock.close()
+
+        self.assertEqual(err.getvalue(),
+                         'Command process_payments is already running for some of the accounts. Terminating.\n')
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state'),
+                                 [('PAYMENT_1', PaymentState.READY_TO_PROCESS)], transform=tuple)
+        self.log_handler.check(
+            ('django_pain.management.commands.process_payments', 'INFO', 'Command process_payments started.'),
+            ('django_pain.management.commands.process_payments', 'INFO', 'Lock acquired.'),
+            ('django_pain.management.commands.process_payments', 'WARNING',
+             'Command already running for some of the accounts. Terminating.'),
+        )
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+    def test_account_lock_concurrent(self):
+        """Test runs restricted to different accounts may run concurrently."""
+        with override_settings(PAIN_PROCESS_PAYMENTS_LOCK_FILE=os.path.join(cast(str, self.tempdir.path), 'test.lock')):
+            lock = open(SETTINGS.process_payments_lock_file, 'a')
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            account_lock = open(SETTINGS.process_payments_lock_file + '.987654_3210', 'a')
+            fcntl.flock(account_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            call_command('process_payments', '--include-accounts', '123456/7890')
+            lock.close()
+            account_lock.close()
+
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state'),
+                                 [('PAYMENT_1', PaymentState.PROCESSED)], transform=tuple)
+
+    @override_settings(PAIN_LOCK_BACKEND='django_pain.tests.commands.test_process_payments.DummyHeldLock')
+    def test_lock_backend(self):
+        """Test process payments uses configured lock backend."""
+        err = StringIO()
+        call_command('process_payments', '--no-color', stderr=err)
+
+        self.assertEqual(err.getvalue(), 'Command process_payments is already running. Terminating.\n')
+        self.assertQuerysetEqual(BankPayment.objects.values_list('identifier', 'state'),
+                                 [('PAYMENT_1', PaymentState.READY_TO_PROCESS)], transform=tuple)
@@ -17,7 +17,9 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Test mixins."""
+from django_pain.accounts import BANK_ACCOUNTS
 from django_pain.import_callbacks import _get_ignore_processor_name
+from django_pain.metrics import get_metrics_backends
 from django_pain.settings import (get_card_payment_handler_class, get_card_payment_handler_instance,
                                   get_processor_class, get_processor_instance, get_processor_objective)
 
@@ -34,3 +36,6 @@ class CacheResetMixin(object):
         get_card_payment_handler_class.cache_clear()
         get_card_payment_handler_instance.cache_clear()
         _get_ignore_processor_name.cache_clear()
+        get_metrics_backends.cache_clear()
+        # Accounts rolled back by tests are not removed by signals.
+        BANK_ACCOUNTS.clear()
@@ -18,16 +18,17 @@
 
 """Test TransprocXMLParser."""
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 
 from django.test import TestCase, override_settings
 from djmoney.money import Money
 
 from django_pain.models import BankAccount
 from django_pain.parsers.transproc import TransprocXMLParser
+from django_pain.tests.mixins import CacheResetMixin
 
 
-class TestTransprocXMLParser(TestCase):
+class TestTransprocXMLParser(CacheResetMixin, TestCase):
     """Test FioXMLParser."""
 
     XML_INPUT = b'''<?xml version="1.0" encoding="UTF-8"?>
@@ -132,3 +133,24 @@ class TestTransprocXMLParser(TestCase):
         with self.assertRaisesRegex(BankAccount.DoesNotExist, 'Bank account 123456789/0123 does not exist.'):
             output = parser.parse(BytesIO(self.XML_INPUT))
             next(output)
+
+    def test_parse_text_stream(self):
+        BankAccount.objects.create(account_number='123456789/0123', currency='CZK')
+        parser = TransprocXMLParser()
+        payments = list(parser.parse(TextIOWrapper(BytesIO(self.XML_INPUT), encoding='utf-8')))
+        self.assertEqual([payment.identifier for payment in payments], ['111'])
+
+    def test_parse_multiple_items(self):
+        BankAccount.objects.create(account_number='123456789/0123', currency='CZK')
+        items = self.XML_INPUT.split(b'<items>')[1].split(b'</items>')[0]
+        xml_input = self.XML_INPUT.replace(items, items * 3)
+        parser = TransprocXMLParser()
+        payments = list(parser.parse(BytesIO(xml_input)))
+        self.assertEqual([payment.identifier for payment in payments], ['111', '111', '111'])
+
+    def test_parse_items_before_account(self):
+        xml_input = self.XML_INPUT.replace(b'<account_number>123456789</account_number>', b'')
+        xml_input = xml_input.replace(b'</items>', b'</items><account_number>123456789</account_number>')
+        parser = TransprocXMLParser()
+        with self.assertRaisesRegex(ValueError, 'Bank statement items precede its account number.'):
+            list(parser.parse(BytesIO(xml_input)))
@@ -17,10 +17,12 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Test common payment processor."""
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, override_settings
 
-from django_pain.constants import PaymentProcessingError
-from django_pain.processors import ProcessPaymentResult
+from django_pain.constants import PaymentProcessingError, PaymentState
+from django_pain.models import BankPayment
+from django_pain.processors import AccountSnapshot, PaymentSnapshot, ProcessPaymentResult, copy_payment
+from django_pain.tests.utils import get_account, get_payment
 
 
 class TestProcessPaymentResult(SimpleTestCase):
@@ -45,3 +47,50 @@ class TestProcessPaymentResult(SimpleTestCase):
             ProcessPaymentResult(False) == ProcessPaymentResult(False, PaymentProcessingError.DUPLICITY),
             False
         )
+
+
+class TestPaymentSnapshot(SimpleTestCase):
+    """Test PaymentSnapshot."""
+
+    def setUp(self):
+        self.account = get_account(id=1, account_number='123456/7890', currency='CZK')
+        self.payment = get_payment(id=2, identifier='PAYMENT', account=self.account, variable_symbol='1234')
+
+    def test_from_payment(self):
+        snapshot = PaymentSnapshot.from_payment(self.payment)
+        self.assertEqual(snapshot.pk, 2)
+        self.assertEqual(snapshot.identifier, 'PAYMENT')
+        self.assertEqual(snapshot.uuid, self.payment.uuid)
+        self.assertEqual(snapshot.amount, self.payment.amount)
+        self.assertEqual(snapshot.variable_symbol, '1234')
+        self.assertIsInstance(snapshot.account, AccountSnapshot)
+        self.assertEqual(snapshot.account.pk, 1)
+        self.assertEqual(snapshot.account.account_number, '123456/7890')
+        self.assertEqual(snapshot.account.currency, 'CZK')
+
+    def test_str(self):
+        snapshot = PaymentSnapshot.from_payment(self.payment)
+        self.assertEqual(str(snapshot), 'PAYMENT')
+        self.assertEqual(str(snapshot), str(self.payment))
+
+    def test_read_only(self):
+        snapshot = PaymentSnapshot.from_payment(self.payment)
+        with self.assertRaisesRegex(AttributeError, 'PaymentSnapshot is read-only.'):
+            snapshot.state = PaymentState.PROCESSED
+        with self.assertRaisesRegex(AttributeError, 'AccountSnapshot is read-only.'):
+            snapshot.account.account_number = '000000/0000'
+        with self.assertRaises(AttributeError):
+            del snapshot.identifier
+
+    def test_copy_payment(self):
+        copy = copy_payment(self.payment)
+        self.assertIsInstance(copy, PaymentSnapshot)
+        self.assertEqual(copy.identifier, 'PAYMENT')
+
+    @override_settings(PAIN_PROCESSORS_DEEPCOPY_PAYMENTS=True)
+    def test_copy_payment_deepcopy(self):
+        copy = copy_payment(self.payment)
+        self.assertIsInstance(copy, BankPayment)
+        self.assertIsNot(copy, self.payment)
+        self.assertIsNot(copy.account, self.account)
+        self.assertEqual(copy.identifier, 'PAYMENT')
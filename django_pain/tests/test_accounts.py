@@ -0,0 +1,133 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test bank account registry."""
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from django_pain.accounts import BankAccountRegistry, get_bank_account, get_bank_accounts
+from django_pain.models import BankAccount
+
+from .mixins import CacheResetMixin
+
+
+class TestBankAccountRegistry(TestCase):
+    """Test BankAccountRegistry."""
+
+    def setUp(self):
+        self.registry = BankAccountRegistry()
+        self.account = BankAccount.objects.create(account_number='123456/7890', currency='CZK')
+        self.other_account = BankAccount.objects.create(account_number='987654/3210', currency='EUR')
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.registry.get('123456/7890'), self.account)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.get('123456/7890'), self.account)
+
+    def test_get_not_exists(self):
+        with self.assertRaisesMessage(BankAccount.DoesNotExist, 'Bank account 000000/0000 does not exist.'):
+            self.registry.get('000000/0000')
+        # Missing accounts are not remembered.
+        account = BankAccount.objects.create(account_number='000000/0000', currency='CZK')
+        self.assertEqual(self.registry.get('000000/0000'), account)
+
+    def test_get_copy(self):
+        account = self.registry.get('123456/7890')
+        account.account_name = 'Changed'
+        self.assertIsNot(self.registry.get('123456/7890'), account)
+        self.assertEqual(self.registry.get('123456/7890').account_name, '')
+
+    def test_get_many(self):
+        self.registry.get('123456/7890')
+        with self.assertNumQueries(1):
+            accounts = self.registry.get_many(['123456/7890', '987654/3210', '000000/0000'])
+        self.assertEqual(accounts, {'123456/7890': self.account, '987654/3210': self.other_account})
+        with self.assertNumQueries(0):
+            self.registry.get_many(['123456/7890', '987654/3210'])
+
+    @override_settings(PAIN_BANK_ACCOUNT_CACHE_TIMEOUT=60)
+    def test_expiration(self):
+        with patch('django_pain.accounts.time.monotonic', return_value=1000):
+            self.registry.get('123456/7890')
+        with patch('django_pain.accounts.time.monotonic', return_value=1059):
+            with self.assertNumQueries(0):
+                self.registry.get('123456/7890')
+        with patch('django_pain.accounts.time.monotonic', return_value=1060):
+            with self.assertNumQueries(1):
+                self.registry.get('123456/7890')
+
+    @override_settings(PAIN_BANK_ACCOUNT_CACHE_TIMEOUT=None)
+    def test_no_expiration(self):
+        with patch('django_pain.accounts.time.monotonic', return_value=1000):
+            self.registry.get('123456/7890')
+        with patch('django_pain.accounts.time.monotonic', return_value=1000000):
+            with self.assertNumQueries(0):
+                self.registry.get('123456/7890')
+
+    def test_clear(self):
+        self.registry.get('123456/7890')
+        self.registry.clear()
+        with self.assertNumQueries(1):
+            self.registry.get('123456/7890')
+
+    def test_clear_while_fetching(self):
+        registry = self.registry
+
+        class ClearingList(list):
+            def __init__(self, iterable):
+                super().__init__(iterable)
+                registry.clear()
+
+        with patch('django_pain.accounts.list', ClearingList, create=True):
+            self.assertEqual(registry.get('123456/7890'), self.account)
+        # Account fetched before the clear is not stored.
+        with self.assertNumQueries(1):
+            registry.get('123456/7890')
+
+
+class TestGetBankAccount(CacheResetMixin, TestCase):
+    """Test get_bank_account and get_bank_accounts."""
+
+    def setUp(self):
+        super().setUp()
+        self.account = BankAccount.objects.create(account_number='123456/7890', account_name='Account',
+                                                  currency='CZK')
+
+    def test_get_bank_account(self):
+        self.assertEqual(get_bank_account('123456/7890'), self.account)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_bank_account('123456/7890').account_name, 'Account')
+
+    def test_get_bank_accounts(self):
+        self.assertEqual(get_bank_accounts(['123456/7890', '000000/0000']), {'123456/7890': self.account})
+
+    def test_invalidated_on_save(self):
+        get_bank_account('123456/7890')
+        self.account.account_number = '123456/0000'
+        self.account.save()
+        with self.assertRaises(BankAccount.DoesNotExist):
+            get_bank_account('123456/7890')
+        self.assertEqual(get_bank_account('123456/0000'), self.account)
+
+    def test_invalidated_on_delete(self):
+        get_bank_account('123456/7890')
+        self.account.delete()
+        with self.assertRaises(BankAccount.DoesNotExist):
+            get_bank_account('123456/7890')
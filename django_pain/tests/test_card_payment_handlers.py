@@ -18,18 +18,27 @@
 
 """Tests of card payment handlers."""
 import datetime
+import threading
+import time
 from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import Mock, patch, sentinel
 
 import requests
 from django.test import TestCase, override_settings
 from djmoney.money import Money
 from pycsob import conf as CSOB
+from pycsob.utils import CsobVerifyError
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
-from django_pain.card_payment_handlers import (CartItem, CSOBCardPaymentHandler, PaymentHandlerConnectionError,
-                                               PaymentHandlerError)
+from django_pain.card_payment_handlers import (CardPaymentState, CartItem, CSOBCardPaymentHandler,
+                                               PaymentHandlerConnectionError, PaymentHandlerError)
+from django_pain.card_payment_handlers.csob import CSOBHTTPAdapter
 from django_pain.constants import PaymentState, PaymentType
+from django_pain.metrics import CARD_GATEWAY_REQUEST_DURATION
 from django_pain.models.bank import BankPayment
+from django_pain.tests.mixins import CacheResetMixin
 from django_pain.tests.utils import get_account, get_payment
 
 csob_settings = {
@@ -43,7 +52,108 @@ csob_settings = {
 }
 
 
-class TestCSOBCardPaymentHandlerStatus(TestCase):
+class GatewayRequestHandler(BaseHTTPRequestHandler):
+    """Request handler of the dummy gateway which fails every other request or delays responses if required."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        self.server.requests += 1  # type: ignore
+        time.sleep(self.server.delay)  # type: ignore
+        status = 503 if self.server.failing and self.server.requests % 2 else 200  # type: ignore
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        """Do not log requests."""
+
+
+class TestCSOBCardPaymentHandlerSession(CacheResetMixin, TestCase):
+    """Test HTTP session of CSOBCardPaymentHandler."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), GatewayRequestHandler)
+        self.server.requests = 0  # type: ignore
+        self.server.failing = False  # type: ignore
+        self.server.delay = 0  # type: ignore
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def _get_settings(self, **kwargs):
+        settings = dict(csob_settings, API_URL=self.url)
+        settings.update(kwargs)
+        return settings
+
+    def test_adapter(self):
+        with override_settings(PAIN_CSOB_CARD=self._get_settings(POOL_SIZE=20, CONNECT_TIMEOUT=1, READ_TIMEOUT=5,
+                                                                 RETRIES=3)):
+            handler = CSOBCardPaymentHandler('csob')
+            adapter = handler.client._client.get_adapter('https://example.org/')
+        self.assertIsInstance(adapter, CSOBHTTPAdapter)
+        self.assertEqual(adapter.timeout, (1, 5))
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertNotIn('Connection', handler.client._client.headers)
+        self.assertIsInstance(handler.client._client.headers, CaseInsensitiveDict)
+        self.assertIsNot(handler.client._client.headers, CSOB.HEADERS)
+
+    def test_adapter_timeout(self):
+        with override_settings(PAIN_CSOB_CARD=self._get_settings()):
+            handler = CSOBCardPaymentHandler('csob')
+            session = handler.client._client
+        with patch('requests.adapters.HTTPAdapter.send', autospec=True, side_effect=HTTPAdapter.send) as send_mock:
+            session.get(self.url)
+            session.get(self.url, timeout=1)
+        self.assertEqual([call[1]['timeout'] for call in send_mock.call_args_list], [(3.05, 12), 1])
+
+    def test_connection_reuse(self):
+        with override_settings(PAIN_CSOB_CARD=self._get_settings()):
+            handler = CSOBCardPaymentHandler('csob')
+            self.assertEqual(handler.get_connection_stats(), {'requests': 0, 'connections': 0})
+            for _ in range(3):
+                handler.client._client.get(self.url)
+        self.assertEqual(handler.get_connection_stats(), {'requests': 3, 'connections': 1})
+
+    def test_no_keep_alive(self):
+        with override_settings(PAIN_CSOB_CARD=self._get_settings(KEEP_ALIVE=False)):
+            handler = CSOBCardPaymentHandler('csob')
+            for _ in range(3):
+                handler.client._client.get(self.url)
+        self.assertEqual(handler.get_connection_stats(), {'requests': 3, 'connections': 3})
+        self.assertEqual(handler.client._client.headers['connection'], 'close')
+        self.assertNotIn('Connection', CSOB.HEADERS)
+
+    def test_retries(self):
+        self.server.failing = True  # type: ignore
+        with override_settings(PAIN_CSOB_CARD=self._get_settings(RETRIES=1, RETRY_BACKOFF=0)):
+            handler = CSOBCardPaymentHandler('csob')
+            self.assertEqual(handler.client._client.get(self.url).status_code, 200)
+            self.assertEqual(handler.client._client.post(self.url).status_code, 503)
+        self.assertEqual(self.server.requests, 3)  # type: ignore
+        self.assertEqual(handler.get_connection_stats(), {'requests': 2, 'connections': 1})
+
+    def test_read_timeout(self):
+        self.server.delay = 0.5  # type: ignore
+        with override_settings(PAIN_CSOB_CARD=self._get_settings(READ_TIMEOUT=0.1)):
+            handler = CSOBCardPaymentHandler('csob')
+            session = handler.client._client
+        # Requests which change payments are not retried, so read timeouts are not turned to connection errors.
+        with patch.object(handler.client, 'payment_init', side_effect=lambda: session.post(self.url)):
+            with self.assertRaisesRegex(PaymentHandlerConnectionError, 'Gateway connection error'):
+                handler._call_gateway('payment_init')
+
+
+class TestCSOBCardPaymentHandlerStatus(CacheResetMixin, TestCase):
     """Test CSOBCardPaymentHandler.payment_status method."""
 
     def test_get_client(self):
@@ -73,6 +183,34 @@ class TestCSOBCardPaymentHandlerStatus(TestCase):
 
         self.assertEqual(payment.state, PaymentState.CANCELED)
 
+    def test_get_payment_state_duration(self):
+        CARD_GATEWAY_REQUEST_DURATION.clear()
+        self.addCleanup(CARD_GATEWAY_REQUEST_DURATION.clear)
+        result_mock = Mock()
+        result_mock.payload = {'paymentStatus': CSOB.PAYMENT_STATUS_CANCELLED, 'resultCode': CSOB.RETURN_CODE_OK}
+
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.payment_status.return_value = result_mock
+            handler.get_payment_state(get_payment(identifier='1', payment_type=PaymentType.CARD_PAYMENT))
+
+        self.assertIn('pain_card_gateway_request_duration_seconds_count{handler="csob",operation="payment_status"} 1',
+                      CARD_GATEWAY_REQUEST_DURATION.collect())
+
+    def test_get_payment_state_duration_connection_error(self):
+        CARD_GATEWAY_REQUEST_DURATION.clear()
+        self.addCleanup(CARD_GATEWAY_REQUEST_DURATION.clear)
+
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.payment_status.side_effect = requests.ConnectionError
+            with self.assertRaises(PaymentHandlerConnectionError):
+                handler.get_payment_state(get_payment(identifier='1', payment_type=PaymentType.CARD_PAYMENT))
+
+        gateway_client_mock.payment_status.assert_called_once_with(pay_id='1')
+        self.assertIn('pain_card_gateway_request_duration_seconds_count{handler="csob",operation="payment_status"} 1',
+                      CARD_GATEWAY_REQUEST_DURATION.collect())
+
     def test_update_payment_state_no_update_not_initialized(self):
         account = get_account(account_number='123456', currency='CZK')
         account.save()
@@ -128,14 +266,110 @@ class TestCSOBCardPaymentHandlerStatus(TestCase):
             self.assertRaises(PaymentHandlerConnectionError, handler.update_payments_state, payment)
 
 
-class TestCSOBCardPaymentHandlerInit(TestCase):
+class TestCSOBCardPaymentHandlerNotification(CacheResetMixin, TestCase):
+    """Test CSOBCardPaymentHandler.verify_notification method."""
+
+    def test_verify_notification(self):
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.gateway_return.return_value = OrderedDict([
+                ('payId', 'unique_id_123'),
+                ('resultCode', CSOB.RETURN_CODE_OK),
+                ('paymentStatus', CSOB.PAYMENT_STATUS_CONFIRMED),
+            ])
+            self.assertEqual(handler.verify_notification({'payId': 'unique_id_123'}),
+                             ('unique_id_123', CardPaymentState('Confirmed', PaymentState.READY_TO_PROCESS)))
+
+    def test_verify_notification_unverified(self):
+        handler = CSOBCardPaymentHandler('csob')
+        for error in (CsobVerifyError(), KeyError('signature'), ValueError()):
+            with self.subTest(error=error):
+                with patch.object(handler, '_client') as gateway_client_mock:
+                    gateway_client_mock.gateway_return.side_effect = error
+                    self.assertRaisesRegex(PaymentHandlerError, 'Unverified gateway return data',
+                                           handler.verify_notification, {})
+
+    def test_verify_notification_not_ok(self):
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.gateway_return.return_value = OrderedDict([
+                ('payId', 'unique_id_123'),
+                ('resultCode', CSOB.RETURN_CODE_MERCHANT_BLOCKED),
+            ])
+            self.assertRaisesRegex(PaymentHandlerError, 'gateway return resultCode != OK',
+                                   handler.verify_notification, {})
+
+    def test_verify_notification_invalid(self):
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.gateway_return.return_value = OrderedDict([
+                ('payId', 'unique_id_123'),
+                ('resultCode', CSOB.RETURN_CODE_OK),
+                ('paymentStatus', 42),
+            ])
+            self.assertRaisesRegex(PaymentHandlerError, 'Invalid gateway return data',
+                                   handler.verify_notification, {})
+
+
+class TestCSOBCardPaymentHandlerInit(CacheResetMixin, TestCase):
     """Test CSOBCardPaymentHandler.init_payment method."""
     def test_init_payment_connection_error(self):
+        account = get_account(account_number='123456', currency='CZK')
+        account.save()
+
         handler = CSOBCardPaymentHandler('csob')
         with patch.object(handler, '_client') as gateway_client_mock:
             gateway_client_mock.payment_init.side_effect = requests.ConnectionError()
             self.assertRaises(PaymentHandlerConnectionError, handler.init_payment, Money(100, 'CZK'), '123', 'csob',
-                              'https://example.com', 'POST', [], 'cs')
+                              'https://example.com', 'POST', [CartItem('Gift for FRED', 1, 100, 'Gift')], 'cs')
+        # The reservation is removed.
+        self.assertFalse(BankPayment.objects.exists())
+
+    def test_init_payment_reserved(self):
+        account = get_account(account_number='123456', currency='CZK')
+        account.save()
+
+        def payment_init(**kwargs):
+            # Payment is reserved and committed before the gateway is called.
+            payment = BankPayment.objects.get()
+            self.assertEqual(payment.state, PaymentState.RESERVED)
+            self.assertEqual(payment.identifier, str(payment.uuid))
+            return Mock()
+
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.payment_init.side_effect = payment_init
+            gateway_client_mock.gateway_return.return_value = OrderedDict([
+                ('payId', 'unique_id_123'),
+                ('resultCode', CSOB.RETURN_CODE_OK),
+                ('paymentStatus', CSOB.PAYMENT_STATUS_INIT),
+            ])
+            payment, _ = handler.init_payment(Money(100, 'CZK'), '123', 'donations', 'https://example.com', 'POST',
+                                              [CartItem('Gift for FRED', 1, 100, 'Gift')], 'cs')
+
+        self.assertEqual(gateway_client_mock.payment_init.call_count, 1)
+        payment = BankPayment.objects.get(pk=payment.pk)
+        self.assertEqual(payment.identifier, 'unique_id_123')
+        self.assertEqual(payment.state, PaymentState.INITIALIZED)
+
+    def test_init_payment_account_cached(self):
+        account = get_account(account_number='123456', currency='CZK')
+        account.save()
+
+        handler = CSOBCardPaymentHandler('csob')
+        with patch.object(handler, '_client') as gateway_client_mock:
+            gateway_client_mock.gateway_return.side_effect = [
+                {'payId': 'unique_id_{}'.format(i), 'resultCode': CSOB.RETURN_CODE_OK,
+                 'paymentStatus': CSOB.PAYMENT_STATUS_INIT}
+                for i in range(2)]
+            handler.init_payment(Money(100, 'CZK'), '123', 'donations', 'https://example.com', 'POST',
+                                 [CartItem('Gift for FRED', 1, 100, 'Gift')], 'cs')
+            # Only the reservation is inserted and then updated.
+            with self.assertNumQueries(2):
+                payment, _ = handler.init_payment(Money(100, 'CZK'), '123', 'donations', 'https://example.com',
+                                                  'POST', [CartItem('Gift for FRED', 1, 100, 'Gift')], 'cs')
+
+        self.assertEqual(payment.account, account)
 
     def test_init_payment_ok(self):
         account = get_account(account_number='123456', currency='CZK')
@@ -296,6 +530,7 @@ class TestCSOBCardPaymentHandlerInit(TestCase):
                                    [CartItem('Gift for FRED', 1, 1000000,
                                              'Gift for the best FRED')],
                                    'cs')
+        self.assertFalse(BankPayment.objects.exists())
 
     def test_init_payment_not_wrong_status(self):
         account = get_account(account_number='123456', currency='CZK')
@@ -0,0 +1,141 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test locks."""
+import os
+from typing import cast
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from testfixtures import TempDirectory
+
+from django_pain.locks import FileLock, LockError, PostgresAdvisoryLock, get_lock
+
+
+class TestFileLock(SimpleTestCase):
+    """Test FileLock."""
+
+    def setUp(self):
+        self.tempdir = TempDirectory()
+        self.lock_file = os.path.join(cast(str, self.tempdir.path), 'test.lock')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_path(self):
+        self.assertEqual(FileLock('process_payments', path=self.lock_file).path, self.lock_file)
+        self.assertEqual(FileLock('process_payments', '123456/7890', self.lock_file).path,
+                         self.lock_file + '.123456_7890')
+
+    def test_default_path(self):
+        with patch('django_pain.locks.tempfile.gettempdir', return_value=self.tempdir.path):
+            self.assertEqual(FileLock('process_payments').path,
+                             os.path.join(cast(str, self.tempdir.path), 'pain_process_payments.lock'))
+            self.assertEqual(FileLock('download_payments', '123456/7890').path,
+                             os.path.join(cast(str, self.tempdir.path), 'pain_download_payments.lock.123456_7890'))
+
+    def test_exclusive(self):
+        lock = FileLock('process_payments', path=self.lock_file)
+        other_lock = FileLock('process_payments', path=self.lock_file)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other_lock.acquire())
+        self.assertFalse(other_lock.acquire(shared=True))
+        lock.release()
+        self.assertTrue(other_lock.acquire())
+        other_lock.release()
+
+    def test_shared(self):
+        lock = FileLock('process_payments', path=self.lock_file)
+        other_lock = FileLock('process_payments', path=self.lock_file)
+        self.assertTrue(lock.acquire(shared=True))
+        self.assertTrue(other_lock.acquire(shared=True))
+        self.assertFalse(FileLock('process_payments', path=self.lock_file).acquire())
+        lock.release()
+        other_lock.release()
+
+    def test_keys(self):
+        lock = FileLock('process_payments', '123456/7890', self.lock_file)
+        other_lock = FileLock('process_payments', '987654/3210', self.lock_file)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(other_lock.acquire())
+        lock.release()
+        other_lock.release()
+
+    def test_release_not_acquired(self):
+        FileLock('process_payments', path=self.lock_file).release()
+
+    def test_error(self):
+        lock = FileLock('process_payments', path=self.lock_file)
+        os.mkdir(lock.path)
+        with self.assertRaisesRegex(LockError, r'^Error occured while opening lockfile .*/test.lock: .*Is a directory'):
+            lock.acquire()
+
+    def test_release_error(self):
+        lock = FileLock('process_payments', path=self.lock_file)
+        self.assertTrue(lock.acquire())
+        with patch('django_pain.locks.fcntl.flock', side_effect=OSError('Gone')):
+            with self.assertRaisesRegex(LockError, r'^Error occured while unlocking lockfile .*/test.lock: Gone'):
+                lock.release()
+        # The lock file is closed anyway, so the lock is released.
+        self.assertTrue(FileLock('process_payments', path=self.lock_file).acquire())
+
+    def test_get_lock(self):
+        lock = get_lock('process_payments', '123456/7890', self.lock_file)
+        self.assertIsInstance(lock, FileLock)
+        self.assertEqual(str(lock), 'process_payments:123456/7890')
+        self.assertEqual(cast(FileLock, lock).path, self.lock_file + '.123456_7890')
+
+
+class TestPostgresAdvisoryLock(TestCase):
+    """Test PostgresAdvisoryLock."""
+
+    def test_lock_id(self):
+        self.assertEqual(PostgresAdvisoryLock('process_payments').lock_id,
+                         PostgresAdvisoryLock('process_payments', '').lock_id)
+        self.assertNotEqual(PostgresAdvisoryLock('process_payments').lock_id,
+                            PostgresAdvisoryLock('process_payments', '123456/7890').lock_id)
+        for value in PostgresAdvisoryLock('process_payments', '123456/7890').lock_id:
+            self.assertGreaterEqual(value, -2 ** 31)
+            self.assertLess(value, 2 ** 31)
+
+    @skipIf(connection.vendor == 'postgresql', 'Requires other database than PostgreSQL.')
+    def test_not_postgres(self):
+        with self.assertRaisesRegex(LockError, 'Advisory lock process_payments requires PostgreSQL database.'):
+            PostgresAdvisoryLock('process_payments').acquire()
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL database.')
+    def test_acquire(self):
+        lock = PostgresAdvisoryLock('process_payments')
+        self.assertTrue(lock.acquire())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        lock.release()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL database.')
+    def test_shared(self):
+        lock = PostgresAdvisoryLock('process_payments', '123456/7890')
+        self.assertTrue(lock.acquire(shared=True))
+        lock.release()
+        self.assertTrue(lock.acquire())
+        lock.release()
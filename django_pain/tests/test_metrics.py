@@ -0,0 +1,282 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test metrics."""
+import os
+import socket
+from typing import List, cast
+from unittest.mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from testfixtures import LogCapture, TempDirectory
+
+from django_pain.metrics import (AbstractMetricsBackend, CommandMetrics, Histogram, LoggingMetricsBackend,
+                                 PrometheusTextfileMetricsBackend, StatsdMetricsBackend, format_labels,
+                                 get_metrics_backends)
+from django_pain.settings import SETTINGS
+
+from .mixins import CacheResetMixin
+
+
+class DummyMetricsBackend(AbstractMetricsBackend):
+    """Metrics backend which remembers reported metrics."""
+
+    reported: List[CommandMetrics] = []
+
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def report(self, metrics):
+        if self.fail:
+            raise ValueError('Gone')
+        self.reported.append(metrics)
+
+
+def get_metrics(perf_counter=(0.0,)):
+    """Return metrics with fixed timings."""
+    with patch('django_pain.metrics.time.perf_counter', side_effect=perf_counter):
+        metrics = CommandMetrics('test_command')
+    metrics.timings.update([('parse', 2.0), ('save', 0.5)])
+    metrics.counts.update([('parse', 10)])
+    metrics.duration = 3.0
+    return metrics
+
+
+class TestCommandMetrics(CacheResetMixin, SimpleTestCase):
+    """Test CommandMetrics."""
+
+    def setUp(self):
+        super().setUp()
+        DummyMetricsBackend.reported = []
+
+    def test_stage(self):
+        with patch('django_pain.metrics.time.perf_counter', side_effect=[0.0, 1.0, 2.0, 3.0, 4.0, 6.0, 10.0]):
+            metrics = CommandMetrics('test_command')
+            with metrics.stage('save'):
+                with metrics.stage('process'):
+                    with metrics.stage('save'):
+                        pass
+        self.assertEqual(metrics.timings, {'save': 6.0, 'process': 3.0})
+        self.assertEqual(metrics.counts, {})
+
+    def test_stage_exception(self):
+        with patch('django_pain.metrics.time.perf_counter', side_effect=[0.0, 1.0, 3.0]):
+            metrics = CommandMetrics('test_command')
+            with self.assertRaises(ValueError):
+                with metrics.stage('save'):
+                    raise ValueError('Gone')
+        self.assertEqual(metrics.timings, {'save': 2.0})
+
+    def test_iterate(self):
+        with patch('django_pain.metrics.time.perf_counter', side_effect=[0.0, 1.0, 2.0, 3.0, 5.0, 6.0, 6.5]):
+            metrics = CommandMetrics('test_command')
+            self.assertEqual(list(metrics.iterate('parse', ['a', 'b'])), ['a', 'b'])
+        self.assertEqual(metrics.timings, {'parse': 3.5})
+        self.assertEqual(metrics.counts, {'parse': 2})
+
+    def test_add(self):
+        metrics = get_metrics()
+        metrics.add({'parse': 1.0, 'process': 4.0}, {'parse': 5, 'process': 3})
+        self.assertEqual(metrics.timings, {'parse': 3.0, 'save': 0.5, 'process': 4.0})
+        self.assertEqual(metrics.counts, {'parse': 15, 'process': 3})
+
+    def test_get_rates(self):
+        metrics = get_metrics()
+        metrics.counts.update([('process', 2)])
+        self.assertEqual(metrics.get_rates(), {'parse': 5.0})
+
+    def test_get_timings_since(self):
+        metrics = get_metrics()
+        self.assertEqual(metrics.get_timings_since({'parse': 1.5, 'save': 0.5}), {'parse': 0.5})
+        self.assertEqual(metrics.get_timings_since({}), {'parse': 2.0, 'save': 0.5})
+
+    def test_finish(self):
+        with patch('django_pain.metrics.time.perf_counter', side_effect=[1.0, 4.0]):
+            metrics = CommandMetrics('test_command')
+            metrics.finish()
+        self.assertEqual(metrics.duration, 3.0)
+
+    @override_settings(PAIN_METRICS_BACKENDS={
+        'broken': {'BACKEND': 'django_pain.tests.test_metrics.DummyMetricsBackend', 'PARAMS': {'fail': True}},
+        'dummy': {'BACKEND': 'django_pain.tests.test_metrics.DummyMetricsBackend', 'PARAMS': {}},
+    })
+    def test_finish_backends(self):
+        metrics = CommandMetrics('test_command')
+        with LogCapture('django_pain.metrics', propagate=False) as log_handler:
+            metrics.finish()
+        self.assertEqual(DummyMetricsBackend.reported, [metrics])
+        log_handler.check(
+            ('django_pain.metrics', 'ERROR', 'Metrics backend broken failed to report metrics: Gone'),
+        )
+
+
+class TestLoggingMetricsBackend(SimpleTestCase):
+    """Test LoggingMetricsBackend."""
+
+    def test_report(self):
+        with LogCapture('django_pain.metrics', propagate=False) as log_handler:
+            LoggingMetricsBackend(level='DEBUG').report(get_metrics())
+        log_handler.check(
+            ('django_pain.metrics', 'DEBUG',
+             'Command test_command stage parse took 2.000 s, 10 items, 5.0 items/s.'),
+            ('django_pain.metrics', 'DEBUG', 'Command test_command stage save took 0.500 s.'),
+            ('django_pain.metrics', 'DEBUG', 'Command test_command took 3.000 s.'),
+        )
+
+
+class TestStatsdMetricsBackend(SimpleTestCase):
+    """Test StatsdMetricsBackend."""
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(5)
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_report(self):
+        metrics = get_metrics()
+        metrics.command = 'test command'
+        backend = StatsdMetricsBackend(host='127.0.0.1', port=self.sock.getsockname()[1], prefix='pain')
+        backend.report(metrics)
+        lines = [self.sock.recv(1024).decode() for _ in range(4)]
+        self.assertEqual(lines, ['pain.test_command.parse:2000.000|ms',
+                                 'pain.test_command.save:500.000|ms',
+                                 'pain.test_command.items.parse:10|g',
+                                 'pain.test_command.total:3000.000|ms'])
+
+
+class TestPrometheusTextfileMetricsBackend(SimpleTestCase):
+    """Test PrometheusTextfileMetricsBackend."""
+
+    def setUp(self):
+        self.tempdir = TempDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_report(self):
+        backend = PrometheusTextfileMetricsBackend(directory=cast(str, self.tempdir.path))
+        with patch('django_pain.metrics.time.time', return_value=1500000000.0):
+            backend.report(get_metrics())
+        self.assertEqual(os.listdir(cast(str, self.tempdir.path)), ['pain_test_command.prom'])
+        self.assertEqual(self.tempdir.read('pain_test_command.prom', encoding='utf-8').splitlines(), [
+            '# HELP pain_command_stage_seconds Duration of the command stage in seconds.',
+            '# TYPE pain_command_stage_seconds gauge',
+            'pain_command_stage_seconds{command="test_command",stage="parse"} 2.0',
+            'pain_command_stage_seconds{command="test_command",stage="save"} 0.5',
+            '# HELP pain_command_stage_items Number of items processed by the command stage.',
+            '# TYPE pain_command_stage_items gauge',
+            'pain_command_stage_items{command="test_command",stage="parse"} 10',
+            '# HELP pain_command_duration_seconds Duration of the command in seconds.',
+            '# TYPE pain_command_duration_seconds gauge',
+            'pain_command_duration_seconds{command="test_command"} 3.0',
+            '# HELP pain_command_last_run_timestamp_seconds Time when the command finished.',
+            '# TYPE pain_command_last_run_timestamp_seconds gauge',
+            'pain_command_last_run_timestamp_seconds{command="test_command"} 1500000000.0',
+        ])
+
+    def test_report_error(self):
+        backend = PrometheusTextfileMetricsBackend(directory=cast(str, self.tempdir.path))
+        with patch('django_pain.metrics.os.replace', side_effect=OSError('Gone')):
+            with self.assertRaisesRegex(OSError, 'Gone'):
+                backend.report(get_metrics())
+        self.assertEqual(os.listdir(cast(str, self.tempdir.path)), [])
+
+
+class TestFormatLabels(SimpleTestCase):
+    """Test format_labels."""
+
+    def test_format(self):
+        self.assertEqual(format_labels(), '{}')
+        self.assertEqual(format_labels(origin='bank', account='a"b\\c\nd'), '{origin="bank",account="a\\"b\\\\c\\nd"}')
+
+
+class TestHistogram(SimpleTestCase):
+    """Test Histogram."""
+
+    def test_collect_empty(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ('operation',))
+        self.assertEqual(histogram.collect(), ['# HELP test_seconds Test histogram.', '# TYPE test_seconds histogram'])
+
+    def test_observe(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ('operation',), buckets=(1.0, 0.5))
+        histogram.observe(0.2, operation='init')
+        histogram.observe(0.5, operation='init')
+        histogram.observe(0.7, operation='init')
+        histogram.observe(3.0, operation='init')
+        histogram.observe(0.1, operation='status')
+        self.assertEqual(histogram.collect(), [
+            '# HELP test_seconds Test histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{operation="init",le="0.5"} 2',
+            'test_seconds_bucket{operation="init",le="1.0"} 3',
+            'test_seconds_bucket{operation="init",le="+Inf"} 4',
+            'test_seconds_sum{operation="init"} 4.4',
+            'test_seconds_count{operation="init"} 4',
+            'test_seconds_bucket{operation="status",le="0.5"} 1',
+            'test_seconds_bucket{operation="status",le="1.0"} 1',
+            'test_seconds_bucket{operation="status",le="+Inf"} 1',
+            'test_seconds_sum{operation="status"} 0.1',
+            'test_seconds_count{operation="status"} 1',
+        ])
+
+    def test_time(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ('operation',), buckets=(1.0, ))
+        with patch('django_pain.metrics.time.perf_counter', side_effect=[1.0, 3.0]):
+            with self.assertRaises(ValueError):
+                with histogram.time(operation='init'):
+                    raise ValueError('Gone')
+        self.assertEqual(histogram.collect()[2:], [
+            'test_seconds_bucket{operation="init",le="1.0"} 0',
+            'test_seconds_bucket{operation="init",le="+Inf"} 1',
+            'test_seconds_sum{operation="init"} 2.0',
+            'test_seconds_count{operation="init"} 1',
+        ])
+
+    def test_clear(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ('operation',))
+        histogram.observe(0.2, operation='init')
+        histogram.clear()
+        self.assertEqual(len(histogram.collect()), 2)
+
+
+class TestGetMetricsBackends(CacheResetMixin, SimpleTestCase):
+    """Test get_metrics_backends and the metrics backends setting."""
+
+    def test_default(self):
+        SETTINGS.check()
+        self.assertEqual(get_metrics_backends(), {})
+
+    @override_settings(PAIN_METRICS_BACKENDS={
+        'log': {'BACKEND': 'django_pain.metrics.LoggingMetricsBackend', 'PARAMS': {'level': 'DEBUG'}},
+    })
+    def test_backends(self):
+        SETTINGS.check()
+        backends = get_metrics_backends()
+        self.assertEqual(list(backends.keys()), ['log'])
+        self.assertIsInstance(backends['log'], LoggingMetricsBackend)
+
+    @override_settings(PAIN_METRICS_BACKENDS={
+        'log': {'BACKEND': 'django_pain.tests.test_metrics.get_metrics', 'PARAMS': {}},
+    })
+    def test_invalid_backend(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, 'is not subclass of AbstractMetricsBackend'):
+            SETTINGS.check()
@@ -17,16 +17,22 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Test models."""
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from unittest import skipUnless
 
+from django.contrib.admin import AdminSite
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import BLANK_CHOICE_DASH
-from django.test import SimpleTestCase, TestCase, override_settings
+from django.db import IntegrityError, connection
+from django.db.models import BLANK_CHOICE_DASH, F
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from djmoney.money import Money
 from freezegun import freeze_time
 
-from django_pain.constants import InvoiceType, PaymentType
+from django_pain.admin import BankPaymentAdmin
+from django_pain.admin.filters import PaymentStateListFilter
+from django_pain.admin.paginators import KeysetChangeList
+from django_pain.constants import InvoiceType, PaymentState, PaymentType
+from django_pain.management.commands.process_payments import Command as ProcessPaymentsCommand
 from django_pain.models import BankPayment, PaymentImportHistory
 
 from .mixins import CacheResetMixin
@@ -110,6 +116,116 @@ class TestBankPayment(CacheResetMixin, TestCase):
         payment = get_payment(account=account, payment_type=PaymentType.CARD_PAYMENT, counter_account_number='123')
         self.assertRaises(IntegrityError, payment.save)
 
+    @freeze_time('2018-01-01 12:00')
+    def test_defer(self):
+        payment = get_payment()
+        payment.defer()
+        payment.defer()
+
+        self.assertEqual(payment.state, PaymentState.DEFERRED)
+        self.assertEqual(payment.processing_attempts, 2)
+        self.assertIsNone(payment.next_processing_time)
+
+    @freeze_time('2018-01-01 12:00')
+    @override_settings(PAIN_PROCESSING_RETRY_DELAY=60, PAIN_PROCESSING_RETRY_MAX_DELAY=300)
+    def test_defer_retry_delay(self):
+        payment = get_payment()
+        expected = [datetime(2018, 1, 1, 12, 1), datetime(2018, 1, 1, 12, 2), datetime(2018, 1, 1, 12, 4),
+                    datetime(2018, 1, 1, 12, 5), datetime(2018, 1, 1, 12, 5)]
+        for attempt, next_processing_time in enumerate(expected, start=1):
+            payment.defer()
+            self.assertEqual(payment.processing_attempts, attempt)
+            self.assertEqual(payment.next_processing_time, next_processing_time)
+
+    def test_save_clears_next_processing_time(self):
+        account = get_account()
+        account.save()
+        payment = get_payment(account=account, state=PaymentState.DEFERRED,
+                              next_processing_time=datetime(2018, 1, 1, 12))
+        payment.save()
+        self.assertEqual(BankPayment.objects.get().next_processing_time, datetime(2018, 1, 1, 12))
+
+        payment.state = PaymentState.PROCESSED
+        payment.save(update_fields=['state'])
+        self.assertIsNone(payment.next_processing_time)
+        self.assertIsNone(BankPayment.objects.get().next_processing_time)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL database.')
+class TestBankPaymentIndexes(TestCase):
+    """
+    Test queries on bank payments use the indexes.
+
+    Payments resemble production data, so the planner prefers the indexes on its own:
+    payments of many accounts are imported day by day, a fifth of them stays deferred
+    and only the latest ones, card payments among them, are ready to process.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        accounts = []
+        for account_index in range(20):
+            account = get_account(account_number='{}/0100'.format(account_index),
+                                  account_name='Account {}'.format(account_index))
+            account.save()
+            accounts.append(account)
+        payments = []
+        for index in range(1000):
+            payment_type, counter_account_number = PaymentType.TRANSFER, '098765/4321'
+            if index >= 995:
+                state = PaymentState.READY_TO_PROCESS
+                payment_type, counter_account_number = PaymentType.CARD_PAYMENT, ''
+            elif index % 5:
+                state = PaymentState.PROCESSED
+            else:
+                state = PaymentState.DEFERRED
+            for account_index, account in enumerate(accounts):
+                payments.append(get_payment(
+                    identifier='PAYMENT_{}_{}'.format(account_index, index), account=account, state=state,
+                    payment_type=payment_type, counter_account_number=counter_account_number,
+                    transaction_date=date(2018, 1, 1) + timedelta(days=index // 20),
+                    counter_account_name='Customer {}'.format(index)))
+        BankPayment.objects.bulk_create(payments)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE django_pain_bankaccount')
+            cursor.execute('ANALYZE django_pain_bankpayment')
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_process_payments(self):
+        options = {'time_from': None, 'time_to': None, 'include_accounts': None, 'exclude_accounts': None}
+        payments = ProcessPaymentsCommand()._get_payments(options)
+        self.assertUsesIndex(payments.filter(payment_type=PaymentType.CARD_PAYMENT).order_by('transaction_date'),
+                             'bankpayment_unprocessed_idx')
+        self.assertUsesIndex(
+            payments.order_by(F('transaction_date').asc(nulls_last=True), 'pk').values_list('pk')[:10],
+            'bankpayment_unproc_batch_idx')
+
+    def test_payment_state_list_filter(self):
+        request = RequestFactory().get('/')
+        list_filter = PaymentStateListFilter(BankPayment._meta.get_field('state'), request,
+                                             {'state__exact': PaymentState.READY_TO_PROCESS}, BankPayment,
+                                             BankPaymentAdmin, 'state')
+        payments = BankPayment.objects.filter(account__account_name='Account 1')
+        payments = payments.order_by('-transaction_date', '-create_time')
+        # Admin shows the first page of the list.
+        self.assertUsesIndex(list_filter.queryset(request, payments)[:100], 'bankpayment_account_state_idx')
+
+    def test_keyset_pagination(self):
+        cursor = BankPayment.objects.get(identifier='PAYMENT_1_500')
+        segments = KeysetChangeList._following(BankPayment.objects.all(), (cursor.transaction_date,
+                                                                           cursor.create_time, cursor.pk))
+        payments = segments[0].order_by(*KeysetChangeList.keyset_ordering)[:101]
+        self.assertUsesIndex(payments, 'bankpayment_keyset_idx')
+        self.assertNotIn('Sort', payments.explain())
+
+    @override_settings(PAIN_ADMIN_FULLTEXT_SEARCH=True)
+    def test_admin_search(self):
+        model_admin = BankPaymentAdmin(BankPayment, AdminSite())
+        payments, _ = model_admin.get_search_results(RequestFactory().get('/'), BankPayment.objects.all(), 'corp')
+        self.assertUsesIndex(payments, 'bankpayment_name_trgm_idx')
+
 
 class TestPaymentImportHistory(CacheResetMixin, TestCase):
     """Test PaymentImportHistory model."""
@@ -17,20 +17,25 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 """Tests of the REST API."""
 import datetime
+import threading
 from collections import OrderedDict
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, call, patch
 
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from pycsob import conf as CSOB
+from pycsob.utils import CsobVerifyError
 from testfixtures import LogCapture
 
-from django_pain.card_payment_handlers import PaymentHandlerConnectionError
+from django_pain.card_payment_handlers import CardPaymentState, PaymentHandlerConnectionError
 from django_pain.constants import PaymentState, PaymentType
+from django_pain.metrics import REST_REQUEST_DURATION
 from django_pain.models import BankPayment
 from django_pain.serializers import ExternalPaymentState
 from django_pain.settings import get_card_payment_handler_instance
 from django_pain.tests.mixins import CacheResetMixin
 from django_pain.tests.utils import get_account, get_payment
+from django_pain.views.rest import get_cached_payment_state
 
 
 @override_settings(ROOT_URLCONF='django_pain.tests.urls',
@@ -51,6 +56,13 @@ class TestBankPaymentRestAPI(CacheResetMixin, TestCase):
         response = self.client.get('/api/private/bankpayment/no-i-do-not-exists/')
         self.assertEqual(response.status_code, 404)
 
+    def test_request_duration(self):
+        REST_REQUEST_DURATION.clear()
+        self.addCleanup(REST_REQUEST_DURATION.clear)
+        self.client.get('/api/private/bankpayment/no-i-do-not-exists/')
+        self.assertIn('pain_rest_request_duration_seconds_count{action="retrieve",method="GET",status="404"} 1',
+                      REST_REQUEST_DURATION.collect())
+
     def test_retrieve_exists(self):
         account = get_account(account_number='123456', currency='CZK')
         account.save()
@@ -192,7 +204,7 @@ class TestBankPaymentRestAPI(CacheResetMixin, TestCase):
             gateway_client_mock.side_effect = PaymentHandlerConnectionError()
             response = self.client.post('/api/private/bankpayment/', data={
                 'amount': '1000',
-                'amount_currency': 'EUR',
+                'amount_currency': 'CZK',
                 'variable_symbol': '130',
                 'processor': 'donations',
                 'card_handler': 'csob',
@@ -203,3 +215,191 @@ class TestBankPaymentRestAPI(CacheResetMixin, TestCase):
             })
 
         self.assertEqual(response.status_code, 503)
+        self.assertFalse(BankPayment.objects.exists())
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls',
+                   PAIN_CARD_PAYMENT_HANDLERS={
+                       'csob': 'django_pain.card_payment_handlers.csob.CSOBCardPaymentHandler'
+                   },
+                   PAIN_CARD_PAYMENT_STATE_CACHE_TIMEOUT=60)
+class TestBankPaymentRestAPICache(CacheResetMixin, TestCase):
+    """Test caching of card payment states."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        account = get_account(account_number='123456', currency='CZK')
+        account.save()
+        self.payment = get_payment(identifier='1', account=account, counter_account_number='',
+                                   payment_type=PaymentType.CARD_PAYMENT, state=PaymentState.INITIALIZED,
+                                   card_handler='csob')
+        self.payment.save()
+
+    def _retrieve(self, payment_status, count=2):
+        result_mock = Mock()
+        result_mock.payload = {'paymentStatus': payment_status, 'resultCode': CSOB.RETURN_CODE_OK}
+        card_payment_hadler = get_card_payment_handler_instance(self.payment.card_handler)
+        with patch.object(card_payment_hadler, '_client') as gateway_client_mock:
+            gateway_client_mock.payment_status.return_value = result_mock
+            for _ in range(count):
+                response = self.client.get('/api/private/bankpayment/{}/'.format(self.payment.uuid))
+                self.assertEqual(response.status_code, 200)
+        return response, gateway_client_mock.payment_status.call_count
+
+    def test_retrieve_cached(self):
+        response, call_count = self._retrieve(CSOB.PAYMENT_STATUS_PROCESS)
+        self.assertEqual(call_count, 1)
+        self.assertEqual(response.data['state'], ExternalPaymentState.INITIALIZED)
+        self.assertEqual(BankPayment.objects.get().card_payment_state,
+                         CSOB.PAYMENT_STATUSES[CSOB.PAYMENT_STATUS_PROCESS])
+
+    @override_settings(PAIN_PROCESSORS={
+        'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+    def test_retrieve_paid_not_cached(self):
+        BankPayment.objects.update(processor='dummy')
+        response, call_count = self._retrieve(CSOB.PAYMENT_STATUS_CONFIRMED)
+        # The first request processes the payment, the other one gets its state again.
+        self.assertEqual(call_count, 2)
+        self.assertEqual(response.data['state'], ExternalPaymentState.PAID)
+        self.assertEqual(BankPayment.objects.get().state, PaymentState.PROCESSED)
+
+    @override_settings(PAIN_CARD_PAYMENT_STATE_CACHE_TIMEOUT=None)
+    def test_retrieve_cache_disabled(self):
+        response, call_count = self._retrieve(CSOB.PAYMENT_STATUS_PROCESS)
+        self.assertEqual(call_count, 2)
+
+    def test_retrieve_connection_error(self):
+        card_payment_hadler = get_card_payment_handler_instance(self.payment.card_handler)
+        with patch.object(card_payment_hadler, '_client') as gateway_client_mock:
+            gateway_client_mock.payment_status.side_effect = PaymentHandlerConnectionError()
+            response = self.client.get('/api/private/bankpayment/{}/'.format(self.payment.uuid))
+        self.assertEqual(response.status_code, 503)
+
+    @override_settings(PAIN_CARD_PAYMENT_HANDLERS={
+        'csob': 'django_pain.tests.commands.test_get_payments_states.DummyUpdatingCardPaymentHandler'})
+    def test_retrieve_updated_by_handler(self):
+        response = self.client.get('/api/private/bankpayment/{}/'.format(self.payment.uuid))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], ExternalPaymentState.CANCELED)
+        self.assertEqual(BankPayment.objects.get().card_payment_state, 'updated')
+
+    def test_get_cached_payment_state_coalesced(self):
+        payment_state = CardPaymentState('Probíhá', PaymentState.INITIALIZED)
+        requested = threading.Event()
+        release = threading.Event()
+
+        def get_payment_state(payment):
+            requested.set()
+            release.wait(5)
+            return payment_state
+
+        handler = Mock()
+        handler.get_payment_state.side_effect = get_payment_state
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_cached_payment_state(handler, self.payment)))
+                   for _ in range(3)]
+        threads[0].start()
+        requested.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [payment_state] * 3)
+        self.assertEqual(handler.get_payment_state.call_count, 1)
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls',
+                   PAIN_CARD_PAYMENT_HANDLERS={
+                       'csob': 'django_pain.card_payment_handlers.csob.CSOBCardPaymentHandler',
+                       'dummy': 'django_pain.tests.utils.DummyCardPaymentHandler',
+                   },
+                   PAIN_PROCESSORS={
+                       'dummy': 'django_pain.tests.commands.test_process_payments.DummyTruePaymentProcessor'})
+class TestBankPaymentRestAPINotification(CacheResetMixin, TestCase):
+    """Test notifications of card payments."""
+
+    def setUp(self):
+        super().setUp()
+        account = get_account(account_number='123456', currency='CZK')
+        account.save()
+        self.payment = get_payment(identifier='1', account=account, counter_account_number='',
+                                   payment_type=PaymentType.CARD_PAYMENT, state=PaymentState.INITIALIZED,
+                                   card_handler='csob', processor='dummy')
+        self.payment.save()
+
+    def _notify(self, gateway_return, method='post', data=None):
+        card_payment_hadler = get_card_payment_handler_instance('csob')
+        with patch.object(card_payment_hadler, '_client') as gateway_client_mock:
+            if isinstance(gateway_return, Exception):
+                gateway_client_mock.gateway_return.side_effect = gateway_return
+            else:
+                gateway_client_mock.gateway_return.return_value = gateway_return
+            response = getattr(self.client, method)('/api/private/bankpayment/notification/csob/',
+                                                    data or {'payId': '1', 'signature': 'SIGNATURE'})
+        return response, gateway_client_mock.gateway_return
+
+    def test_notification_paid(self):
+        response, gateway_return_mock = self._notify(OrderedDict([
+            ('payId', '1'), ('resultCode', CSOB.RETURN_CODE_OK), ('paymentStatus', CSOB.PAYMENT_STATUS_CONFIRMED)]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], ExternalPaymentState.PAID)
+        self.assertEqual(gateway_return_mock.mock_calls, [call({'payId': '1', 'signature': 'SIGNATURE'})])
+        payment = BankPayment.objects.get()
+        self.assertEqual(payment.state, PaymentState.PROCESSED)
+        self.assertEqual(payment.card_payment_state, CSOB.PAYMENT_STATUSES[CSOB.PAYMENT_STATUS_CONFIRMED])
+
+    def test_notification_get(self):
+        response, gateway_return_mock = self._notify(OrderedDict([
+            ('payId', '1'), ('resultCode', CSOB.RETURN_CODE_OK), ('paymentStatus', CSOB.PAYMENT_STATUS_CANCELLED)]),
+            method='get')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], ExternalPaymentState.CANCELED)
+        self.assertEqual(gateway_return_mock.mock_calls, [call({'payId': '1', 'signature': 'SIGNATURE'})])
+        self.assertEqual(BankPayment.objects.get().state, PaymentState.CANCELED)
+
+    def test_notification_not_initialized(self):
+        BankPayment.objects.update(state=PaymentState.PROCESSED)
+        response, _ = self._notify(OrderedDict([
+            ('payId', '1'), ('resultCode', CSOB.RETURN_CODE_OK), ('paymentStatus', CSOB.PAYMENT_STATUS_CANCELLED)]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(BankPayment.objects.get().state, PaymentState.PROCESSED)
+
+    @override_settings(PAIN_CARD_PAYMENT_STATE_CACHE_TIMEOUT=60)
+    def test_notification_cache_invalidated(self):
+        cache.set('pain_card_payment_state_{}'.format(self.payment.uuid),
+                  CardPaymentState('Initialized', PaymentState.INITIALIZED))
+        self.addCleanup(cache.clear)
+        self._notify(OrderedDict([
+            ('payId', '1'), ('resultCode', CSOB.RETURN_CODE_OK), ('paymentStatus', CSOB.PAYMENT_STATUS_PROCESS)]))
+
+        self.assertIsNone(cache.get('pain_card_payment_state_{}'.format(self.payment.uuid)))
+        self.assertEqual(BankPayment.objects.get().card_payment_state,
+                         CSOB.PAYMENT_STATUSES[CSOB.PAYMENT_STATUS_PROCESS])
+
+    def test_notification_unverified(self):
+        with LogCapture('django_pain.views.rest') as log_handler:
+            response, _ = self._notify(CsobVerifyError('Invalid signature'))
+        self.assertEqual(response.status_code, 400)
+        log_handler.check(('django_pain.views.rest', 'WARNING',
+                           'Invalid notification of card payment handler csob: Unverified gateway return data'))
+        self.assertEqual(BankPayment.objects.get().state, PaymentState.INITIALIZED)
+
+    def test_notification_unknown_payment(self):
+        response, _ = self._notify(OrderedDict([
+            ('payId', '2'), ('resultCode', CSOB.RETURN_CODE_OK), ('paymentStatus', CSOB.PAYMENT_STATUS_CONFIRMED)]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_notification_unknown_handler(self):
+        response = self.client.post('/api/private/bankpayment/notification/unknown/', {})
+        self.assertEqual(response.status_code, 404)
+
+    def test_notification_not_supported(self):
+        response = self.client.post('/api/private/bankpayment/notification/dummy/', {})
+        self.assertEqual(response.status_code, 404)
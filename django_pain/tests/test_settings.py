@@ -23,6 +23,7 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.test import SimpleTestCase, override_settings
 
+from django_pain.locks import FileLock, PostgresAdvisoryLock
 from django_pain.settings import (SETTINGS, get_card_payment_handler_class, get_card_payment_handler_instance,
                                   get_processor_class, get_processor_instance, get_processor_objective)
 
@@ -67,6 +68,34 @@ class TestProcessorsSetting(SimpleTestCase):
             SETTINGS.check()
 
 
+class TestLockBackendSetting(SimpleTestCase):
+    """Test LockBackendSetting."""
+
+    def test_default(self):
+        """Test default setting."""
+        SETTINGS.check()
+        self.assertEqual(SETTINGS.lock_backend, FileLock)
+
+    @override_settings(PAIN_LOCK_BACKEND='django_pain.locks.PostgresAdvisoryLock')
+    def test_ok(self):
+        """Test ok setting."""
+        SETTINGS.check()
+        self.assertEqual(SETTINGS.lock_backend, PostgresAdvisoryLock)
+
+    @override_settings(PAIN_LOCK_BACKEND='django_pain.tests.test_settings.TestLockBackendSetting')
+    def test_not_correct_subclass(self):
+        """Test not subclass of AbstractLock."""
+        with self.assertRaisesRegex(ImproperlyConfigured, '{} is not subclass of AbstractLock'.format(
+                'django_pain.tests.test_settings.TestLockBackendSetting')):
+            SETTINGS.check()
+
+    @override_settings(PAIN_LOCK_BACKEND='django_pain.locks.UnknownLock')
+    def test_not_importable(self):
+        """Test class which can not be imported."""
+        with self.assertRaisesRegex(ImproperlyConfigured, 'django_pain.locks.UnknownLock can not be imported'):
+            SETTINGS.check()
+
+
 class DummyDownloader(BankStatementDownloader):
     """Dummy class which does not do anything. It is used in TestDownloadersSetting."""
 
@@ -22,7 +22,7 @@ from datetime import date, datetime
 from django.test import SimpleTestCase
 
 from django_pain.models.bank import BankAccount
-from django_pain.utils import StrEnum, full_class_name, parse_date_safe, parse_datetime_safe
+from django_pain.utils import StrEnum, full_class_name, parse_date_safe, parse_datetime_safe, parse_positive_int
 
 
 class TestEnum(StrEnum):
@@ -65,3 +65,17 @@ class ParseDatetimeSafeTest(SimpleTestCase):
             parse_datetime_safe('2017-01-32 00:00')
         with self.assertRaises(ValueError):
             parse_datetime_safe('not a date')
+
+
+class ParsePositiveIntTest(SimpleTestCase):
+
+    def test_parse_positive_int(self):
+        self.assertEqual(parse_positive_int('42'), 42)
+
+    def test_parse_positive_int_fails_on_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_positive_int('0')
+        with self.assertRaises(ValueError):
+            parse_positive_int('-1')
+        with self.assertRaises(ValueError):
+            parse_positive_int('not a number')
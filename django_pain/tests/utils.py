@@ -17,13 +17,14 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Test utils."""
+from concurrent.futures import Executor, Future
 from datetime import date
 from typing import Any
 
 from djmoney.money import Money
 
-from django_pain.card_payment_handlers import (AbstractCardPaymentHandler, PaymentHandlerConnectionError,
-                                               PaymentHandlerError)
+from django_pain.card_payment_handlers import (AbstractCardPaymentHandler, CardPaymentState,
+                                               PaymentHandlerConnectionError, PaymentHandlerError)
 from django_pain.constants import InvoiceType, PaymentState
 from django_pain.models import BankAccount, BankPayment, Client, Invoice
 from django_pain.processors import AbstractPaymentProcessor
@@ -44,6 +45,8 @@ class DummyPaymentProcessor(AbstractPaymentProcessor):
 class DummyCardPaymentHandler(AbstractCardPaymentHandler):
     """Dummy card payment handler."""
 
+    supports_payment_state = True
+
     def init_payment(self, **kwargs):
         """Do nothing."""
 
@@ -52,6 +55,10 @@ class DummyCardPaymentHandler(AbstractCardPaymentHandler):
         payment.state = PaymentState.READY_TO_PROCESS
         payment.save()
 
+    def get_payment_state(self, payment):
+        """Return paid payment state."""
+        return CardPaymentState('paid', PaymentState.READY_TO_PROCESS)
+
 
 class DummyCardPaymentHandlerExc(DummyCardPaymentHandler):
     """Dummy card payment handler which throws connectoin exception."""
@@ -63,6 +70,10 @@ class DummyCardPaymentHandlerExc(DummyCardPaymentHandler):
         """Raise exception."""
         raise PaymentHandlerError('Card Handler Error')
 
+    def get_payment_state(self, payment):
+        """Raise exception."""
+        raise PaymentHandlerError('Card Handler Error')
+
 
 class DummyCardPaymentHandlerConnExc(DummyCardPaymentHandler):
     """Dummy card payment handler which throws connectoin exception."""
@@ -74,6 +85,25 @@ class DummyCardPaymentHandlerConnExc(DummyCardPaymentHandler):
         """Raise exception."""
         raise PaymentHandlerConnectionError('Gateway connection error')
 
+    def get_payment_state(self, payment):
+        """Raise exception."""
+        raise PaymentHandlerConnectionError('Gateway connection error')
+
+
+class SynchronousExecutor(Executor):
+    """Executor which runs the tasks immediately in the current process."""
+
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        pass
+
+    def submit(self, __fn, *args, **kwargs):
+        future = Future()  # type: Future
+        try:
+            future.set_result(__fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
 
 def get_account(**kwargs: Any) -> BankAccount:
     """Create bank account object."""
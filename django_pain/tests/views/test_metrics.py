@@ -0,0 +1,147 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Test metrics view."""
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from freezegun import freeze_time
+
+from django_pain.constants import PaymentState
+from django_pain.metrics import CARD_GATEWAY_REQUEST_DURATION, REST_REQUEST_DURATION
+from django_pain.models import BankAccount, PaymentImportHistory
+from django_pain.tests.utils import get_payment
+from django_pain.views.metrics import LOCK_KEY
+
+
+@override_settings(ROOT_URLCONF='django_pain.tests.urls', PAIN_METRICS_VIEW=True)
+class TestMetrics(TestCase):
+    """Test metrics view."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        CARD_GATEWAY_REQUEST_DURATION.clear()
+        self.addCleanup(CARD_GATEWAY_REQUEST_DURATION.clear)
+        REST_REQUEST_DURATION.clear()
+        self.addCleanup(REST_REQUEST_DURATION.clear)
+        self.account = BankAccount.objects.create(account_number='123456/7890', currency='CZK')
+        BankAccount.objects.create(account_number='987654/3210', currency='CZK')
+
+    def get_lines(self):
+        response = self.client.get(reverse('pain:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return response.content.decode().splitlines()
+
+    @override_settings(PAIN_METRICS_VIEW=False)
+    def test_disabled(self):
+        response = self.client.get(reverse('pain:metrics'))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(PAIN_METRICS_VIEW_TOKEN='Gazpacho!')
+    def test_token(self):
+        for headers, status in (({}, 403),
+                                ({'HTTP_AUTHORIZATION': 'Bearer Gazpacho'}, 403),
+                                ({'HTTP_AUTHORIZATION': 'Gazpacho!'}, 403),
+                                ({'HTTP_AUTHORIZATION': 'Bearer Gazpacho!'}, 200)):
+            with self.subTest(headers=headers):
+                response = self.client.get(reverse('pain:metrics'), **headers)
+                self.assertEqual(response.status_code, status)
+
+    def test_empty(self):
+        self.assertEqual(self.get_lines(), [
+            '# HELP pain_imports_total Number of payment imports.',
+            '# TYPE pain_imports_total counter',
+            '# HELP pain_imported_payments_total Number of payments handled by imports.',
+            '# TYPE pain_imported_payments_total counter',
+            '# HELP pain_deferred_payments Number of deferred payments waiting for processing.',
+            '# TYPE pain_deferred_payments gauge',
+            'pain_deferred_payments{account="123456/7890"} 0',
+            'pain_deferred_payments{account="987654/3210"} 0',
+            '# HELP pain_card_gateway_request_duration_seconds Duration of requests to card payment gateways in '
+            'seconds.',
+            '# TYPE pain_card_gateway_request_duration_seconds histogram',
+            '# HELP pain_rest_request_duration_seconds Duration of REST API requests in seconds.',
+            '# TYPE pain_rest_request_duration_seconds histogram',
+        ])
+
+    def test_metrics(self):
+        PaymentImportHistory.objects.create(origin='bank', imported=5, skipped=2, errors=1, finished=True)
+        PaymentImportHistory.objects.create(origin='bank', imported=3, skipped=0, errors=0, finished=True)
+        PaymentImportHistory.objects.create(origin='transproc', errors=1)
+        get_payment(identifier='1', account=self.account, processor='dummy', state=PaymentState.PROCESSED).save()
+        get_payment(identifier='2', account=self.account, processor='dummy', state=PaymentState.PROCESSED).save()
+        get_payment(identifier='3', account=self.account, processor='dummy', state=PaymentState.DEFERRED).save()
+        get_payment(identifier='4', account=self.account, state=PaymentState.READY_TO_PROCESS).save()
+        CARD_GATEWAY_REQUEST_DURATION.observe(0.2, handler='csob', operation='payment_status')
+
+        lines = self.get_lines()
+
+        self.assertEqual(lines[2:4], ['pain_imports_total{origin="bank"} 2',
+                                      'pain_imports_total{origin="transproc"} 1'])
+        self.assertEqual(lines[6:12], [
+            'pain_imported_payments_total{origin="bank",result="imported"} 8',
+            'pain_imported_payments_total{origin="bank",result="skipped"} 2',
+            'pain_imported_payments_total{origin="bank",result="errored"} 1',
+            'pain_imported_payments_total{origin="transproc",result="imported"} 0',
+            'pain_imported_payments_total{origin="transproc",result="skipped"} 0',
+            'pain_imported_payments_total{origin="transproc",result="errored"} 1',
+        ])
+        self.assertEqual(lines[14:16], ['pain_deferred_payments{account="123456/7890"} 1',
+                                        'pain_deferred_payments{account="987654/3210"} 0'])
+        self.assertFalse([line for line in lines if line.startswith('pain_processed_payments')])
+        self.assertIn(
+            'pain_card_gateway_request_duration_seconds_count{handler="csob",operation="payment_status"} 1', lines)
+
+    def test_cached(self):
+        self.get_lines()
+        PaymentImportHistory.objects.create(origin='bank', imported=5, skipped=2, errors=1, finished=True)
+        CARD_GATEWAY_REQUEST_DURATION.observe(0.2, handler='csob', operation='payment_status')
+
+        with self.assertNumQueries(0):
+            lines = self.get_lines()
+
+        self.assertNotIn('pain_imports_total{origin="bank"} 1', lines)
+        # Durations of requests are not cached.
+        self.assertIn(
+            'pain_card_gateway_request_duration_seconds_count{handler="csob",operation="payment_status"} 1', lines)
+
+    def test_expired(self):
+        with freeze_time('2021-02-01 10:00:00'):
+            self.get_lines()
+        PaymentImportHistory.objects.create(origin='bank', imported=5, skipped=2, errors=1, finished=True)
+
+        with freeze_time('2021-02-01 10:01:00'):
+            lines = self.get_lines()
+
+        self.assertIn('pain_imports_total{origin="bank"} 1', lines)
+        self.assertIsNone(cache.get(LOCK_KEY))
+
+    def test_expired_locked(self):
+        with freeze_time('2021-02-01 10:00:00'):
+            self.get_lines()
+        PaymentImportHistory.objects.create(origin='bank', imported=5, skipped=2, errors=1, finished=True)
+        # Other process recomputes the metrics.
+        cache.add(LOCK_KEY, True)
+
+        with freeze_time('2021-02-01 10:01:00'):
+            with self.assertNumQueries(0):
+                lines = self.get_lines()
+
+        self.assertNotIn('pain_imports_total{origin="bank"} 1', lines)
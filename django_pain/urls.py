@@ -19,11 +19,12 @@
 """django_pain url dispatcher."""
 from django.urls import include, path
 
-from django_pain.views import get_processors_options, load_processor_client_choices, rest
+from django_pain.views import get_processors_options, load_processor_client_choices, metrics, rest
 
 app_name = 'pain'
 urlpatterns = [
     path('ajax/processor_client_choices/', load_processor_client_choices, name='processor_client_choices'),
     path('ajax/get_processors_options/', get_processors_options, name='processor_options'),
     path('api/private/', include(rest.ROUTER.urls)),
+    path('metrics/', metrics, name='metrics'),
 ]
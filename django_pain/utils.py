@@ -17,9 +17,14 @@
 # along with FRED.  If not, see <https://www.gnu.org/licenses/>.
 
 """Various utils."""
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import date, datetime
 from enum import Enum
+from typing import Iterable, Iterator
 
+import django
 from django.utils.dateparse import parse_date, parse_datetime
 
 
@@ -52,3 +57,32 @@ def parse_datetime_safe(value: str) -> datetime:
     if result is None:
         raise ValueError('Could not parse date_time.')
     return result
+
+
+def parse_positive_int(value: str) -> int:
+    """Parse positive integer, raise an exception when unsuccessful."""
+    result = int(value)
+    if result <= 0:
+        raise ValueError('Value has to be a positive integer.')
+    return result
+
+
+def get_worker_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Return pool of worker processes in which Django is set up, so the workers may use the database.
+
+    Workers are spawned rather than forked, so they do not share database connections with this process.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+@contextmanager
+def cancel_on_error(futures: Iterable[Future]) -> Iterator[None]:
+    """Cancel the futures if the block fails, so the remaining tasks are not run in vain."""
+    try:
+        yield
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
@@ -18,8 +18,10 @@
 
 """Views module."""
 from .ajax import get_processors_options, load_processor_client_choices
+from .metrics import metrics
 
 __all__ = [
     'get_processors_options',
     'load_processor_client_choices',
+    'metrics',
 ]
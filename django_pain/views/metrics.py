@@ -0,0 +1,111 @@
+#
+# Copyright (C) 2018-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Metrics view."""
+import hmac
+import time
+from typing import List, Optional, Tuple
+
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count, Sum
+from django.http import Http404, HttpResponse
+
+from django_pain.constants import PaymentState
+from django_pain.metrics import CARD_GATEWAY_REQUEST_DURATION, REST_REQUEST_DURATION, format_labels
+from django_pain.models import BankAccount, BankPayment, PaymentImportHistory
+from django_pain.settings import SETTINGS
+
+CACHE_KEY = 'pain_metrics'
+# Cache key of the lock held by the process which recomputes the metrics.
+LOCK_KEY = 'pain_metrics_lock'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def get_database_metrics() -> List[str]:
+    """
+    Return metrics computed from the database in Prometheus text format.
+
+    Only the import history, which is small, and deferred payments, found by the state index, are queried.
+    Numbers of payments processed by payment processors are reported by metrics backends of process_payments.
+    """
+    lines = ['# HELP pain_imports_total Number of payment imports.',
+             '# TYPE pain_imports_total counter']
+    imports = PaymentImportHistory.objects.values('origin').order_by('origin').annotate(
+        imports=Count('id'), imported=Sum('imported'), skipped=Sum('skipped'), errors=Sum('errors'))
+    for row in imports:
+        lines.append('pain_imports_total{} {}'.format(format_labels(origin=row['origin']), row['imports']))
+    lines.extend(['# HELP pain_imported_payments_total Number of payments handled by imports.',
+                  '# TYPE pain_imported_payments_total counter'])
+    for row in imports:
+        for result, key in (('imported', 'imported'), ('skipped', 'skipped'), ('errored', 'errors')):
+            lines.append('pain_imported_payments_total{} {}'.format(
+                format_labels(origin=row['origin'], result=result), row[key] or 0))
+
+    lines.extend(['# HELP pain_deferred_payments Number of deferred payments waiting for processing.',
+                  '# TYPE pain_deferred_payments gauge'])
+    deferred = dict(BankPayment.objects.filter(state=PaymentState.DEFERRED).values('account').order_by(
+        'account').annotate(count=Count('id')).values_list('account', 'count'))
+    for account_id, account_number in BankAccount.objects.order_by('account_number').values_list(
+            'pk', 'account_number'):
+        lines.append('pain_deferred_payments{} {}'.format(format_labels(account=account_number),
+                                                          deferred.get(account_id, 0)))
+    return lines
+
+
+def get_cached_database_metrics() -> List[str]:
+    """
+    Return metrics computed from the database, cached for PAIN_METRICS_VIEW_CACHE_TIMEOUT seconds.
+
+    Expired metrics are recomputed by a single process, other processes return the expired metrics meanwhile.
+    """
+    timeout = SETTINGS.metrics_view_cache_timeout
+    # Cached metrics are kept with the time they were computed at, so they are available even when expired.
+    cached: Optional[Tuple[float, List[str]]] = cache.get(CACHE_KEY)
+    if cached is not None and time.time() < cached[0] + timeout:
+        return cached[1]
+
+    locked = cache.add(LOCK_KEY, True, timeout)
+    if not locked and cached is not None:
+        return cached[1]
+    try:
+        lines = get_database_metrics()
+        cache.set(CACHE_KEY, (time.time(), lines), None)
+    finally:
+        if locked:
+            cache.delete(LOCK_KEY)
+    return lines
+
+
+def metrics(request):
+    """
+    Return metrics in Prometheus text format.
+
+    Metrics computed from the database are cached for PAIN_METRICS_VIEW_CACHE_TIMEOUT seconds.
+    Durations of requests are measured by the process which handles the request.
+    If PAIN_METRICS_VIEW_TOKEN is set, the request has to contain it as a bearer token.
+    """
+    if not SETTINGS.metrics_view:
+        raise Http404
+    if SETTINGS.metrics_view_token is not None:
+        expected = 'Bearer {}'.format(SETTINGS.metrics_view_token)
+        if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected.encode()):
+            raise PermissionDenied
+
+    lines = get_cached_database_metrics() + CARD_GATEWAY_REQUEST_DURATION.collect() + REST_REQUEST_DURATION.collect()
+    return HttpResponse('\n'.join(lines) + '\n', content_type=CONTENT_TYPE)
@@ -18,51 +18,155 @@
 
 """REST API module."""
 import logging
-from copy import deepcopy
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
 
+from django.core.cache import cache
 from django.db import transaction
+from django.shortcuts import get_object_or_404
 from rest_framework import mixins, routers, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 
-from django_pain.card_payment_handlers import PaymentHandlerConnectionError
+from django_pain.card_payment_handlers import (AbstractCardPaymentHandler, CardPaymentState,
+                                               PaymentHandlerConnectionError, PaymentHandlerError)
 from django_pain.constants import PaymentState, PaymentType
+from django_pain.metrics import REST_REQUEST_DURATION
 from django_pain.models import BankPayment
+from django_pain.processors import copy_payment
 from django_pain.serializers import BankPaymentSerializer
-from django_pain.settings import get_card_payment_handler_instance, get_processor_instance
+from django_pain.settings import SETTINGS, get_card_payment_handler_instance, get_processor_instance
 
 LOGGER = logging.getLogger(__name__)
 
 
+class _KeyLocks(object):
+    """Locks of individual keys, which are discarded when no longer used."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[str, Tuple[threading.Lock, int]] = {}
+
+    @contextmanager
+    def __call__(self, key: str) -> Iterator[None]:
+        """Hold the lock of the key."""
+        with self._lock:
+            lock, users = self._locks.get(key, (threading.Lock(), 0))
+            self._locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._locks.pop(key)
+                if users > 1:
+                    self._locks[key] = (lock, users - 1)
+
+
+_PAYMENT_STATE_LOCKS = _KeyLocks()
+
+
+def _get_payment_state_cache_key(payment: BankPayment) -> str:
+    return 'pain_card_payment_state_{}'.format(payment.uuid)
+
+
+def get_cached_payment_state(card_payment_handler: AbstractCardPaymentHandler,
+                             payment: BankPayment) -> CardPaymentState:
+    """
+    Get state of the payment from Card Gateway or from cache.
+
+    States of initialized payments are cached for PAIN_CARD_PAYMENT_STATE_CACHE_TIMEOUT seconds.
+    Concurrent requests for the state of the same payment in this process share a single request to Card Gateway.
+    """
+    key = _get_payment_state_cache_key(payment)
+    payment_state: Optional[CardPaymentState] = cache.get(key)
+    if payment_state is None:
+        with _PAYMENT_STATE_LOCKS(key):
+            # The state may have been fetched while we were waiting.
+            payment_state = cache.get(key)
+            if payment_state is None:
+                payment_state = card_payment_handler.get_payment_state(payment)
+                if payment_state.state == PaymentState.INITIALIZED:
+                    cache.set(key, payment_state, SETTINGS.card_payment_state_cache_timeout)
+    return payment_state
+
+
 class BankPaymentViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     """BankPayment API for create and retrieve."""
 
-    queryset = BankPayment.objects.filter(payment_type=PaymentType.CARD_PAYMENT).select_for_update()
+    queryset = BankPayment.objects.filter(payment_type=PaymentType.CARD_PAYMENT).exclude(state=PaymentState.RESERVED)
     serializer_class = BankPaymentSerializer
     lookup_field = 'uuid'
+    # Whether get_object should lock the payment.
+    lock_payment = True
+
+    def get_queryset(self):
+        """Return card payments, locked for update if required."""
+        queryset = super().get_queryset()
+        if self.lock_payment:
+            queryset = queryset.select_for_update()
+        return queryset
+
+    def dispatch(self, request, *args, **kwargs):
+        """Dispatch the request and observe its duration."""
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        REST_REQUEST_DURATION.observe(time.perf_counter() - start, action=self.action or '', method=request.method,
+                                      status=str(response.status_code))
+        return response
 
     def _process_payment(self, payment):
         processor = get_processor_instance(payment.processor)
         LOGGER.info('Processing card payment with processor %s.', processor)
-        result = list(processor.process_payments([deepcopy(payment)]))[0]
+        result = list(processor.process_payments([copy_payment(payment)]))[0]
         if result.result:
             payment.state = PaymentState.PROCESSED
         else:
             LOGGER.info('Saving payment %s as DEFERRED with error %s.', payment.uuid, result.error)
-            payment.state = PaymentState.DEFERRED
+            payment.defer()
         payment.processing_error = result.error
         payment.save()
 
     @transaction.atomic()
     def retrieve(self, request, *args, **kwargs):
-        """Update payment state and return update payment."""
+        """
+        Update payment state and return update payment.
+
+        If PAIN_CARD_PAYMENT_STATE_CACHE_TIMEOUT is set, initialized payments are not locked
+        and their state is cached unless it changes.
+        """
+        payment_state = None
+        if SETTINGS.card_payment_state_cache_timeout:
+            self.lock_payment = False
+            try:
+                payment = self.get_object()
+            finally:
+                self.lock_payment = True
+            card_payment_handler = get_card_payment_handler_instance(payment.card_handler)
+            # Other card payment handlers can only update the payment.
+            if payment.state == PaymentState.INITIALIZED and card_payment_handler.supports_payment_state:
+                try:
+                    payment_state = get_cached_payment_state(card_payment_handler, payment)
+                except PaymentHandlerConnectionError:
+                    return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                if payment_state == (payment.card_payment_state, payment.state):
+                    return Response(BankPaymentSerializer(payment).data)
+
         payment = self.get_object()
         old_payment_state = payment.state
 
         card_payment_handler = get_card_payment_handler_instance(payment.card_handler)
-        try:
-            card_payment_handler.update_payments_state(payment)
-        except PaymentHandlerConnectionError:
-            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if payment_state is not None and payment.state == PaymentState.INITIALIZED:
+            payment.card_payment_state, payment.state = payment_state
+            payment.save()
+        else:
+            try:
+                card_payment_handler.update_payments_state(payment)
+            except PaymentHandlerConnectionError:
+                return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
         if old_payment_state == PaymentState.INITIALIZED and payment.state == PaymentState.READY_TO_PROCESS:
             self._process_payment(payment)
@@ -70,9 +174,49 @@ class BankPaymentViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, vie
         serializer = BankPaymentSerializer(payment)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get', 'post'], url_path=r'notification/(?P<card_handler>[^/.]+)')
     @transaction.atomic()
+    def notification(self, request, card_handler):
+        """
+        Update payment state notified by Card Gateway and process the payment if paid.
+
+        The notification is verified by the card payment handler.
+        """
+        try:
+            card_payment_handler = get_card_payment_handler_instance(card_handler)
+        except ValueError:
+            raise NotFound()
+        if not card_payment_handler.supports_notifications:
+            raise NotFound()
+        params = request.data if request.method == 'POST' else request.query_params
+        try:
+            identifier, payment_state = card_payment_handler.verify_notification(dict(params.items()))
+        except PaymentHandlerError as error:
+            LOGGER.warning('Invalid notification of card payment handler %s: %s', card_handler, error)
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        payment = get_object_or_404(self.get_queryset(), card_handler=card_handler, identifier=identifier)
+        old_payment_state = payment.state
+        payment.card_payment_state = payment_state.card_payment_state
+        # Only initialized payments may change their state, see update_payments_state.
+        if payment.state == PaymentState.INITIALIZED:
+            payment.state = payment_state.state
+        payment.save()
+        cache.delete(_get_payment_state_cache_key(payment))
+
+        if old_payment_state == PaymentState.INITIALIZED and payment.state == PaymentState.READY_TO_PROCESS:
+            self._process_payment(payment)
+
+        serializer = BankPaymentSerializer(payment)
+        return Response(serializer.data)
+
     def create(self, request, *args, **kwargs):
-        """Create new payment."""
+        """
+        Create new payment.
+
+        Card payment handler is not called in a transaction, so no transaction has to stay open
+        while Card Gateway initializes the payment.
+        """
         try:
             return super().create(request, *args, **kwargs)
         except PaymentHandlerConnectionError: